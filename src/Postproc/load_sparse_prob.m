@@ -0,0 +1,26 @@
+function Yhat = load_sparse_prob(fileName)
+% LOAD_SPARSE_PROB  Loads sparse CNN estimates (see emlib.save_sparse_prob)
+%
+%      Yhat = load_sparse_prob('YhatDeploy.sparse.mat');
+%
+%   where,
+%     Yhat : a tensor of probability estimates with dimensions 
+%            (nClasses, nSlices, width, height).  Pixels that
+%            were not evaluated have the value -1.
+
+% mjp 2015
+
+S = load(fileName);
+sz = double(S.shape(:)');
+
+Yhat = -1 * ones(sz, 'single');
+
+% coordinates are stored zero-based
+sl = double(S.slice(:)) + 1;
+row = double(S.row(:)) + 1;
+col = double(S.col(:)) + 1;
+
+for k = 1:sz(1)
+    idx = sub2ind(sz, k*ones(size(sl)), sl, row, col);
+    Yhat(idx) = S.values(:,k);
+end
@@ -1,7 +1,7 @@
 """
 Manually converts a .npy output from pycaffe wrappers into a .mat
-file.  Only needed if there is some problem with the .mat file
-produced by the pycaffe wrapper scripts.
+file.  emcnn.py only writes a .mat file itself if run with --save-mat 1
+(since this requires holding the entire volume in memory).
 
 Example:
    python  npy_to_mat.py  YhatDeploy.npy
@@ -16,7 +16,7 @@ if __name__ == "__main__":
     inFile = sys.argv[1]
 
     print('[info]: loading file %s ...' % inFile)
-    Yhat = np.load(inFile)
+    Yhat = np.load(inFile, mmap_mode='r')
     print('[info]: volume has shape: %s' % str(Yhat.shape))
     
 
@@ -8,6 +8,9 @@ function Yhat = postproc_volume(YhatRaw, varargin)
 %                    (nClasses, nSlices, width, height)
 %              -or-
 %                    (width, height, nSlices)
+%              -or-
+%                    the name of a sparse estimates file (see
+%                    load_sparse_prob.m)
 %
 %              In the former case, this code will reshape the volume
 %              to the latter case (i.e. four -> three dimensions).
@@ -40,6 +43,11 @@ p = p.Results;
 
 
 
+% load sparse estimates (if needed)
+if ischar(YhatRaw)
+    YhatRaw = load_sparse_prob(YhatRaw);
+end
+
 % change from 4D caffe tensor to 3D EM tensor (if needed)
 if length(size(YhatRaw)) == 4
     YhatRaw = YhatRaw(2,:,:,:);   % probabilities for class 1 (membrane)
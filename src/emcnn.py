@@ -38,9 +38,10 @@ __copyright__ = "Copyright 2015, JHU/APL"
 __license__ = "Apache 2.0"
 
 
-import sys, os, argparse, time, datetime
+import sys, os, argparse, time, datetime, tempfile, shutil, traceback, Queue, threading
+import multiprocessing as mp
 from pprint import pprint
-from random import shuffle, choice
+from random import shuffle
 import pdb
 
 import numpy as np
@@ -48,7 +49,8 @@ import scipy
 
 from sobol_lib import i4_sobol_generate as sobol
 import emlib
-from pycaffe2 import SGDSolverMemoryData
+import postproc
+from pycaffe2 import SGDSolverMemoryData, SGDSolverDataParallel, ShiftAndStitchNet, dense_geometry, layer_specs
 
 
 
@@ -92,6 +94,30 @@ def _train_mode_args():
 		    type=str, default='', 
 		    help='(optional) limit to a subset of X/Y validation')
 
+    parser.add_argument('--valid-pixels', dest='validPixels', 
+		    type=int, default=0, 
+		    help='(optional) validate on a fixed random subset of this many pixels (0 := all)')
+
+    parser.add_argument('--valid-seconds', dest='validSeconds', 
+		    type=float, default=0, 
+		    help='(optional) time budget (in seconds) for each validation pass (0 := none)')
+
+    parser.add_argument('--async-valid', dest='asyncValid', 
+		    type=int, default=0, 
+		    help='(optional) 1 := validate model snapshots in a separate (CPU) process while training continues')
+
+    parser.add_argument('--resume', dest='resume', 
+		    type=str, default='', 
+		    help='(optional) continue training from this checkpoint (an iter_*.solverstate.npz file)')
+
+    parser.add_argument('--workers', dest='nWorkers', 
+		    type=int, default=1, 
+		    help='(optional) number of network replicas (processes) for data-parallel training; each iteration averages the gradients of this many minibatches.  CPU only; consider setting OMP_NUM_THREADS accordingly')
+
+    parser.add_argument('--prefetch-workers', dest='nPrefetchWorkers', 
+		    type=int, default=1, 
+		    help='(optional) number of processes assembling (and augmenting) minibatches in the background; see --prefetch')
+
     return parser
 
 
@@ -120,6 +146,50 @@ def _deploy_mode_args():
 		    type=str, default='', 
 		    help='(optional) limit to a subset of X/Y deploy volume')
 
+    parser.add_argument('--save-mat', dest='saveMat', 
+		    type=int, default=0, 
+		    help='(optional) 1 := also save the estimates in matlab format (requires holding the entire volume in memory)')
+
+    parser.add_argument('--sparse', dest='sparse', 
+		    type=str, default='', 
+		    help='(optional) store only the evaluated pixels, with this precision (float16 or float32); useful with --eval-pct < 1')
+
+    parser.add_argument('--cache-dir', dest='cacheDir', 
+		    type=str, default='', 
+		    help='(optional) directory for re-using estimates across deployments of the same model, network and volume')
+
+    parser.add_argument('--refine-rounds', dest='refineRounds', 
+		    type=int, default=0, 
+		    help='(optional) with --eval-pct < 1, spend part of the budget on an initial subset of pixels and the rest over this many rounds on the most uncertain pixels')
+
+    parser.add_argument('--refine-tol', dest='refineTol', 
+		    type=float, default=0.0, 
+		    help='(optional) stop refining a slice once no pixel has an uncertainty score above this value (in [0,1])')
+
+    parser.add_argument('--postproc', dest='postproc', 
+		    type=int, default=0, 
+		    help='(optional) 1 := inpaint, smooth and invert the estimates (see postproc.py) after deployment')
+
+    parser.add_argument('--workers', dest='nWorkers', 
+		    type=int, default=1, 
+		    help='(optional) number of processes (each with its own copy of the network) to use; CPU only.  Consider setting OMP_NUM_THREADS=1 when using this')
+
+    parser.add_argument('--block-size', dest='blockSize', 
+		    type=str, default='', 
+		    help='(optional) "slices,rows,cols"; read and evaluate the volume a block at a time (for volumes that do not fit in memory)')
+
+    parser.add_argument('--dense', dest='dense', 
+		    type=int, default=0, 
+		    help='(optional) 1 := evaluate whole slices with a fully convolutional version of the network (shift-and-stitch)')
+
+    parser.add_argument('--dense-check', dest='denseCheck', 
+		    type=int, default=0, 
+		    help='(optional) number of pixels in the first slice to re-evaluate with the tile-based network as a check on --dense')
+
+    parser.add_argument('--dense-approx', dest='denseApprox', 
+		    type=int, default=0, 
+		    help='(optional) 1 := allow --dense for networks whose dense estimates only approximate the tile-based ones (e.g. clipped pooling windows); the difference is then always checked')
+
     # Ref: Gal, Ghahramani "Dropout as a Bayesian Approximation:
     #      Representing Model Uncertainty in Deep Learning," arXiv, 2015.
     parser.add_argument('--n-monte-carlo', dest='nMC', 
@@ -157,6 +227,10 @@ def _get_args():
 		    type=str, default='', 
 		    help='(optional) overrides the snapshot directory')
 
+    parser.add_argument('--prefetch', dest='nPrefetch', 
+		    type=int, default=3, 
+		    help='(optional) number of minibatches to assemble in a background process (0 := no prefetching)')
+
     args = parser.parse_args()
     args.mode = mode
 
@@ -190,24 +264,25 @@ prune_border_4d = lambda X, bs: X[:, :, bs:(-bs), bs:(-bs)]
 
 
             
-def _omit_labels(Y, extraOmits=[]):
+def _omit_labels(Y, extraOmits=[], hist=None):
     """Determines which labels to omit.
     
     This is the union of the set of all negative labels in Y 
     with the set extraOmits.
+
+    hist := (optional) emlib.label_histogram(Y), if already available
     """
+    yVals, counts = emlib.label_histogram(Y) if hist is None else hist
+
     # we always omit labels < 0
-    omitLabels = np.unique(Y)
-    omitLabels = list(omitLabels[omitLabels<0])
+    omitLabels = list(yVals[yVals<0])
 
     # optionally exclude additional pixels
     if extraOmits: 
         omitLabels = omitLabels + extraOmits
 
     # determine the total pct omitted
-    numOmitted = 0
-    for yi in omitLabels:
-        numOmitted += np.sum(Y==yi)
+    numOmitted = np.sum(counts[np.in1d(yVals, omitLabels)])
     
     return omitLabels, 100.0*numOmitted / Y.size
 
@@ -216,52 +291,54 @@ def _omit_labels(Y, extraOmits=[]):
 def _load_data(xName, yName, tileRadius, onlySlices, omitLabels=None):
     """Loads data sets and does basic preprocessing.
     """
-    X = emlib.load_cube(xName, np.float32)
+    # only the slices of interest are read from disk
+    # (in their native format, e.g. uint8)
+    X = emlib.load_cube(xName, None, onlySlices if onlySlices else None)
+    if X.dtype != np.uint8:
+        X = X.astype(np.float32)
 
     # usually we expect fewer slices in Z than pixels in X or Y.
     # Make sure the dimensions look ok before proceeding.
     assert(X.shape[0] < X.shape[1])
     assert(X.shape[0] < X.shape[2])
 
-    if onlySlices: 
-        X = X[onlySlices,:,:] 
     print('[emCNN]:    data shape: %s' % str(X.shape))
 
-    X = emlib.mirror_edges(X, tileRadius)
-
     # Scale data to live in [0 1].
     # *** ASSUMPTION *** original data is in [0 255]
-    if np.max(X) > 1:
-        X = X / 255.
-    print('[emCNN]:    data min/max: %0.2f / %0.2f' % (np.min(X), np.max(X)))
+    # The scaling is applied as tiles are extracted (i.e. to each
+    # float32 minibatch) and the mirrored edges are not materialized.
+    scale = _data_scale(X)
+    print('[emCNN]:    data min/max: %0.2f / %0.2f' % (scale*np.min(X), scale*np.max(X)))
+    X = emlib.MirroredVolume(X, tileRadius, scale=scale)
 
     # Also obtain labels file (if provided - e.g. in deploy mode
     # we may not have labels...)
     if yName: 
-        Y = emlib.load_cube(yName, np.float32)
-
-        if onlySlices: 
-            Y = Y[onlySlices,:,:] 
+        Y = emlib.load_cube(yName, None, onlySlices if onlySlices else None)
         print('[emCNN]:    labels shape: %s' % str(Y.shape))
+        hist = emlib.label_histogram(Y)   # the only full scan of the labels
 
         # ** ASSUMPTION **: Special case code for membrane detection / ISBI volume
-        yAll = np.unique(Y)
-        yAll.sort()
-        if (len(yAll) == 2) and (yAll[0] == 0) and (yAll[1] == 255):
+        labelOrder = None
+        if (len(hist[0]) == 2) and (hist[0][0] == 0) and (hist[0][1] == 255):
             print('[emCNN]:    ISBI-style labels detected.  converting 0->1, 255->0')
-            Y[Y==0] = 1;      #  membrane
-            Y[Y==255] = 0;    #  non-membrane
+            labelOrder = [255, 0]     # non-membrane, membrane
+            if omitLabels:
+                omitLabels = [{0 : 255, 1 : 0}.get(y, y) for y in omitLabels]
 
         # Labels must be natural numbers (contiguous integers starting at 0)
         # because they are mapped to indices at the output of the network.
-        # This next bit of code remaps the native y values to these indices.
-        omitLabels, pctOmitted = _omit_labels(Y, omitLabels)
-        Y = emlib.fix_class_labels(Y, omitLabels).astype(np.int32)
+        # This next bit of code remaps the native y values to these indices
+        # (and stores them in the smallest suitable type, e.g. int8).
+        omitLabels, pctOmitted = _omit_labels(Y, omitLabels, hist)
+        Y, yAll, counts, nOmitted = emlib.remap_class_labels(Y, omitLabels, labelOrder, hist)
 
-        print('[emCNN]:    yAll is %s' % str(np.unique(Y)))
+        print('[emCNN]:    yAll is %s' % str(range(len(yAll))))
+        print('[emCNN]:    num. pixels per class: %s' % str(list(counts)))
         print('[emCNN]:    will use %0.2f%% of volume' % (100.0 - pctOmitted))
 
-        Y = emlib.mirror_edges(Y, tileRadius)
+        Y = emlib.MirroredVolume(Y, tileRadius)
 
         return X, Y
     else:
@@ -274,7 +351,7 @@ def _load_data(xName, yName, tileRadius, onlySlices, omitLabels=None):
 #-------------------------------------------------------------------------------
 
 
-def _xform_minibatch(X, arbitraryRotation=False):
+def _xform_minibatch(X, arbitraryRotation=False, rng=None):
     """Synthetic data augmentation for one mini-batch.
 
     The default set of data augmentation operations correspond to
@@ -299,7 +376,12 @@ def _xform_minibatch(X, arbitraryRotation=False):
        
        arbitraryRotation := a boolean; when true, will rotate the mini-batch X
                  by some angle in [0, 2*pi)
+
+       rng := (optional) the np.random.RandomState to draw the transformation
+                 from (see emlib.MinibatchPrefetcher); default is np.random
     """
+    if rng is None:
+        rng = np.random
 
     def R0(X):
         return X  # this is the identity map
@@ -332,12 +414,12 @@ def _xform_minibatch(X, arbitraryRotation=False):
         # Note: this should probably be implemented at a higher level
         #       (than the individual mini-batch) so we can incorporate
         #       context rather than filling in pixels with a background color.
-        angle = np.random.rand() * 360.0 
+        angle = rng.rand() * 360.0 
         fillColor = np.max(X) 
         X2 = scipy.ndimage.rotate(X, angle, axes=(2,3), reshape=False, cval=fillColor)
     else:
         symmetries = [R0, R1, R2, R3, M1, M2, D1, D2]
-        op = choice(symmetries) 
+        op = symmetries[rng.randint(len(symmetries))]
         
         # For some reason, the implementation of row and column reversals, 
         #     e.g.      X[:,:,::-1,:]
@@ -356,59 +438,65 @@ def train_one_epoch(solverMD, X, Y,
         batchDim,
         outDir='./', 
         omitLabels=[], 
-        data_augment=None):
+        data_augment=None,
+        nPrefetch=3,
+        sampler=None,
+        on_snapshot=None,
+        on_checkpoint=None,
+        epochSeed=None,
+        skipBatches=0,
+        nPrefetchWorkers=1):
     """ Trains a CNN for a single epoch.
 
     PARAMETERS:
-      solverMD  : an SGDSolverMemoryData object
+      solverMD  : an SGDSolverMemoryData (or SGDSolverDataParallel) object
       X         : a data volume/tensor with dimensions (#slices, height, width)
       Y         : a labels tensor with same size as X
       batchDim  : the tuple (#classes, minibatchSize, height, width)
       outDir    : output directory (e.g. for model snapshots)
       omitLabels : class labels to skip during training (or [] for none)
       data_agument : synthetic data augmentation function
+      nPrefetch : number of minibatch buffers to assemble in the background
+                  (0 := assemble minibatches inline)
+      nPrefetchWorkers : number of background processes assembling minibatches
+      sampler   : (optional) an emlib.StratifiedSampler for Y; creating this
+                  once per training run (vs once per epoch) avoids 
+                  recomputing the per-class pixel pools.
+      on_snapshot : (optional) a function f(iteration, modelFile) that is
+                  called each time a model snapshot is saved.
+      on_checkpoint : (optional) a function f(nBatches) that is called each 
+                  time a model snapshot is saved, where nBatches is the 
+                  number of minibatches completed in this epoch.
+      epochSeed : (optional) seed for the sampler (see StratifiedSampler.epoch())
+                  and for data augmentation (see emlib.MinibatchPrefetcher)
+      skipBatches : number of minibatches to skip (e.g. when resuming)
 
     """
-
-    # Pre-allocate some variables & storage.
-    #
     tileRadius = int(batchDim[2]/2)
-    Xi = np.zeros(batchDim, dtype=np.float32)
-    yi = np.zeros((batchDim[0],), dtype=np.float32)
-    yMax = np.max(Y).astype(np.int32)
     
     lastChatter = -2
     startTime = time.time()
 
-    it = emlib.stratified_interior_pixel_generator(Y, tileRadius, batchDim[0], omitLabels=omitLabels) 
-
-    for Idx, epochPct in it: 
-        # Map the indices Idx -> tiles Xi and labels yi 
-        # 
-        # Note: if Idx.shape[0] < batchDim[0] (last iteration of an epoch) 
-        # a few examples from the previous minibatch will be "recycled" here. 
-        # This is intentional (to keep batch sizes consistent even if data 
-        # set size is not a multiple of the minibatch size). 
-        # 
-        for jj in range(Idx.shape[0]): 
-            a = Idx[jj,1] - tileRadius 
-            b = Idx[jj,1] + tileRadius + 1 
-            c = Idx[jj,2] - tileRadius 
-            d = Idx[jj,2] + tileRadius + 1 
-            Xi[jj, 0, :, :] = X[ Idx[jj,0], a:b, c:d ]
-            yi[jj] = Y[ Idx[jj,0], Idx[jj,1], Idx[jj,2] ] 
-
-        # label-preserving data transformation (synthetic data generation)
-        if data_augment is not None:
-            Xi = data_augment(Xi)
-
-        assert(not np.any(np.isnan(Xi)))
-        assert(not np.any(np.isnan(yi)))
+    if sampler is None:
+        sampler = emlib.StratifiedSampler(Y, tileRadius, omitLabels=omitLabels)
+    it = sampler.epoch(batchDim[0], seed=epochSeed, skip=skipBatches)
 
+    # Map the indices Idx -> tiles Xi and labels yi; this happens in a
+    # pool of background processes while the CNN works on the current minibatch.
+    prefetcher = emlib.MinibatchPrefetcher(it, X, Y, batchDim,
+                                           data_augment=data_augment,
+                                           nBuffers=nPrefetch,
+                                           nWorkers=nPrefetchWorkers,
+                                           seed=epochSeed,
+                                           firstBatch=skipBatches)
+
+    for nBatches, (Xi, yi, Idx, epochPct) in enumerate(prefetcher, skipBatches+1): 
         #----------------------------------------
         # one forward/backward pass and update weights
         #----------------------------------------
         out = solverMD.step(Xi, yi)
+        if out is None:
+            continue   # data-parallel: this minibatch was handed to a worker
 
         #----------------------------------------
         # Some events occur on regular intervals.
@@ -418,6 +506,10 @@ def train_one_epoch(solverMD, X, Y,
             fn = os.path.join(outDir, 'iter_%06d.caffemodel' % solverMD._iter)
             solverMD._solver.net.save(str(fn))
             print "[emCNN]: Saved snapshot."
+            if on_snapshot is not None:
+                on_snapshot(solverMD._iter, fn)
+            if on_checkpoint is not None:
+                on_checkpoint(nBatches)
 
         if solverMD.is_training_complete():
             break  # we hit max_iter on a non-epoch boundary...all done.
@@ -431,10 +523,21 @@ def train_one_epoch(solverMD, X, Y,
                 
     # all finished with this epoch
     print "[emCNN]:    epoch complete."
+    print "[emCNN]:    %0.2f min spent waiting on minibatch data" % (prefetcher.waitTime/60.)
     sys.stdout.flush()
 
 
 
+def _select_device(args):
+    """Tells caffe to use the CPU or the GPU specified in args."""
+    if args.gpu >= 0:
+	caffe.set_mode_gpu()
+	caffe.set_device(args.gpu)
+    else:
+	caffe.set_mode_cpu()
+
+
+
 def _train_network(args):
     """ Main CNN training loop.
 
@@ -463,19 +566,11 @@ def _train_network(args):
 
     # choose a synthetic data generating function
     if args.rotateData:
-        syn_func = lambda V: _xform_minibatch(V, arbitraryRotation=True)
+        syn_func = lambda V, rng: _xform_minibatch(V, arbitraryRotation=True, rng=rng)
         print('[emCNN]:   WARNING: applying arbitrary rotations to data.  This may degrade performance in some cases...\n')
     else:
-        syn_func = lambda V: _xform_minibatch(V, arbitraryRotation=False)
-
+        syn_func = lambda V, rng: _xform_minibatch(V, arbitraryRotation=False, rng=rng)
 
-    #----------------------------------------
-    # Create the Caffe solver
-    # Note this assumes a relatively recent PyCaffe
-    #----------------------------------------
-    solver = caffe.SGDSolver(args.solver)
-    solverMD = SGDSolverMemoryData(solver, solverParam)
-    solverMD.print_network()
 
     #----------------------------------------
     # Load data
@@ -501,57 +596,417 @@ def _train_network(args):
     # Do training; save results
     #----------------------------------------
     omitLabels = set(args.omitLabels).union([-1,])   # always omit -1
+    sampler = emlib.StratifiedSampler(Ytrain, bs, omitLabels=omitLabels)
     currEpoch = 1
+    if args.nWorkers > 1 and args.gpu < 0:
+        print('[emCNN]:   data-parallel: %0.1f iterations per epoch' % (len(sampler) / float(args.nWorkers*batchDim[0])))
+
+    # With a validation budget, each epoch evaluates the same (random) 
+    # subset of the validation pixels; this is chosen once, here.
+    validIdx = None
+    if args.validPixels > 0 or args.validSeconds > 0:
+        validIdx = validation_pixels(Yvalid, bs, args.validPixels)
+        print "[emCNN]: will validate on (at most) %d pixels" % validIdx.shape[0]
+
+    # Optionally, snapshots are validated in a separate process
+    # (so training need not wait on validation).
+    # Note: the validator process is forked before the training process 
+    # selects its device, as a CUDA context cannot be shared with a child.
+    validator = None
+    if args.asyncValid:
+        def make_net(modelFn):
+            caffe.set_mode_cpu()   # the GPU (if any) belongs to the training process
+            return caffe.Net(str(netFn), str(modelFn), 1)   # 1 := test mode
+        validator = AsyncValidator(make_net, Xvalid, Yvalid, batchDim, 
+                                   os.path.join(outDir, 'validation.log'),
+                                   validIdx=validIdx, maxSeconds=args.validSeconds)
+        print "[emCNN]: validation results will be written to %s" % validator.logFile
+
+    #----------------------------------------
+    # Create the Caffe solver
+    # Note this assumes a relatively recent PyCaffe
+    #----------------------------------------
+    _select_device(args)
+    solver = caffe.SGDSolver(args.solver)
+    if args.nWorkers > 1 and args.gpu < 0:
+        # Note: each iteration consumes nWorkers minibatches, so the solver's
+        # iteration counts (max_iter, snapshot, stepsize) cover nWorkers
+        # times as much data as usual.
+        print('[emCNN]: data-parallel training with %d network replicas' % args.nWorkers)
+        print('[emCNN]:   effective batch size is %d (%d minibatches per iteration)' % (args.nWorkers*batchDim[0], args.nWorkers))
+        make_net = lambda: caffe.Net(str(netFn), 0)   # 0 := train mode
+        solverMD = SGDSolverDataParallel(solver, solverParam, make_net, args.nWorkers)
+    else:
+        if args.nWorkers > 1:
+            print('[emCNN]: WARNING: --workers is only supported in CPU mode')
+        solverMD = SGDSolverMemoryData(solver, solverParam)
+    solverMD.print_network()
+
+    # Each model snapshot is accompanied by a checkpoint of the full 
+    # training state (written in the background).
+    checkpointer = Checkpointer()
+    epochSeeds = []     # the sampler seed used for each epoch
+
+    def checkpoint(nBatches):
+        state = solverMD.get_state()
+        state.update(get_rng_state())
+        state['epochSeeds'] = np.array(epochSeeds, dtype=np.int64)
+        state['epochBatches'] = np.array(nBatches)
+        checkpointer.save(os.path.join(outDir, 'iter_%06d.solverstate.npz' % solverMD._iter), state)
+
+    resumeSeed, skipBatches = None, 0
+    if args.resume:
+        print "[emCNN]: resuming from checkpoint %s" % args.resume
+        state = np.load(args.resume)
+        solverMD.set_state(state)
+        set_rng_state(state)
+        epochSeeds = [int(x) for x in state['epochSeeds']]
+        sampler.replay(epochSeeds[:-1])
+        resumeSeed, skipBatches = epochSeeds[-1], int(state['epochBatches'])
+        currEpoch = len(epochSeeds)
+        print "[emCNN]: resuming at iteration %d (epoch %d, minibatch %d)" % (solverMD._iter, currEpoch, skipBatches)
     sys.stdout.flush()
 
+    yhatIter = None     # the iteration whose estimates are in Yhat.npy (if any)
     while not solverMD.is_training_complete():
         print "[emCNN]: Starting epoch %d" % currEpoch
 
+        if resumeSeed is None:
+            epochSeeds.append(np.random.randint(0, 2**31-1))
+        resumeSeed = None
+
         train_one_epoch(solverMD, Xtrain, Ytrain, 
             batchDim, outDir, 
             omitLabels=omitLabels,
-            data_augment=syn_func)
+            data_augment=syn_func,
+            nPrefetch=args.nPrefetch,
+            sampler=sampler,
+            on_snapshot=validator.submit if validator else None,
+            on_checkpoint=checkpoint,
+            epochSeed=epochSeeds[-1],
+            skipBatches=skipBatches,
+            nPrefetchWorkers=args.nPrefetchWorkers)
 
         currEpoch += 1
+        skipBatches = 0
 
-        print "[emCNN]: Making predictions on validation data..."
-        Mask = np.ones(Xvalid.shape, dtype=np.bool)
-        Mask[Yvalid<0] = False
-        Prob = predict(solver.net, Xvalid, Mask, batchDim)
+        if validator is not None:
+            # validate the current weights (unless train_one_epoch just did so)
+            if validator.lastIter != solverMD._iter:
+                fn = os.path.join(outDir, 'iter_%06d.caffemodel' % solverMD._iter)
+                solver.net.save(str(fn))
+                validator.submit(solverMD._iter, fn)
+            continue
 
-        # discard mirrored edges and form class estimates
-        Yhat = np.argmax(Prob, 0) 
-        Yhat[Mask==False] = -1;
-        Prob = prune_border_4d(Prob, bs)
-        Yhat = prune_border_3d(Yhat, bs)
+        print "[emCNN]: Making predictions on validation data..."
+        if validIdx is None:
+            perf = validate(solver.net, Xvalid, Yvalid, batchDim, nPrefetch=args.nPrefetch,
+                            outFile=os.path.join(outDir, 'Yhat.npy'))
+            yhatIter = solverMD._iter
+        else:
+            perf = validate_pixels(solver.net, Xvalid, Yvalid, validIdx, batchDim, 
+                                   nPrefetch=args.nPrefetch, maxSeconds=args.validSeconds)
 
         # compute some metrics
         print('[emCNN]: Validation set performance:')
-        emlib.metrics(prune_border_3d(Yvalid, bs), Yhat, display=True)
+        perf.report(display=True)
+        if np.sum(perf.H) > 0:
+            print('  ROC AUC:   %0.3f' % perf.auc())
 
  
     solver.net.save(str(os.path.join(outDir, 'final.caffemodel')))
-    np.save(os.path.join(outDir, 'Yhat.npz'), Prob)
-    scipy.io.savemat(os.path.join(outDir, 'Yhat.mat'), {'Yhat' : Prob})
+    solverMD.close()
+    checkpointer.wait()
+    if validator is not None:
+        print "[emCNN]: waiting for snapshot validation to finish..."
+        validator.close()
+    if yhatIter != solverMD._iter:
+        # e.g. validation was budgeted or asynchronous, or (when resuming
+        # from the last checkpoint) no epoch was trained in this run
+        print "[emCNN]: Making predictions on (all) validation data..."
+        validate(solver.net, Xvalid, Yvalid, batchDim, nPrefetch=args.nPrefetch,
+                 outFile=os.path.join(outDir, 'Yhat.npy'))
+    Prob = np.load(os.path.join(outDir, 'Yhat.npy'), mmap_mode='r')
+    scipy.io.savemat(os.path.join(outDir, 'Yhat.mat'), {'Yhat' : np.asarray(Prob)})
     print('[emCNN]: training complete.')
 
 
 
+def validate(net, X, Y, batchDim, nPrefetch=3, outFile=None):
+    """Evaluates a CNN on a labeled data volume, one slice at a time.
+
+    Only pixels with non-negative labels are evaluated; the metrics are
+    accumulated as each slice is processed, so only one slice of 
+    estimates is held in memory.
+
+    PARAMETERS:
+      X, Y     : data and labels volumes (including the mirrored edges)
+      batchDim : a tuple of the form (#classes, minibatchSize, height, width)
+      outFile  : (optional) a .npy file name; if provided, the estimates 
+                 are also streamed to this file (see emlib.create_prob_volume()).
+
+    Returns an emlib.MetricsAccumulator.
+    """
+    bs = border_size(batchDim)
+    perf = emlib.MetricsAccumulator()
+    ProbAll = None
+
+    for ii in range(X.shape[0]):
+        Yi = prune_border_3d(Y[ii:ii+1,...], bs)
+        Mask = np.zeros((1,) + X.shape[1:], dtype=np.bool)
+        prune_border_3d(Mask, bs)[...] = (Yi >= 0)
+        Prob = predict(net, X[ii:ii+1,...], Mask, batchDim, nPrefetch=nPrefetch)
+
+        # form class estimates (Prob does not include the mirrored edges)
+        Yhat = np.argmax(Prob, 0) 
+        Yhat[Yi < 0] = -1
+        perf.update(Yi, Yhat, Prob[1,...] if Prob.shape[0] == 2 else None)
+
+        if outFile:
+            if ProbAll is None:
+                ProbAll = emlib.create_prob_volume((Prob.shape[0], X.shape[0]) + Prob.shape[2:], outFile)
+            ProbAll[:, ii, ...] = Prob[:, 0, ...]
+
+    if ProbAll is not None:
+        ProbAll.flush()
+    return perf
+
+
+
+def get_rng_state():
+    """The state of numpy's (global) random number generator, as a 
+    dictionary of numpy arrays (see set_rng_state())."""
+    rng = np.random.get_state()
+    return {'rngKeys' : rng[1], 'rngPos' : np.array(rng[2]), 
+            'rngHasGauss' : np.array(rng[3]), 'rngGauss' : np.array(rng[4])}
+
+
+
+def set_rng_state(state):
+    np.random.set_state(('MT19937', state['rngKeys'], int(state['rngPos']), 
+                         int(state['rngHasGauss']), float(state['rngGauss'])))
+
+
+
+def _write_checkpoint(fn, state):
+    tmpFn = fn[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmpFn, **state)
+    os.rename(tmpFn, fn)   # so a partially written checkpoint is never used
+
+
+
+class Checkpointer(object):
+    """Writes training checkpoints (dictionaries of numpy arrays, e.g. 
+    from SGDSolverMemoryData.get_state()) to .npz files in a background 
+    thread, so that training need not wait on disk I/O.  At most one 
+    checkpoint is written at a time.
+    """
+
+    def __init__(self):
+        self._thread = None
+
+
+    def save(self, fn, state):
+        """Writes state to fn (in the background); state should not be 
+        modified afterwards."""
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(fn, state))
+        self._thread.start()
+
+
+    def _write(self, fn, state):
+        try:
+            _write_checkpoint(fn, state)
+        except Exception:
+            print('[emCNN]: WARNING: failed to write checkpoint "%s":\n%s' % (fn, traceback.format_exc()))
+
+
+    def wait(self):
+        """Waits for any pending write to complete."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+
+def _validation_worker(make_net, X, Y, batchDim, validIdx, maxSeconds, logFile, taskQ, errorQ):
+    """Evaluates model snapshots (see AsyncValidator).  Failures are 
+    reported (to the parent) via errorQ."""
+    while True:
+        task = taskQ.get()
+        if task is None:
+            break
+        iteration, modelFn = task
+        try:
+            net = make_net(modelFn)
+            tic = time.time()
+            if validIdx is None:
+                perf = validate(net, X, Y, batchDim, nPrefetch=0)
+            else:
+                perf = validate_pixels(net, X, Y, validIdx, batchDim, nPrefetch=0, maxSeconds=maxSeconds)
+            C, acc, precision, recall, f1 = perf.report()
+            auc = perf.auc() if np.sum(perf.H) > 0 else np.nan
+            with open(logFile, 'a') as f:
+                f.write('%d\t%0.5f\t%0.5f\t%0.5f\t%0.5f\t%0.5f\t%d\t%0.1f\n' % (iteration, acc, precision, recall, f1, auc, 
+                                                                              np.sum(perf.support), time.time()-tic))
+        except Exception:
+            errorQ.put((modelFn, traceback.format_exc()))
+        sys.stdout.flush()
+
+
+
+class AsyncValidator(object):
+    """Validates model snapshots in a separate process, so that training
+    does not block on validation.  Each snapshot is loaded into its own 
+    network, evaluated (see validate() and validate_pixels()) and a line 
+    with the metrics is appended to a (tab separated) log file:
+
+        iteration  accuracy  precision  recall  f1  auc  #pixels  seconds
+
+    PARAMETERS:
+      make_net   : a function that, given a model (snapshot) file name,
+                   returns a network (called in the worker process).
+      X, Y       : validation data and labels (including the mirrored edges)
+      logFile    : the file to append the results to
+      validIdx   : (optional) pixels to evaluate; see validation_pixels()
+      maxSeconds : (optional) time budget per snapshot (only with validIdx)
+
+    Failures in the worker process are raised (as RuntimeErrors) by the 
+    next call to submit() or close().
+    """
+
+    def __init__(self, make_net, X, Y, batchDim, logFile, validIdx=None, maxSeconds=0):
+        self.logFile = logFile
+        self.lastIter = None
+        if not os.path.exists(logFile):
+            with open(logFile, 'w') as f:
+                f.write('iteration\taccuracy\tprecision\trecall\tf1\tauc\tnPixels\tseconds\n')
+
+        self._taskQ = mp.Queue()
+        self._errorQ = mp.Queue()
+        self._proc = mp.Process(target=_validation_worker,
+                                args=(make_net, X, Y, batchDim, validIdx, maxSeconds, logFile, self._taskQ, self._errorQ))
+        self._proc.daemon = True
+        self._proc.start()
+
+
+    def _check(self, running=True):
+        """Raises any failure reported by the worker process."""
+        try:
+            modelFn, tb = self._errorQ.get_nowait()
+            raise RuntimeError('validation of "%s" failed:\n%s' % (modelFn, tb))
+        except Queue.Empty:
+            pass
+        if running and not self._proc.is_alive():
+            raise RuntimeError('validation process exited unexpectedly')
+
+
+    def submit(self, iteration, modelFn):
+        """Queues a snapshot for validation."""
+        self._check()
+        self.lastIter = iteration
+        self._taskQ.put((iteration, modelFn))
+
+
+    def close(self):
+        """Waits for all queued snapshots to be validated."""
+        self._taskQ.put(None)
+        self._proc.join()
+        self._check(running=False)
+
+
+
+def validation_pixels(Y, borderSize, nPixels=0, seed=0):
+    """Selects a fixed, random subset of the labeled (i.e. non-negative)
+    pixels in the interior of Y; this is done a slice at a time.
+
+    PARAMETERS:
+      nPixels : the size of the subset (0 := all labeled pixels)
+      seed    : random number generator seed (so the subset is reproducible)
+
+    Returns an (N x 3) int32 tensor of pixel indices, in random order 
+    (so any prefix is also a random subset; see validate_pixels()).
+    """
+    rng = np.random.RandomState(seed)
+    Yi = prune_border_3d(Y, borderSize)   # a view (no mirrored edges)
+    counts = [np.count_nonzero(Yi[ii,...] >= 0) for ii in range(Yi.shape[0])]
+    nPixels = np.sum(counts) if nPixels <= 0 else min(nPixels, np.sum(counts))
+    take = emlib.split_draw(counts, nPixels, rng)
+
+    Idx = []
+    for ii in range(Yi.shape[0]):
+        if take[ii] == 0: continue
+        rows, cols = np.nonzero(Yi[ii,...] >= 0)
+        keep = rng.permutation(rows.size)[:take[ii]]
+        Idx.append(np.column_stack((ii*np.ones(keep.size), rows[keep]+borderSize, cols[keep]+borderSize)).astype(np.int32))
+    Idx = np.concatenate(Idx) if Idx else np.zeros((0,3), dtype=np.int32)
+    rng.shuffle(Idx)
+    return Idx
+
+
+
+def validate_pixels(net, X, Y, Idx, batchDim, nPrefetch=3, maxSeconds=0):
+    """Evaluates a CNN on a given set of (labeled) pixels; see
+    validation_pixels().  Unlike validate(), there is no need to scan the
+    volume (or a mask) to determine which pixels to evaluate.
+
+    PARAMETERS:
+      X, Y       : data and labels volumes (including the mirrored edges)
+      Idx        : (N x 3) indices of the pixels to evaluate
+      maxSeconds : (optional) stop after this much time (0 := no limit).
+                   If Idx is in random order the pixels evaluated are
+                   still a random subset.
+
+    Returns an emlib.MetricsAccumulator.
+    """
+    perf = emlib.MetricsAccumulator()
+    it = ((Idx[ii:ii+batchDim[0]], (1.0*ii)/Idx.shape[0]) for ii in range(0, Idx.shape[0], batchDim[0]))
+    prefetcher = emlib.MinibatchPrefetcher(it, X, Y, batchDim, nBuffers=nPrefetch)
+
+    tic = time.time()
+    for Xi, yi, Idxb, pct in prefetcher:
+        n = Idxb.shape[0]
+        net.set_input_arrays(Xi, yi)
+        P = np.reshape(net.forward()['prob'], (batchDim[0], -1))[:n,:]
+        perf.update(yi[:n], np.argmax(P, axis=1), P[:,1] if P.shape[1] == 2 else None)
+
+        if maxSeconds > 0 and (time.time() - tic) > maxSeconds:
+            print('[emCNN]: validation time budget reached after %d pixels' % np.sum(perf.support))
+            break
+
+    return perf
+
+
+
 #-------------------------------------------------------------------------------
 # Functions for "deploying" a CNN (i.e. forward pass only)
 #-------------------------------------------------------------------------------
 
 
-def predict(net, X, Mask, batchDim, nMC=0):
+def predict(net, X, Mask, batchDim, nMC=0, nPrefetch=3, outFile=None, sparse=None):
     """Generates predictions for a data volume.
 
     PARAMETERS:
       X        : a data volume/tensor with dimensions (#slices, height, width)
+                 (including the mirrored edges)
       Mask     : a boolean tensor with the same size as X.  Only positive
                  elements will be classified.  The prediction for all 
                  negative elements will be -1.  Use this to run predictions
                  on a subset of the volume.
       batchDim : a tuple of the form (#classes, minibatchSize, height, width)
+      nPrefetch : number of minibatch buffers to assemble in the background
+                  (0 := assemble minibatches inline)
+      outFile  : (optional) a .npy file name; if provided, the estimates
+                 are streamed to this (memory mapped) file rather than
+                 held in memory.
+      sparse   : (optional) a numpy dtype (e.g. np.float16).  If provided, only
+                 the estimates for pixels in Mask are stored, with this
+                 precision (see emlib.SparseProbVolume).  In this case,
+                 outFile (if any) should be a .npz or .mat file.
+
+    Returns a float32 tensor Prob with dimensions (#classes, #slices, height, width)
+    where height and width are those of X *without* the mirrored edges
+    (or the emlib.SparseProbVolume equivalent).
 
     """    
     # *** This code assumes a layer called "prob"
@@ -560,19 +1015,19 @@ def predict(net, X, Mask, batchDim, nMC=0):
 
     print "[emCNN]: Evaluating %0.2f%% of cube" % (100.0*np.sum(Mask)/numel(Mask)) 
 
-    # Pre-allocate some variables & storage.
-    #
     tileRadius = int(batchDim[2]/2)
-    Xi = np.zeros(batchDim, dtype=np.float32)
-    yi = np.zeros((batchDim[0],), dtype=np.float32)
     nClasses = net.blobs['prob'].data.shape[1]
 
     # if we don't evaluate all pixels, the 
     # ones not evaluated will have label -1
-    if nMC <= 0: 
-        Prob = -1*np.ones((nClasses, X.shape[0], X.shape[1], X.shape[2]))
+    nOut = nClasses if nMC <= 0 else nMC
+    if sparse is not None:
+        Prob = emlib.SparseProbVolume.from_mask(nOut, prune_border_3d(Mask, tileRadius), dtype=sparse)
     else:
-        Prob = -1*np.ones((nMC, X.shape[0], X.shape[1], X.shape[2]))
+        Prob = emlib.create_prob_volume((nOut, X.shape[0], X.shape[1]-2*tileRadius, X.shape[2]-2*tileRadius), 
+                                        outFile)
+
+    if nMC > 0: 
         print "[emCNN]: Generating %d MC samples for class 0" % nMC
         if nClasses > 2: 
             print "[emCNN]: !!!WARNING!!! nClasses > 2 but we are only extracting MC samples for class 0 at this time..."
@@ -584,15 +1039,14 @@ def predict(net, X, Mask, batchDim, nMC=0):
     lastChatter = -2
     it = emlib.interior_pixel_generator(X, tileRadius, batchDim[0], mask=Mask)
 
-    for Idx, epochPct in it: 
-        # Extract subtiles from validation data set 
-        for jj in range(Idx.shape[0]): 
-            a = Idx[jj,1] - tileRadius 
-            b = Idx[jj,1] + tileRadius + 1 
-            c = Idx[jj,2] - tileRadius 
-            d = Idx[jj,2] + tileRadius + 1 
-            Xi[jj, 0, :, :] = X[ Idx[jj,0], a:b, c:d ]
-            yi[jj] = 0  # this is just a dummy value
+    # Extract subtiles (in the background); yi is just a dummy value
+    prefetcher = emlib.MinibatchPrefetcher(it, X, None, batchDim, nBuffers=nPrefetch)
+
+    for Xi, yi, Idx, epochPct in prefetcher: 
+        # coordinates of these pixels once the mirrored edges are removed
+        n = Idx.shape[0]
+        rows = Idx[:,1] - tileRadius
+        cols = Idx[:,2] - tileRadius
 
         #---------------------------------------- 
         # forward pass only (i.e. no backward pass)
@@ -611,14 +1065,12 @@ def predict(net, X, Mask, batchDim, nMC=0):
             
             # store the per-class probability estimates.  
             # 
-            # * On the final iteration, the size of Prob  may not match 
-            #   the remaining space in Yhat (unless we get lucky and the 
+            # * On the final iteration, the size of ProbBatch may not match 
+            #   the number of pixels in Idx (unless we get lucky and the 
             #   data cube size is a multiple of the mini-batch size).  
-            #   This is why we slice yijHat before assigning to Yhat. 
-            for jj in range(nClasses): 
-                pj = ProbBatch[:,jj]      # get probabilities for class j 
-                assert(len(pj.shape)==1)  # should be a vector (vs tensor) 
-                Prob[jj, Idx[:,0], Idx[:,1], Idx[:,2]] = pj[:Idx.shape[0]]   # (*)
+            #   This is why we slice ProbBatch before assigning to Prob. 
+            assert(ProbBatch.ndim == 2)
+            Prob[:, Idx[:,0], rows, cols] = ProbBatch[:n,:].T   # (*)
         else:
             # Generate MC-based uncertainty estimates
             # (instead of just a single point estimate)
@@ -632,7 +1084,7 @@ def predict(net, X, Mask, batchDim, nMC=0):
                 ProbBatch = np.squeeze(out['prob']) 
                 p0 = ProbBatch[:,0]      # get probabilities for class 0
                 assert(len(p0.shape)==1)  # should be a vector (vs tensor) 
-                Prob[ii, Idx[:,0], Idx[:,1], Idx[:,2]] = p0[:Idx.shape[0]]   # (*)
+                Prob[ii, Idx[:,0], rows, cols] = p0[:n]   # (*)
             cnnTime += time.time() - _tmp 
             
 
@@ -644,7 +1096,388 @@ def predict(net, X, Mask, batchDim, nMC=0):
             sys.stdout.flush()
 
     # done
+    elapsed = (time.time() - startTime) / 60.0
+    if outFile and (sparse is not None):
+        emlib.save_sparse_prob(outFile, Prob)
+    elif outFile:
+        Prob.flush()
     print('[emCNN]: Total time to evaluate cube: %0.2f min (%0.2f CNN min)' % (elapsed, cnnTime/60.))
+    print('[emCNN]: %0.2f min spent waiting on minibatch data' % (prefetcher.waitTime/60.))
+    return Prob
+
+
+
+
+def predict_blockwise(net, V, batchDim, blockSize, slices=None, SliceMask=None, scale=1.,
+                      nPrefetch=3, outFile=None, sparse=None):
+    """Like predict(), but for a volume that is read from disk a block
+    at a time (so peak memory depends on the block size rather than the 
+    volume size).
+
+      V         : the (un-mirrored) volume; see emlib.open_cube()
+      blockSize : (#slices, height, width) of each block.  Each block is
+                  read along with a halo of tileRadius pixels (mirrored
+                  only at the edges of the volume; see emlib.read_block()).
+      slices    : (optional) the subset of slices in V to evaluate
+      SliceMask : (optional) a boolean (height, width) mask of the pixels to
+                  evaluate in each slice, including the mirrored edges
+                  (as for the Mask argument of predict())
+      scale     : multiplier applied to the data (e.g. 1/255.)
+
+    The return value is as for predict().
+    """
+    tileRadius = border_size(batchDim)
+    if slices is None:
+        slices = range(V.shape[0])
+    nSlices = len(slices)
+    m, n = V.shape[1:]
+    if SliceMask is None:
+        SliceMask = np.ones((m+2*tileRadius, n+2*tileRadius), dtype=np.bool)
+
+    tic = time.time()
+    Prob = None
+    shards = []
+    nBlocks = int(np.ceil(1.*nSlices/blockSize[0]) * np.ceil(1.*m/blockSize[1]) * np.ceil(1.*n/blockSize[2]))
+    blockId = 0
+
+    for z0 in range(0, nSlices, blockSize[0]):
+        z1 = min(z0 + blockSize[0], nSlices)
+        for a in range(0, m, blockSize[1]):
+            b = min(a + blockSize[1], m)
+            for c in range(0, n, blockSize[2]):
+                d = min(c + blockSize[2], n)
+                blockId += 1
+
+                Xb = emlib.read_block(V, slices[z0:z1], (a,b), (c,d), tileRadius) * scale
+                Mb = np.repeat(SliceMask[np.newaxis, a:b+2*tileRadius, c:d+2*tileRadius], z1-z0, axis=0)
+                P = predict(net, Xb, Mb, batchDim, nPrefetch=nPrefetch, sparse=sparse)
+
+                if sparse is not None:
+                    # block -> volume coordinates
+                    sl, row, col = np.unravel_index(P.index, P.shape[1:])
+                    index = np.ravel_multi_index((sl+z0, row+a, col+c), (nSlices, m, n))
+                    shards.append((index, P.values))
+                else:
+                    if Prob is None:
+                        Prob = emlib.create_prob_volume((P.shape[0], nSlices, m, n), outFile)
+                    Prob[:, z0:z1, a:b, c:d] = P
+
+                print('[emCNN]: finished block %d (of %d); %0.2f min elapsed' % (blockId, nBlocks, (time.time()-tic)/60.))
+                sys.stdout.flush()
+
+    if sparse is not None:
+        index = np.concatenate([x[0] for x in shards])
+        values = np.concatenate([x[1] for x in shards], axis=1)
+        order = np.argsort(index)
+        shape = (values.shape[0], nSlices, m, n)
+        Prob = emlib.SparseProbVolume(shape, index[order].astype(emlib._index_type(nSlices*m*n)), values[:, order])
+        if outFile: emlib.save_sparse_prob(outFile, Prob)
+    elif outFile:
+        Prob.flush()
+    return Prob
+
+
+
+def _data_scale(V, slices=None):
+    """The multiplier that maps the data to [0,1].  The maximum is found
+    a slice at a time, so V may also be a volume that is read on demand
+    (see emlib.open_cube()).  Both _load_data() and blockwise deployment 
+    use this, so that they see the same data.
+    """
+    # *** ASSUMPTION *** original data is in [0 255]
+    if slices is None:
+        slices = range(V.shape[0])
+    xMax = max([np.max(V[[ii], :, :]) for ii in slices])
+    return 1/255. if xMax > 1 else 1.
+
+
+
+def _sobol_mask(m, n, pct):
+    """A boolean (m x n) mask with (approximately) pct of the pixels
+    set, chosen using a Sobol sequence.
+    """
+    Mask = np.zeros((m,n), dtype=np.bool)
+    nToEval = np.round(pct*m*n).astype(np.int32)
+    idx = sobol(2, nToEval ,0)
+    idx[0] = np.floor(m*idx[0])
+    idx[1] = np.floor(n*idx[1])
+    idx = idx.astype(np.int32)
+    Mask[idx[0], idx[1]] = True
+    return Mask
+
+
+
+def _predict_worker(make_net, X, Mask, batchDim, nPrefetch, sparse, tmpDir, taskQ, resultQ):
+    """Worker process for predict_parallel().  Evaluates ranges of slices
+    until it receives None.  Results are handed back via files in tmpDir.
+    """
+    try:
+        net = make_net()
+        while True:
+            task = taskQ.get()
+            if task is None: 
+                break
+            a, b = task
+            P = predict(net, X[a:b,...], Mask[a:b,...], batchDim, nPrefetch=nPrefetch, sparse=sparse)
+            if sparse is not None:
+                fn = os.path.join(tmpDir, 'shard_%06d.npz' % a)
+                emlib.save_sparse_prob(fn, P)
+            else:
+                fn = os.path.join(tmpDir, 'shard_%06d.npy' % a)
+                np.save(fn, P)
+            resultQ.put(('done', a, b, fn))
+    except:
+        resultQ.put(('error', traceback.format_exc()))
+
+
+
+def predict_parallel(make_net, X, Mask, batchDim, nWorkers, nPrefetch=0, outFile=None, sparse=None):
+    """Like predict(), but shards the volume across nWorkers processes.
+
+    Each worker calls make_net() to create its own network and then 
+    evaluates disjoint ranges of slices (one slice at a time, so that the
+    load is balanced when some slices have more pixels in Mask than 
+    others).  X and Mask are shared with the workers (read-only, via fork)
+    and the coordinator (this process) merges the workers' results into
+    the output as they become available.
+
+    The return value is as for predict().
+    """
+    nSlices = X.shape[0]
+    tileRadius = border_size(batchDim)
+    tmpDir = tempfile.mkdtemp()
+
+    taskQ = mp.Queue()
+    resultQ = mp.Queue()
+    for ii in range(nSlices):
+        taskQ.put((ii, ii+1))
+    for ii in range(nWorkers):
+        taskQ.put(None)
+
+    workers = [mp.Process(target=_predict_worker, 
+                          args=(make_net, X, Mask, batchDim, nPrefetch, sparse, tmpDir, taskQ, resultQ))
+               for ii in range(nWorkers)]
+
+    tic = time.time()
+    Prob = None
+    shards = {}
+    try:
+        # Note: the workers are not daemons because predict() may start 
+        # a (prefetching) process of its own; they are joined (or 
+        # terminated) below instead.
+        for w in workers:
+            w.start()
+
+        nDone = 0
+        while nDone < nSlices:
+            try:
+                msg = resultQ.get(timeout=10)
+            except Queue.Empty:
+                if not any([w.is_alive() for w in workers]):
+                    raise RuntimeError('deploy workers exited unexpectedly')
+                continue
+
+            if msg[0] == 'error':
+                raise RuntimeError('deploy worker failed:\n%s' % msg[1])
+            _, a, b, fn = msg
+            nDone += b - a
+
+            if sparse is not None:
+                shards[a] = emlib.load_sparse_prob(fn)
+            else:
+                P = np.load(fn)
+                if Prob is None:
+                    shape = (P.shape[0], nSlices) + P.shape[2:]
+                    Prob = emlib.create_prob_volume(shape, outFile)
+                Prob[:, a:b, ...] = P
+            os.remove(fn)
+            print('[emCNN]: %d of %d slices complete (%0.2f min)' % (nDone, nSlices, (time.time()-tic)/60.))
+            sys.stdout.flush()
+
+        for w in workers:
+            w.join()
+    finally:
+        for w in workers:
+            if w.is_alive(): w.terminate()
+        shutil.rmtree(tmpDir)
+
+    if sparse is not None:
+        # shards hold consecutive slices, so their (sorted) indices
+        # can be offset and concatenated
+        starts = sorted(shards.keys())
+        shape = (shards[starts[0]].shape[0], nSlices) + shards[starts[0]].shape[2:]
+        sliceSize = shape[2] * shape[3]
+        index = np.concatenate([shards[a].index.astype(np.int64) + a*sliceSize for a in starts])
+        values = np.concatenate([shards[a].values for a in starts], axis=1)
+        Prob = emlib.SparseProbVolume(shape, index.astype(emlib._index_type(nSlices*sliceSize)), values)
+        if outFile: emlib.save_sparse_prob(outFile, Prob)
+    elif outFile:
+        Prob.flush()
+
+    print('[emCNN]: evaluated %d slices with %d workers in %0.2f min' % (nSlices, nWorkers, (time.time()-tic)/60.))
+    return Prob
+
+
+
+def predict_cached(net, X, Mask, batchDim, cacheFn, nPrefetch=3, outFile=None, sparse=None):
+    """Like predict(), but re-uses the estimates stored in cacheFn.
+
+    The cache is a sparse estimates file (see emlib.save_sparse_prob())
+    containing every pixel evaluated so far; only pixels in Mask that are
+    not already in the cache are evaluated by the CNN.  The new estimates
+    are then merged into the cache.  It is the caller's responsibility to
+    make sure cacheFn is specific to the model, network and volume
+    (e.g. by using emlib.content_hash()).
+
+    The return value is as for predict(), i.e. only estimates for pixels 
+    in Mask are returned.
+    """
+    tileRadius = border_size(batchDim)
+    MaskI = prune_border_3d(Mask, tileRadius)
+
+    Cache = None
+    Todo = MaskI.copy()
+    if os.path.exists(cacheFn):
+        Cache = emlib.load_sparse_prob(cacheFn)
+        if Cache.shape[1:] != MaskI.shape:
+            raise RuntimeError('cache "%s" does not match the volume dimensions' % cacheFn)
+        Todo.flat[Cache.index] = False
+    print('[emCNN]: %d of %d pixels are already in the cache' % (np.sum(MaskI) - np.sum(Todo), np.sum(MaskI)))
+
+    if np.any(Todo):
+        MaskNew = np.zeros(Mask.shape, dtype=np.bool)
+        prune_border_3d(MaskNew, tileRadius)[...] = Todo
+        New = predict(net, X, MaskNew, batchDim, nPrefetch=nPrefetch, sparse=np.float32)
+        Cache = New if Cache is None else Cache.merge(New)
+
+        # write to a temporary file first so an interrupted run
+        # does not corrupt the cache
+        tmpFn = cacheFn[:-len('.npz')] + '.tmp.npz'
+        emlib.save_sparse_prob(tmpFn, Cache)
+        os.rename(tmpFn, cacheFn)
+
+    return _sparse_result(Cache.restrict(MaskI), outFile, sparse)
+
+
+
+def predict_adaptive(net, X, Mask, batchDim, nRounds, budgetPct, tol=0, 
+                     nPrefetch=3, outFile=None, sparse=None, cacheFn=None):
+    """Coarse-to-fine version of predict().
+
+    The pixels in Mask are evaluated first.  Then, for each of nRounds
+    refinement rounds, part of the remaining per-slice budget is spent on 
+    the pixels whose estimates are most uncertain (see emlib.refinement_mask()).
+
+      budgetPct : the total fraction of pixels to evaluate in each slice 
+                  (including those in Mask).
+      tol       : a slice is considered done once no unevaluated pixel
+                  has an uncertainty score above this value.
+      cacheFn   : (optional) if provided, estimates are computed via
+                  predict_cached().
+
+    The return value is as for predict().
+    """
+    tileRadius = border_size(batchDim)
+    MaskI = prune_border_3d(Mask, tileRadius)
+    nSlices, m, n = MaskI.shape
+    nBudget = int(round(budgetPct*m*n))
+
+    def evaluate(M):
+        if cacheFn:
+            return predict_cached(net, X, M, batchDim, cacheFn, nPrefetch=nPrefetch, sparse=np.float32)
+        else:
+            return predict(net, X, M, batchDim, nPrefetch=nPrefetch, sparse=np.float32)
+
+    Prob = evaluate(Mask)
+
+    for rr in range(nRounds):
+        MaskNew = np.zeros(Mask.shape, dtype=np.bool)
+        MaskNewI = prune_border_3d(MaskNew, tileRadius)
+        for ii in range(nSlices):
+            P = Prob.get_slice(ii)
+            nUsed = np.sum(P[0,...] >= 0)
+            nNew = int(np.ceil((nBudget - nUsed) / float(nRounds - rr)))
+            if nNew > 0:
+                MaskNewI[ii,...] = emlib.refinement_mask(P, nNew, tol)
+
+        nNew = np.sum(MaskNewI)
+        print('[emCNN]: refinement round %d (of %d): evaluating %d new pixels' % (rr+1, nRounds, nNew))
+        if nNew == 0:
+            break
+        Prob = Prob.merge(evaluate(MaskNew))
+
+    print('[emCNN]: evaluated %0.2f%% of the cube' % (100. * Prob.index.size / MaskI.size))
+    return _sparse_result(Prob, outFile, sparse)
+
+
+
+def _sparse_result(Prob, outFile, sparse):
+    """Converts a SparseProbVolume to the output format requested
+    (and saves it, if outFile is provided).
+    """
+    if sparse is not None:
+        Prob.values = Prob.values.astype(sparse)
+        if outFile: emlib.save_sparse_prob(outFile, Prob)
+    else:
+        Prob = Prob.todense(outFile=outFile)
+        if outFile: Prob.flush()
+    return Prob
+
+
+
+def predict_dense(net, netParam, X, batchDim, denseNetFn, nCheck=0, outFile=None, approximate=False):
+    """Generates predictions for every pixel in a data volume using a
+    fully convolutional version of the network (see ShiftAndStitchNet).
+
+    PARAMETERS:
+      net        : the (tile-based) caffe.Net with trained weights
+      netParam   : the caffe_pb2.NetParameter for net
+      X          : a data volume/tensor with dimensions (#slices, height, width)
+      batchDim   : a tuple of the form (#classes, minibatchSize, height, width)
+      denseNetFn : where to write the fully convolutional network prototxt
+      nCheck     : if positive, this many randomly chosen pixels in the first
+                   slice are also evaluated using predict() and the largest
+                   discrepancy is reported.
+      outFile    : (optional) a .npy file to stream the estimates to
+      approximate : for networks whose dense estimates are not identical to
+                   the tile-based ones (e.g. pooling windows that are clipped
+                   at the tile boundary; see pycaffe2.dense_geometry()) this 
+                   must be True, else a ValueError is raised.  The check 
+                   above is then always run (on at least 1000 pixels).
+
+    Returns a Prob tensor with the same format as predict().
+    """
+    tileRadius = int(batchDim[2]/2)
+    warnings = dense_geometry(layer_specs(netParam), batchDim[2])['warnings']
+    if warnings and not approximate:
+        raise ValueError('dense estimates would differ from the tile-based ones (%s); pass approximate=True (--dense-approx 1) to proceed anyway' % '; '.join(warnings))
+    if warnings:
+        nCheck = max(nCheck, 1000)
+    nClasses = net.blobs['prob'].data.shape[1]
+    dnet = ShiftAndStitchNet(net, netParam, batchDim[2], X.shape[1:], denseNetFn)
+
+    Prob = emlib.create_prob_volume((nClasses, X.shape[0], X.shape[1]-2*tileRadius, X.shape[2]-2*tileRadius), outFile)
+    startTime = time.time()
+
+    for ii in range(X.shape[0]):
+        Prob[:, ii, ...] = dnet.predict_slice(X[ii,...])
+        if outFile:
+            Prob.flush()
+
+        elapsed = (time.time() - startTime) / 60.0
+        print('[emCNN]: elapsed=%0.2f min; finished slice %d (of %d)' % (elapsed, ii+1, X.shape[0]))
+        sys.stdout.flush()
+
+    if nCheck > 0: 
+        Mask = np.zeros(X.shape, dtype=np.bool)
+        Mask[0, 
+             np.random.randint(tileRadius, X.shape[1]-tileRadius, size=nCheck),
+             np.random.randint(tileRadius, X.shape[2]-tileRadius, size=nCheck)] = True
+        ProbTile = predict(net, X[0:1,...], Mask[0:1,...], batchDim, nPrefetch=0)
+        Mask = prune_border_3d(Mask[0:1,...], tileRadius)
+        err = np.abs(ProbTile[:, Mask] - Prob[:, 0:1, ...][:, Mask])
+        print('[emCNN]: dense vs tile-based estimates: max abs difference is %0.2e' % np.max(err))
+
     return Prob
 
 
@@ -696,45 +1529,116 @@ def _deploy_network(args):
     # Load data
     #----------------------------------------
     bs = border_size(batchDim)
-    print "[emCNN]: loading deploy data..."
-    Xdeploy = _load_data(args.emDeployFile,
-                         None,
-                         tileRadius=bs,
-                         onlySlices=args.deploySlices)
+    blockwise = len(args.blockSize) > 0
+    if blockwise:
+        if args.dense or args.refineRounds > 0 or args.cacheDir or args.nWorkers > 1 or args.nMC > 0:
+            print('[emCNN]: WARNING: --dense, --refine-rounds, --cache-dir, --workers and --n-monte-carlo are ignored with --block-size')
+        # the volume is read a block at a time by predict_blockwise()
+        Xdeploy = emlib.open_cube(args.emDeployFile)
+        deploySlices = args.deploySlices if args.deploySlices else range(Xdeploy.shape[0])
+        print('[emCNN]:    data shape: %s' % str(Xdeploy.shape))
+    else:
+        print "[emCNN]: loading deploy data..."
+        Xdeploy = _load_data(args.emDeployFile,
+                             None,
+                             tileRadius=bs,
+                             onlySlices=args.deploySlices)
     print "[emCNN]: tile radius is: %d" % bs
 
-    # Create a mask volume (vs list of labels to omit) due to API of emlib
+    # In refinement mode, only part of the budget is spent up front;
+    # the remainder goes to pixels chosen by predict_adaptive().
+    refine = (args.refineRounds > 0) and (args.evalPct < 1) and (not args.dense) and (args.nMC <= 0) and (not blockwise)
+    if args.refineRounds > 0 and not refine and not blockwise:
+        print('[emCNN]: WARNING: --refine-rounds requires --eval-pct < 1 and is ignored in dense and monte carlo modes')
+    initialPct = args.evalPct / (1. + args.refineRounds) if refine else args.evalPct
+
+    # Create a mask volume (vs list of labels to omit) due to API of emlib.
+    # The same pixels are evaluated in every slice.
+    m = Xdeploy.shape[-2] + (2*bs if blockwise else 0)
+    n = Xdeploy.shape[-1] + (2*bs if blockwise else 0)
     if args.evalPct < 1: 
-        Mask = np.zeros(Xdeploy.shape, dtype=np.bool)
-        m = Xdeploy.shape[-2]
-        n = Xdeploy.shape[-1]
-        nToEval = np.round(args.evalPct*m*n).astype(np.int32)
-        idx = sobol(2, nToEval ,0)
-        idx[0] = np.floor(m*idx[0])
-        idx[1] = np.floor(n*idx[1])
-        idx = idx.astype(np.int32)
-        Mask[:,idx[0], idx[1]] = True
-        pct = 100.*np.sum(Mask) / Mask.size
+        SliceMask = _sobol_mask(m, n, initialPct)
+        pct = 100.*np.sum(SliceMask) / SliceMask.size
         print("[emCNN]: subsampling volume...%0.2f%% remains" % pct)
     else:
-        Mask = np.ones(Xdeploy.shape, dtype=np.bool)
+        SliceMask = np.ones((m,n), dtype=np.bool)
+
+    if not blockwise:
+        Mask = np.zeros(Xdeploy.shape, dtype=np.bool)
+        Mask[...] = SliceMask
 
     #----------------------------------------
     # Do deployment & save results
     #----------------------------------------
     sys.stdout.flush()
 
-    if args.nMC < 0: 
-        Prob = predict(net, Xdeploy, Mask, batchDim)
+    # Estimates are streamed to disk as they are computed
+    # (the mirrored edges are never stored).
+    outFile = os.path.join(outDir, 'YhatDeploy.npy')
+    sparse = None
+    if args.sparse and args.dense:
+        print('[emCNN]: WARNING: --sparse is ignored in dense mode (every pixel is evaluated)')
+    elif args.sparse:
+        sparse = np.dtype(args.sparse)
+        outFile = os.path.join(outDir, 'YhatDeploy.sparse.npz')
+
+    cacheFn = None
+    if args.cacheDir and (args.dense or args.nMC > 0):
+        print('[emCNN]: WARNING: --cache-dir is ignored in dense and monte carlo modes')
+    elif args.cacheDir and not blockwise:
+        cacheKey = emlib.content_hash([args.model, netFn], [Xdeploy])
+        cacheFn = os.path.join(args.cacheDir, 'Yhat_%s.npz' % cacheKey)
+        print('[emCNN]: using prediction cache: %s' % cacheFn)
+        if not os.path.isdir(args.cacheDir):
+            os.makedirs(args.cacheDir)
+
+    parallel = (args.nWorkers > 1) and (args.gpu < 0) and (args.nMC <= 0)
+    if args.nWorkers > 1 and not parallel:
+        print('[emCNN]: WARNING: --workers is only supported in CPU mode (and not in monte carlo mode)')
+    elif parallel and (blockwise or args.dense or refine or cacheFn):
+        print('[emCNN]: WARNING: --workers is ignored with --block-size, --dense, --refine-rounds and --cache-dir')
+        parallel = False
+
+    if blockwise:
+        blockSize = [int(x) for x in args.blockSize.split(',')]
+        Prob = predict_blockwise(net, Xdeploy, batchDim, blockSize, 
+                                 slices=deploySlices, SliceMask=SliceMask,
+                                 scale=_data_scale(Xdeploy, deploySlices), 
+                                 nPrefetch=args.nPrefetch, outFile=outFile, sparse=sparse)
+    elif args.dense: 
+        if args.evalPct < 1 or args.nMC > 0:
+            print('[emCNN]: WARNING: --eval-pct and --n-monte-carlo are ignored in dense mode')
+        Prob = predict_dense(net, netParam, Xdeploy, batchDim, 
+                             os.path.join(outDir, 'dense_net.prototxt'),
+                             nCheck=args.denseCheck, outFile=outFile, approximate=args.denseApprox)
+    elif refine:
+        Prob = predict_adaptive(net, Xdeploy, Mask, batchDim, args.refineRounds, args.evalPct, 
+                                tol=args.refineTol, nPrefetch=args.nPrefetch, 
+                                outFile=outFile, sparse=sparse, cacheFn=cacheFn)
+    elif cacheFn:
+        Prob = predict_cached(net, Xdeploy, Mask, batchDim, cacheFn, nPrefetch=args.nPrefetch,
+                              outFile=outFile, sparse=sparse)
+    elif parallel:
+        make_net = lambda: caffe.Net(netFn, args.model, phaseTest)
+        Prob = predict_parallel(make_net, Xdeploy, Mask, batchDim, args.nWorkers, nPrefetch=args.nPrefetch,
+                                outFile=outFile, sparse=sparse)
     else:
-        Prob = predict(net, Xdeploy, Mask, batchDim, nMC=args.nMC)
-
-    # discard mirrored edges 
-    Prob = prune_border_4d(Prob, bs)
+        Prob = predict(net, Xdeploy, Mask, batchDim, nMC=max(args.nMC,0), nPrefetch=args.nPrefetch, 
+                       outFile=outFile, sparse=sparse)
 
     net.save(str(os.path.join(outDir, 'final.caffemodel')))
-    np.save(os.path.join(outDir, 'YhatDeploy'), Prob)
-    scipy.io.savemat(os.path.join(outDir, 'YhatDeploy.mat'), {'Yhat' : Prob})
+    if args.saveMat and sparse is not None:
+        emlib.save_sparse_prob(os.path.join(outDir, 'YhatDeploy.sparse.mat'), Prob)
+    elif args.saveMat:
+        scipy.io.savemat(os.path.join(outDir, 'YhatDeploy.mat'), {'Yhat' : np.asarray(Prob)})
+
+    if args.postproc and args.nMC > 0:
+        print('[emCNN]: WARNING: --postproc is ignored in monte carlo mode')
+    elif args.postproc:
+        print('[emCNN]: postprocessing estimates...')
+        sys.stdout.flush()
+        postproc.postproc_volume(Prob, outFile=os.path.join(outDir, 'YhatPostproc.npy'),
+                                 tiffFile=os.path.join(outDir, 'YhatPostproc.tif'))
 
     print('[emCNN]: deployment complete.')
 
@@ -750,19 +1654,14 @@ if __name__ == "__main__":
     from caffe.proto import caffe_pb2
     from google.protobuf import text_format
 
-    # specify CPU or GPU
-    if args.gpu >= 0:
-	caffe.set_mode_gpu()
-	caffe.set_device(args.gpu)
-    else:
-	caffe.set_mode_cpu()
-
     print(args)
 
     # train or deploy
+    # (training selects the CPU/GPU itself; see _train_network())
     if args.mode == 'train':
         _train_network(args)
     else:
+        _select_device(args)
         _deploy_network(args)
 
 
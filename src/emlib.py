@@ -6,19 +6,22 @@ __copyright__ = "Copyright 2014, JHU/APL"
 __license__ = "Apache 2.0"
 
 
-import os, sys, re
+import os, sys, re, time, random, traceback, ctypes, hashlib, glob, struct, zlib, Queue
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import pdb
 
 import numpy as np
 from PIL import Image
 
 from scipy.signal import convolve2d
-from scipy.io import loadmat
+from scipy.ndimage import distance_transform_edt, maximum_filter, minimum_filter
+from scipy.io import loadmat, savemat
 import h5py
 
 
 
-def load_cube(dataFile, dtype='float32'):
+def load_cube(dataFile, dtype='float32', slices=None):
     """ Loads a data volume.  This could be image data or class labels.
 
     Uses the file extension to determine the underlying data format.
@@ -27,11 +30,13 @@ def load_cube(dataFile, dtype='float32'):
 
     dataFile  := the full filename containing the data volume
     dtype     := data type that should be used to represent the data
+    slices    := (optional) a list of the slices to load.  Only these
+                 slices are read from disk (and converted to dtype).
     """
     
     # Raw TIFF data
     if dataFile.endswith('.tif') or dataFile.endswith('.tiff'):
-        return load_tiff_data(dataFile, dtype)
+        return load_tiff_data(dataFile, dtype, slices)
 
     # Matlab data 
     elif dataFile.endswith('.mat'):
@@ -41,52 +46,208 @@ def load_cube(dataFile, dtype='float32'):
         d = h5py.File(dataFile, 'r')
         if len(d.keys()) > 1:
             raise RuntimeError('mat file has more than one key - not yet supported!')
-        X = (d.values()[0])[:]
+        X = _read_slices(d.values()[0], slices)   # hyperslab read
         X = np.transpose(X, (0,2,1))
-        return X.astype(dtype)
+        return np.ascontiguousarray(X, dtype=dtype)
 
     # Numpy file 
     else:
         # assumpy numpy serialized object
-        return np.load(dataFile).astype(dtype)
+        X = _read_slices(np.load(dataFile, mmap_mode='r'), slices)
+        return np.ascontiguousarray(X, dtype=dtype)
+
+
+
+def _read_slices(V, slices):
+    """Returns V[slices,...] for a memory mapped array or hdf5 dataset V,
+    reading only the slices requested (in the order requested).
+    """
+    if slices is None:
+        return np.array(V)
+    slices = np.asarray(slices, dtype=np.int64)
+    u, inv = np.unique(slices, return_inverse=True)
+    X = V[list(u), ...]     # h5py requires an increasing list
+    if np.array_equal(u, slices):
+        return X
+    return X[inv, ...]
  
     
 
-def load_tiff_data(dataFile, dtype='float32'):
+class _MatCube(object):
+    """Read-only access to a volume in a matlab (7.3, i.e. hdf5) file
+    without loading it.  Indexing is as for the tensor returned by 
+    load_cube() (i.e. matlab's fortran ordering is accounted for).
+    """
+    def __init__(self, dataFile):
+        self._f = h5py.File(dataFile, 'r')
+        if len(self._f.keys()) > 1:
+            raise RuntimeError('mat file has more than one key - not yet supported!')
+        self._d = self._f.values()[0]
+        s, n, m = self._d.shape
+        self.shape = (s, m, n)
+        self.dtype = self._d.dtype
+
+    def __getitem__(self, key):
+        slices, rows, cols = key
+        if isinstance(slices, (list, np.ndarray)):
+            # h5py requires an increasing list; read each slice once and
+            # then restore the order requested (as in _read_slices())
+            slices = np.asarray(slices, dtype=np.int64)
+            u, inv = np.unique(slices, return_inverse=True)
+            X = np.transpose(self._d[list(u), cols, rows], (0,2,1))
+            return X if np.array_equal(u, slices) else X[inv, ...]
+        return np.transpose(self._d[slices, cols, rows], (0,2,1))
+
+
+
+def open_cube(dataFile):
+    """ Opens a data volume for reading a block at a time.
+
+    Unlike load_cube(), the data is not loaded (where the format allows
+    this) nor converted.  The return value supports indexing of the form
+    V[slices, rowStart:rowStop, colStart:colStop] and has shape and 
+    dtype attributes.  .npy files are memory mapped and hdf5 .mat files
+    are read on demand; .tif files are memory mapped via their decoded
+    sidecar (see load_tiff_data()) if possible, else loaded in full.
+    """
+    if dataFile.endswith('.tif') or dataFile.endswith('.tiff'):
+        sidecar = _tiff_sidecar(dataFile)
+        if sidecar:
+            return np.load(sidecar, mmap_mode='r')
+        return load_tiff_data(dataFile, None, cache=False)
+    elif dataFile.endswith('.mat'):
+        return _MatCube(dataFile)
+    else:
+        return np.load(dataFile, mmap_mode='r')
+
+
+
+def read_block(V, slices, rows, cols, nPixels, dtype=np.float32):
+    """ Reads V[slices, rows[0]:rows[1], cols[0]:cols[1]] along with a
+    border of nPixels around the last two dimensions.  
+
+    Where the border lies inside the volume it holds the neighboring 
+    data; where it extends past the edge of the volume it is created by
+    mirroring, exactly as mirror_edges() does for the whole volume.
+    This lets one process a volume (see open_cube()) a block at a time.
+    """
+    m, n = V.shape[1:]
+    a, b = rows
+    c, d = cols
+    a0, b0 = max(a-nPixels, 0), min(b+nPixels, m)
+    c0, d0 = max(c-nPixels, 0), min(d+nPixels, n)
+
+    X = np.asarray(V[slices, a0:b0, c0:d0]).astype(dtype)
+
+    pad = ((0,0), (a0-(a-nPixels), (b+nPixels)-b0), (c0-(c-nPixels), (d+nPixels)-d0))
+    if np.any(np.array(pad) > 0):
+        X = np.pad(X, pad, mode='symmetric')
+    return X
+
+
+
+def load_tiff_data(dataFile, dtype='float32', slices=None, cache=True, nThreads=None):
     """ Loads data from a multilayer .tif file.
 
     dataFile := the tiff file name
-    dtype    := data type to use for the returned tensor
+    dtype    := data type to use for the returned tensor (None := the
+                data type of the tiff file)
+    slices   := (optional) a list of the layers to load; other
+                layers are skipped (i.e. not decoded)
+    cache    := if True, the decoded volume is saved as a .npy "sidecar"
+                file next to the tiff (keyed by the tiff's size and 
+                modification time) and subsequent calls read the sidecar
+                instead of decoding the tiff again.
+    nThreads := number of threads used to decode pages (default is one per cpu)
     
     Returns result as a numpy tensor with dimensions (layers, width, height).
     """
     if not os.path.isfile(dataFile):
         raise RuntimeError('could not find file "%s"' % dataFile)
-    
-    # load the data from multi-layer TIF files
+
+    sidecar = _tiff_sidecar(dataFile, nThreads) if cache else None
+    if sidecar:
+        X = _read_slices(np.load(sidecar, mmap_mode='r'), slices)
+    else:
+        X = _decode_tiff(dataFile, slices, nThreads)
+
+    if dtype is None:
+        return X
+    return np.ascontiguousarray(X, dtype=dtype)
+
+
+
+def _decode_tiff(dataFile, pages=None, nThreads=None):
+    """Decodes (a subset of) the pages of a multilayer .tif file into a 
+    single preallocated tensor.  Pages are decoded in parallel; PIL 
+    releases the GIL while decoding.
+    """
     dataImg = Image.open(dataFile)
-    X = [];
-    for ii in xrange(sys.maxint):
-        Xi = np.array(dataImg, dtype=dtype)
-        Xi = np.reshape(Xi, (1, Xi.shape[0], Xi.shape[1]))  # add a slice dimension
-        X.append(Xi)
+    if pages is None:
+        pages = range(getattr(dataImg, 'n_frames', 1))
+    X0 = np.asarray(dataImg)
+    X = np.empty((len(pages),) + X0.shape, dtype=X0.dtype)
+
+    def decode(chunk):
+        img = Image.open(dataFile)   # PIL images are not thread safe
+        for jj, ii in chunk:
+            img.seek(ii)
+            Xi = np.asarray(img)
+            if Xi.shape != X0.shape or Xi.dtype != X0.dtype:
+                raise RuntimeError('page %d of "%s" has a different size or type than page 0' % (ii, dataFile))
+            X[jj,...] = Xi
+
+    if nThreads is None:
+        nThreads = mp.cpu_count()
+    nThreads = max(1, min(nThreads, len(pages)))
+    chunks = [list(c) for c in np.array_split(np.arange(len(pages)), nThreads)]
+    chunks = [[(jj, pages[jj]) for jj in c] for c in chunks]
+    if nThreads == 1:
+        decode(chunks[0])
+    else:
+        pool = ThreadPool(nThreads)
         try:
-            dataImg.seek(dataImg.tell()+1)
-        except EOFError:
-            break # this just means hit end of file (not really an error)
-
-    X = np.concatenate(X, axis=0)  # list -> tensor
+            pool.map(decode, chunks)
+        finally:
+            pool.close()
     return X
 
 
 
+def _tiff_sidecar(dataFile, nThreads=None):
+    """Returns the name of the decoded (.npy) copy of a .tif file, creating
+    it if needed.  The name includes the size and modification time of 
+    the .tif file, so a stale copy is never used.  Returns None if the
+    sidecar cannot be written (e.g. a read-only directory).
+    """
+    st = os.stat(dataFile)
+    sidecar = '%s.%d_%d.npy' % (dataFile, st.st_size, int(st.st_mtime))
+    if os.path.exists(sidecar):
+        return sidecar
+
+    X = _decode_tiff(dataFile, nThreads=nThreads)
+    tmpFile = sidecar[:-len('.npy')] + '.tmp%d.npy' % os.getpid()
+    try:
+        np.save(tmpFile, X)
+        os.rename(tmpFile, sidecar)
+    except (IOError, OSError) as e:
+        print('[emlib]: WARNING: could not cache "%s" (%s)' % (dataFile, e))
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+        return None
+
+    # remove copies of earlier versions of the file
+    for fn in glob.glob(dataFile + '.*_*.npy'):
+        if fn != sidecar and re.match(r'.*\.\d+_\d+\.npy$', fn):
+            os.remove(fn)
+    return sidecar
+
+
+
 def save_tiff_data(X, outDir, baseName='X_'):
-    """Unfortunately, it appears PIL can only load multi-page .tif files
-    (i.e. it cannot create them).  So the approach is to create them a
-    slice at a time, using this function, and then combine them after
-    the fact using convert, e.g.
+    """Saves each slice of X as a separate .tif file.
 
-    convert slice??.tif -define quantum:format=floating-point combinedF.tif
+    To create a single multi-page .tif file, use save_multipage_tiff()
+    (or TiffWriter) instead.
     """
     assert(len(X.shape) == 3)
     for ii in range(X.shape[0]):
@@ -96,6 +257,328 @@ def save_tiff_data(X, outDir, baseName='X_'):
 
 
 
+class TiffWriter(object):
+    """Writes a multi-page .tif file one page (slice) at a time, so 
+    volumes can be saved as they are produced (without holding the 
+    entire volume in memory).
+
+    Example:
+        with TiffWriter('Yhat.tif') as tw:
+            for ii in range(nSlices):
+                tw.write(Yhat_ii)
+
+    Parameters:
+      fileName    := the .tif file to create
+      bigtiff     := True to create a BigTIFF file (needed for files larger
+                     than 4GB).  By default, a BigTIFF file is created iff
+                     the (uncompressed) size given by shape and dtype
+                     exceeds 4GB (if shape is not known, a classic tiff
+                     is created and writing past 4GB is an error).
+      compression := None or 'deflate'
+    """
+    _SHORT, _LONG, _LONG8 = 3, 4, 16
+    _SAMPLE_FORMAT = {'u' : 1, 'i' : 2, 'f' : 3}
+
+    def __init__(self, fileName, shape=None, dtype=None, bigtiff=None, compression=None):
+        if compression not in (None, 'deflate'):
+            raise ValueError('unsupported compression "%s"' % compression)
+        if bigtiff is None:
+            bigtiff = (shape is not None) and (np.prod(shape) * np.dtype(dtype).itemsize > 2**32 - 2**25)
+        self.bigtiff = bool(bigtiff)
+        self.compression = compression
+        self.nPages = 0
+
+        self._f = open(fileName, 'wb')
+        if self.bigtiff:
+            self._f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+            self._nextPtr = 8      # where the offset of the next IFD goes
+        else:
+            self._f.write(struct.pack('<2sHI', b'II', 42, 0))
+            self._nextPtr = 4
+
+
+    def write(self, X):
+        """Appends a (height x width) page."""
+        X = np.ascontiguousarray(X)
+        if X.ndim != 2 or X.dtype.kind not in self._SAMPLE_FORMAT:
+            raise ValueError('pages must be 2d numeric arrays')
+        data = X.astype(X.dtype.newbyteorder('<'), copy=False).tobytes()
+        if self.compression == 'deflate':
+            data = zlib.compress(data, 6)
+
+        f = self._f
+        f.seek(0, 2)
+        dataOffset = f.tell()
+        f.write(data)
+        if f.tell() % 2: f.write(b'\0')    # IFDs start on a word boundary
+        ifdOffset = f.tell()
+        if not self.bigtiff and ifdOffset + 256 >= 2**32:
+            raise RuntimeError('tiff file exceeds 4GB; use bigtiff=True')
+
+        offsetType = self._LONG8 if self.bigtiff else self._LONG
+        entries = [(256, self._LONG, X.shape[1]),                        # width
+                   (257, self._LONG, X.shape[0]),                        # length
+                   (258, self._SHORT, 8*X.dtype.itemsize),               # bits per sample
+                   (259, self._SHORT, 8 if self.compression else 1),    # compression
+                   (262, self._SHORT, 1),                                # min is black
+                   (273, offsetType, dataOffset),                        # strip offsets
+                   (277, self._SHORT, 1),                                # samples per pixel
+                   (278, self._LONG, X.shape[0]),                        # rows per strip
+                   (279, offsetType, len(data)),                         # strip byte counts
+                   (284, self._SHORT, 1),                                # planar config
+                   (339, self._SHORT, self._SAMPLE_FORMAT[X.dtype.kind])]
+
+        if self.bigtiff:
+            ifd = [struct.pack('<Q', len(entries))]
+            fmt = {self._SHORT : '<HHQH6x', self._LONG : '<HHQI4x', self._LONG8 : '<HHQQ'}
+        else:
+            ifd = [struct.pack('<H', len(entries))]
+            fmt = {self._SHORT : '<HHIH2x', self._LONG : '<HHII'}
+        for tag, typ, value in entries:
+            ifd.append(struct.pack(fmt[typ], tag, typ, 1, value))
+        ifd.append(struct.pack('<Q' if self.bigtiff else '<I', 0))   # no next IFD (yet)
+        f.write(b''.join(ifd))
+
+        # link the previous IFD (or the header) to this one
+        f.seek(self._nextPtr)
+        f.write(struct.pack('<Q' if self.bigtiff else '<I', ifdOffset))
+        self._nextPtr = ifdOffset + (8 + 20*len(entries) if self.bigtiff else 2 + 12*len(entries))
+        self.nPages += 1
+
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def save_multipage_tiff(X, fileName, compression=None):
+    """Saves an (s x m x n) tensor as a multi-page .tif file (see TiffWriter)."""
+    with TiffWriter(fileName, X.shape, X.dtype, compression=compression) as tw:
+        for ii in range(X.shape[0]):
+            tw.write(X[ii,...])
+
+
+
+def create_prob_volume(shape, outFile=None, fill=-1):
+    """Allocates a float32 tensor for storing (per-class) probability estimates.
+
+    shape   := the tensor dimensions, usually (#classes, #slices, width, height)
+    outFile := (optional) a .npy file name.  If provided, the tensor is a
+               memory mapped view of this file (so the estimates can be
+               streamed to disk rather than held in memory).
+    fill    := initial value (by convention, -1 denotes "not evaluated")
+    """
+    if outFile:
+        P = np.lib.format.open_memmap(outFile, mode='w+', dtype=np.float32, shape=tuple(shape))
+    else:
+        P = np.empty(shape, dtype=np.float32)
+
+    # initialize a slice at a time so large volumes need not be resident
+    for ii in range(P.shape[1]):
+        P[:, ii, ...] = fill
+    return P
+
+
+
+def _index_type(n):
+    """Smallest unsigned integer type that can represent the values 0,...,n-1"""
+    return np.min_scalar_type(max(int(n)-1, 0))
+
+
+
+class SparseProbVolume(object):
+    """Probability estimates for a subset of the pixels in a volume.
+
+    This is an alternative to a dense (#classes, #slices, width, height)
+    tensor that is mostly filled with -1 (i.e. when only a fraction of the
+    pixels are evaluated).  Only the coordinates of the evaluated pixels
+    (as sorted linear indices into a (#slices, width, height) volume) and
+    their estimates are stored.
+
+    Estimates are assigned the same way one would assign to the dense
+    tensor, i.e.
+
+        P[:, slices, rows, cols] = values
+
+    where slices, rows and cols are integer index arrays (this is the form
+    used by emcnn.predict()).
+
+    Attributes:
+      shape  := the shape of the equivalent dense tensor
+      index  := sorted linear indices of the pixels
+      values := a (#classes, #pixels) array of estimates
+    """
+
+    def __init__(self, shape, index, values=None, dtype=np.float16):
+        self.shape = tuple([int(x) for x in shape])
+        self.index = np.asarray(index)
+        if values is None:
+            values = -1*np.ones((self.shape[0], self.index.size), dtype=dtype)
+        self.values = values
+        assert(self.values.shape == (self.shape[0], self.index.size))
+
+
+    @classmethod
+    def from_mask(cls, nClasses, Mask, dtype=np.float16):
+        """Creates an (empty) volume for the pixels where Mask is True."""
+        index = np.flatnonzero(Mask).astype(_index_type(Mask.size))
+        return cls((nClasses,) + Mask.shape, index, dtype=dtype)
+
+
+    def _position(self, slices, rows, cols):
+        lin = np.ravel_multi_index((slices, rows, cols), self.shape[1:])
+        pos = np.searchsorted(self.index, lin)
+        pos[pos >= self.index.size] = 0
+        if np.any(self.index[pos] != lin):
+            raise IndexError('pixel is not part of this sparse volume')
+        return pos
+
+
+    def __setitem__(self, key, value):
+        k, slices, rows, cols = key
+        self.values[k, self._position(slices, rows, cols)] = value
+
+
+    def restrict(self, Mask):
+        """Returns a new volume with only those pixels where Mask is True."""
+        keep = Mask.flat[self.index]
+        return SparseProbVolume(self.shape, self.index[keep], self.values[:, keep])
+
+
+    def merge(self, other):
+        """Returns a new volume containing the pixels of both volumes.
+        Where both volumes have an estimate, the one from other is used.
+        """
+        if self.shape != other.shape:
+            raise ValueError('cannot merge volumes with shapes %s and %s' % (self.shape, other.shape))
+        index = np.union1d(self.index, other.index).astype(_index_type(np.prod(self.shape[1:])))
+        P = SparseProbVolume(self.shape, index, dtype=np.result_type(self.values, other.values))
+        P.values[:, np.searchsorted(index, self.index)] = self.values
+        P.values[:, np.searchsorted(index, other.index)] = other.values
+        return P
+
+
+    def get_slice(self, ii, fill=-1):
+        """Returns the dense (#classes, height, width) estimates for slice ii."""
+        sliceSize = self.shape[2] * self.shape[3]
+        a, b = np.searchsorted(self.index, [ii*sliceSize, (ii+1)*sliceSize])
+        P = fill * np.ones((self.shape[0], sliceSize), dtype=np.float32)
+        P[:, self.index[a:b] - ii*sliceSize] = self.values[:, a:b]
+        return np.reshape(P, (self.shape[0],) + self.shape[2:])
+
+
+    def todense(self, fill=-1, outFile=None):
+        """Returns the equivalent dense tensor (see create_prob_volume())."""
+        P = create_prob_volume(self.shape, outFile, fill=fill)
+        for ii in range(self.shape[1]):
+            P[:, ii, ...] = self.get_slice(ii, fill)
+        return P
+
+
+
+def save_sparse_prob(fn, P):
+    """Saves a SparseProbVolume.
+
+    If fn ends with .mat, a matlab (v5) file is created with variables
+      shape  : dimensions of the dense tensor
+      slice, row, col : (zero-based) pixel coordinates
+      values : a (#pixels x #classes) matrix of estimates
+    (see Postproc/load_sparse_prob.m).  Otherwise fn is a numpy .npz file.
+    """
+    if fn.endswith('.mat'):
+        coordType = _index_type(max(P.shape[1:]))
+        sl, row, col = np.unravel_index(P.index, P.shape[1:])
+        savemat(fn, {'shape' : np.array(P.shape, dtype=np.float64),
+                     'slice' : sl.astype(coordType),
+                     'row' : row.astype(coordType),
+                     'col' : col.astype(coordType),
+                     'values' : P.values.T.astype(np.float32)})   # matlab has no float16
+    else:
+        np.savez(fn, shape=np.array(P.shape), index=P.index, values=P.values)
+
+
+
+def load_sparse_prob(fn):
+    """Loads a SparseProbVolume created by save_sparse_prob()."""
+    if fn.endswith('.mat'):
+        d = loadmat(fn)
+        shape = tuple(d['shape'].astype(np.int64).ravel())
+        index = np.ravel_multi_index((d['slice'].ravel(), d['row'].ravel(), d['col'].ravel()), shape[1:])
+        return SparseProbVolume(shape, index.astype(_index_type(np.prod(shape[1:]))), d['values'].T.copy())
+    else:
+        d = np.load(fn)
+        return SparseProbVolume(d['shape'], d['index'], d['values'])
+
+
+
+def refinement_mask(P, nNew, tol=0.0):
+    """Chooses which pixels in a slice to evaluate next, given partial 
+    estimates for that slice.
+
+      P    := a (#classes, height, width) tensor of estimates, where
+              unevaluated pixels are negative (see predict())
+      nNew := the (maximum) number of pixels to choose
+      tol  := pixels whose uncertainty is at most tol are not chosen
+
+    Unevaluated pixels are assigned the estimate of the nearest evaluated
+    pixel.  A pixel's uncertainty is the larger of (a) one minus the margin
+    between the two most likely classes and (b) the range of the estimates
+    in its 3x3 neighborhood (i.e. is it near a transition).  The score is
+    the uncertainty times the distance to the nearest evaluated pixel, so
+    that new pixels are spread out rather than clustered.
+
+    Returns a boolean (height, width) mask of the chosen pixels.
+    """
+    Evaluated = (P[0,...] >= 0)
+    New = np.zeros(Evaluated.shape, dtype=bool)
+    if nNew <= 0 or np.all(Evaluated) or not np.any(Evaluated):
+        return New
+
+    dist, (ri, ci) = distance_transform_edt(~Evaluated, return_indices=True)
+    Pnn = P[:, ri, ci]   # nearest neighbor interpolation
+
+    if Pnn.shape[0] > 1:
+        Ps = np.sort(Pnn, axis=0)
+        ambiguity = 1 - (Ps[-1,...] - Ps[-2,...])
+    else:
+        ambiguity = 1 - np.abs(2*Pnn[0,...] - 1)
+    variation = np.max([maximum_filter(Pk, size=3) - minimum_filter(Pk, size=3) for Pk in Pnn], axis=0)
+    uncertainty = np.maximum(ambiguity, variation)
+
+    score = uncertainty * dist
+    score[uncertainty <= tol] = 0
+    cand = np.flatnonzero(score > 0)
+    if cand.size > nNew:
+        cand = cand[np.argpartition(-score.flat[cand], nNew-1)[:nNew]]
+    New.flat[cand] = True
+    return New
+
+
+
+def content_hash(fileNames=[], arrays=[]):
+    """Returns a (hex) SHA-1 digest of the contents of the given files
+    and numpy arrays.  Useful e.g. for caching results that depend on 
+    a model, a network definition and a data volume.
+    """
+    h = hashlib.sha1()
+    for fn in fileNames:
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+    for X in arrays:
+        h.update(str(X.dtype) + str(X.shape))
+        for ii in range(X.shape[0]):      # one slice at a time
+            h.update(np.ascontiguousarray(X[ii,...]).data)
+    return h.hexdigest()
+
+
+
 def infer_data_dimensions(netFn):
     """Determine the size of the Caffe input data tensor.
 
@@ -156,23 +639,81 @@ def label_epsilon(Y, epsilon=3, n=9, targetClass=255, verbose=True):
     return (Yeps >= n)
 
 
+def _label_type(n):
+    """Smallest signed integer type that can represent the values -1,...,n-1"""
+    return np.min_scalar_type(-max(int(n), 1))
+
+
+
+def _small_uint(Y):
+    """True if Y holds unsigned integers that can be used to index a lookup table."""
+    return Y.dtype.kind in 'bu' and Y.dtype.itemsize <= 2
+
+
+
+def label_histogram(Y):
+    """Returns (yVals, counts), the (sorted) unique values in the label 
+    tensor Y and the number of times each occurs; computed in a single pass.
+    """
+    if _small_uint(Y):
+        counts = np.bincount(Y.ravel())
+        yVals = np.flatnonzero(counts).astype(Y.dtype)
+        return yVals, counts[yVals]
+    return np.unique(Y, return_counts=True)
+
+
+
+def remap_class_labels(Yin, omitLabels=[], labelOrder=None, hist=None):
+    """Remaps the native y values in Yin to class indices (contiguous
+    natural numbers starting at 0; see fix_class_labels()) in a single pass
+    over the data.  
+
+    Parameters:
+      Yin        := the label tensor
+      omitLabels := native labels to ignore (mapped to class -1)
+      labelOrder := (optional) the native labels, in the order they should 
+                    be numbered.  Default is sorted order.
+      hist       := (optional) label_histogram(Yin), if already available
+
+    Returns (Yout, yAll, counts, nOmitted) where:
+      Yout     := the remapped labels, stored in the smallest signed 
+                  integer type (e.g. int8) that can represent them
+      yAll     := yAll[k] is the native label mapped to class k
+      counts   := counts[k] is the number of pixels in class k
+      nOmitted := the number of pixels mapped to -1
+    """
+    yVals, cnt = label_histogram(Yin) if hist is None else hist
+    if labelOrder is None:
+        labelOrder = yVals
+    keep = [y for y in labelOrder if y in yVals and y not in omitLabels]
+    classIdx = -1 * np.ones(len(yVals), dtype=np.int64)
+    for k, y in enumerate(keep):
+        classIdx[np.flatnonzero(yVals == y)] = k
+
+    lut = classIdx.astype(_label_type(len(keep)))
+    if _small_uint(Yin):
+        full = -1 * np.ones(int(yVals[-1])+1 if len(yVals) else 1, dtype=lut.dtype)
+        full[yVals.astype(np.int64)] = lut
+        Yout = full[Yin]
+    else:
+        Yout = lut[np.searchsorted(yVals, Yin)]
+
+    counts = np.array([cnt[yVals == y][0] for y in keep], dtype=np.int64)
+    nOmitted = int(np.sum(cnt[classIdx < 0]))
+    return Yout, keep, counts, nOmitted
+
+
+
 def fix_class_labels(Yin, omitLabels):
     """Class labels must be contiguous natural numbers starting at 0.
     This is because they are mapped to indices at the output of the CNN.
     This function remaps the input y values if needed.
 
     Any pixels that should be ignored will have class label of -1.
+    See remap_class_labels() for details (e.g. the returned data type).
     """
     if Yin is None: return None
-
-    yAll = np.sort(np.unique(Yin))
-    yAll = [y for y in yAll if y not in omitLabels]
-
-    Yout = -1*np.ones(Yin.shape, dtype=Yin.dtype)
-    for yIdx, y in enumerate(yAll):
-        Yout[Yin==y] = yIdx
-
-    return Yout
+    return remap_class_labels(Yin, omitLabels)[0]
 
 
 
@@ -181,43 +722,329 @@ def mirror_edges(X, nPixels):
           s x (m+2*nPixels) x (n+2*nPixels)
     tensor with an "outer border" created by mirroring pixels along
     the outer border of X
+
+    See also MirroredVolume, which avoids creating this copy.
     """
     assert(nPixels > 0)
-    
-    s,m,n = X.shape
-    Xm = np.zeros((s, m+2*nPixels, n+2*nPixels), dtype=X.dtype)
-    
-    Xm[:, nPixels:m+nPixels, nPixels:n+nPixels] = X
+    return np.pad(X, ((0,0), (nPixels,nPixels), (nPixels,nPixels)), mode='symmetric')
+
+
+
+def _reflect(idx, m):
+    """Maps (possibly out of bounds) indices into [0, m) by mirroring
+    about the edges (as mirror_edges() does); assumes idx is in [-m, 2m).
+    """
+    idx = np.where(idx < 0, -idx-1, idx)
+    return np.where(idx >= m, 2*m-idx-1, idx)
+
+
+
+class MirroredVolume(object):
+    """A "virtual" version of mirror_edges(X, nPixels).
+
+    This behaves like the (s x m+2*nPixels x n+2*nPixels) tensor that
+    mirror_edges() would create, but only X is stored; indices that fall
+    in the mirrored border are reflected back into X when accessed.  It
+    supports extract_tiles() (tiles that touch the border are the only 
+    ones that pay for the reflection), integer array indexing (e.g. 
+    V[slices, rows, cols]) and basic slicing (which returns a view of X 
+    where the region lies in the interior, and a copy otherwise).
+    np.asarray(V) creates the real (mirrored) tensor.
+
+    If scale is provided, X is kept in its native (e.g. uint8) format
+    and values are converted to float32 and multiplied by scale only
+    when they are accessed (e.g. when a minibatch of tiles is gathered).
+    """
+
+    def __init__(self, X, nPixels, scale=None):
+        assert(nPixels > 0)
+        assert(nPixels <= min(X.shape[1:]))
+        self.X = X
+        self.nPixels = int(nPixels)
+        self.scale = scale
+        s, m, n = X.shape
+        self.shape = (s, m+2*self.nPixels, n+2*self.nPixels)
+        self.dtype = X.dtype if scale is None else np.dtype(np.float32)
+        self.ndim = 3
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def _scaled(self, A):
+        if self.scale is None:
+            return A
+        return A.astype(np.float32) * np.float32(self.scale)
+
+
+    def __array__(self, dtype=None):
+        Xm = self._scaled(mirror_edges(self.X, self.nPixels))
+        return Xm if dtype is None else Xm.astype(dtype)
+
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any([k is Ellipsis for k in key]):
+            ii = [k is Ellipsis for k in key].index(True)
+            key = key[:ii] + (slice(None),)*(4-len(key)) + key[ii+1:]
+        key = key + (slice(None),)*(3-len(key))
+        slices, rows, cols = key
+        m, n = self.X.shape[1:]
+        r = self.nPixels
+
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            rr = _reflect(np.arange(*rows.indices(self.shape[1])) - r, m)
+            cc = _reflect(np.arange(*cols.indices(self.shape[2])) - r, n)
+            if rr.size and cc.size and np.all(np.diff(rr) == 1) and np.all(np.diff(cc) == 1):
+                return self._scaled(self.X[slices, rr[0]:rr[-1]+1, cc[0]:cc[-1]+1])   # a view if not scaled
+            return self._scaled(self.X[slices][..., rr[:,np.newaxis], cc[np.newaxis,:]])
+        elif isinstance(rows, slice) or isinstance(cols, slice):
+            raise IndexError('MirroredVolume does not support mixing slices and index arrays')
+        else:
+            return self._scaled(self.X[slices, _reflect(np.asarray(rows) - r, m), _reflect(np.asarray(cols) - r, n)])
+
+
+    def extract_tiles(self, Idx, tileRadius, out=None):
+        """See extract_tiles()."""
+        tileRadius = int(tileRadius)
+        d = 2*tileRadius + 1
+        s, m, n = self.X.shape
+        r = self.nPixels
+
+        if np.any(Idx[:,1:] < tileRadius) or np.any(Idx[:,1] >= self.shape[1]-tileRadius) or np.any(Idx[:,2] >= self.shape[2]-tileRadius):
+            raise RuntimeError('tile extends beyond the edge of the data volume')
+        if out is None:
+            out = np.empty((Idx.shape[0], 1, d, d), dtype=self.dtype)
+
+        # upper left corner of each tile, in the coordinates of X
+        a = Idx[:,1] - tileRadius - r
+        c = Idx[:,2] - tileRadius - r
+        inside = (a >= 0) & (a+d <= m) & (c >= 0) & (c+d <= n)
+
+        if np.all(inside):
+            extract_tiles(self.X, Idx - [0, r, r], tileRadius, out=out)
+            return self._scale_tiles(out, Idx.shape[0])
+
+        if np.any(inside):
+            out[np.flatnonzero(inside), 0] = extract_tiles(self.X, Idx[inside] - [0, r, r], tileRadius)[:,0,...]
+
+        # tiles that (partially) lie in the mirrored border
+        b = np.flatnonzero(~inside)
+        rr = _reflect(a[b,np.newaxis] + np.arange(d), m)
+        cc = _reflect(c[b,np.newaxis] + np.arange(d), n)
+        if self.X.flags.c_contiguous:
+            # gathering via linear indices is faster than 3d fancy indexing
+            # (int64, as these overflow int32 for volumes > 2^31 voxels)
+            lin = (Idx[b,0].astype(np.int64)*m*n)[:,np.newaxis,np.newaxis] + (rr.astype(np.int64)*n)[:,:,np.newaxis] + cc[:,np.newaxis,:]
+            out[b, 0] = np.take(self.X.reshape(-1), lin)
+        else:
+            out[b, 0] = self.X[Idx[b,0][:,np.newaxis,np.newaxis], rr[:,:,np.newaxis], cc[:,np.newaxis,:]]
+        return self._scale_tiles(out, Idx.shape[0])
+
+
+    def _scale_tiles(self, out, n):
+        """Applies the scale (in place) to the first n tiles in out."""
+        if self.scale is not None:
+            out[:n] *= self.scale
+        return out
+
+
+
+def extract_tiles(X, Idx, tileRadius, out=None):
+    """Gathers the square tiles centered on a set of pixels.
+
+    This is a batched alternative to extracting tiles one at a time
+    in a python loop.  A strided "window view" of X is created (no data
+    is copied) and all tiles are then pulled out in a single numpy
+    (fancy indexing) operation.
+
+    Parameters:
+      X          := a (# slices x width x height) data tensor
+      Idx        := an (N x 3) array of (slice, row, column) indices;
+                    these are the centers of the tiles to extract.
+      tileRadius := tiles have dimensions (2*tileRadius+1, 2*tileRadius+1)
+      out        := (optional) a pre-allocated (batchSize, 1, h, w) tensor
+                    with batchSize >= N.  The tiles are written to
+                    out[:N,0,...]; any remaining entries are left as-is.
+
+    Returns out (or, if out is None, a newly allocated (N, 1, h, w) tensor).
+    """
+    if isinstance(X, MirroredVolume):
+        return X.extract_tiles(Idx, tileRadius, out)
+
+    tileRadius = int(tileRadius)
+    d = 2*tileRadius + 1
+    s, m, n = X.shape
+
+    if np.any(Idx[:,1:] < tileRadius) or np.any(Idx[:,1] >= m-tileRadius) or np.any(Idx[:,2] >= n-tileRadius):
+        raise RuntimeError('tile extends beyond the edge of the data volume')
 
-    # a helper function for dealing with corners
-    flip_corner = lambda X : np.fliplr(np.flipud(X))
+    # W[ii, a, c, :, :] is the tile whose upper left corner is X[ii, a, c]
+    W = np.lib.stride_tricks.as_strided(X,
+            shape=(s, m-d+1, n-d+1, d, d),
+            strides=(X.strides[0], X.strides[1], X.strides[2], X.strides[1], X.strides[2]))
 
-    for ii in range(s):
-        # top left corner
-        Xm[ii, 0:nPixels,0:nPixels] = flip_corner(X[ii, 0:nPixels,0:nPixels])
+    tiles = W[Idx[:,0], Idx[:,1]-tileRadius, Idx[:,2]-tileRadius]
 
-        # top right corner
-        Xm[ii, 0:nPixels,n+nPixels:] = flip_corner(X[ii, 0:nPixels,n-nPixels:])
+    if out is None:
+        return tiles[:, np.newaxis, :, :]
 
-        # bottom left corner
-        Xm[ii, m+nPixels:,0:nPixels] = flip_corner(X[ii, m-nPixels:,0:nPixels])
+    out[:Idx.shape[0], 0, :, :] = tiles
+    return out
 
-        # bottom right corner
-        Xm[ii, m+nPixels:,n+nPixels:] = flip_corner(X[ii, m-nPixels:,n-nPixels:])
 
-        # top border
-        Xm[ii, 0:nPixels, nPixels:n+nPixels] = np.flipud(X[ii, 0:nPixels,:])
 
-        # bottom border
-        Xm[ii, m+nPixels:, nPixels:n+nPixels] = np.flipud(X[ii, m-nPixels:,:])
+class StratifiedSampler(object):
+    """Draws pixel indices with the property that pixels of different
+    class labels are represented in equal proportions.
+
+    The (per-class) pools of candidate pixels are computed once, when the
+    sampler is created, and stored as int32 linear indices into the interior 
+    of Y (int64 for very large volumes).  Each call to epoch() then only 
+    reshuffles the pools (in place) to obtain a fresh balanced draw.
+
+    Parameters:
+      Y          := a (# slices x width x height) class label tensor
+
+      borderSize := Specifies a border width - all pixels in this exterior border
+                    will be excluded from the return value.
+                    
+      mask       := a boolean tensor the same size as Y where 0/false means omit
+                    the corresponding pixel
+    """
+
+    def __init__(self, Y, borderSize, mask=None, omitSlices=[], omitLabels=[]):
+        [s,m,n] = Y.shape
+        self.borderSize = borderSize
+
+        # Only the interior (which, for a MirroredVolume, is a view 
+        # of the original data) is considered.
+        interior = (slice(None), slice(borderSize, m-borderSize), slice(borderSize, n-borderSize))
+        Y = Y[interior]
+        if mask is not None:
+            mask = mask[interior]
+        self.shape = Y.shape
+        self.yAll = [y for y in np.unique(Y) if y not in omitLabels]
+        assert(len(self.yAll) > 0)
+
+        # The pools are built a slice at a time (to avoid creating 
+        # temporaries the size of the volume).
+        idxType = np.int32 if Y.size < 2**31 else np.int64
+        pools = [[] for y in self.yAll]
+        sliceSize = Y.shape[1] * Y.shape[2]
+        for ii in range(s):
+            if ii in omitSlices: continue
+            Yi = Y[ii,...]
+            for k, y in enumerate(self.yAll):
+                bits = (Yi == y) if mask is None else ((Yi == y) & mask[ii,...])
+                pools[k].append((np.flatnonzero(bits) + ii*sliceSize).astype(idxType))
+        self.pools = [np.concatenate(p) for p in pools]
+
+        # Determine how many instances of each class to report
+        # (the minimum over the total number)
+        cnt = [p.size for p in self.pools]
+        print('[emlib]: num. pixels per class label is: %s' % str(cnt))
+        self.nPerClass = min(cnt)
+        print('[emlib]: will draw %d samples from each class' % self.nPerClass)
+
+
+    def __len__(self):
+        """The number of pixels returned per epoch."""
+        return self.nPerClass * len(self.pools)
+
+
+    def epoch(self, batchSize, seed=None, skip=0):
+        """An iterator over (Idx, epochPct) for a single epoch, where Idx 
+        are the (# pixels x 3) indices of (at most) batchSize pixels.
+
+        The pools are shuffled when this is called (i.e. in the calling 
+        process, even if the iterator is consumed elsewhere).
+
+          seed := (optional) seed for the shuffles; given the same seed 
+                  (and the same pool state, see replay()) an epoch 
+                  produces the same sequence of pixels.
+          skip := number of batches to skip (e.g. when resuming an epoch)
+        """
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        cnt = self.nPerClass
+        Lin = np.empty((len(self),), dtype=self.pools[0].dtype)
+        for k, pool in enumerate(self.pools):
+            rng.shuffle(pool)   # note: modifies array in-place
+            Lin[k*cnt:(k+1)*cnt] = pool[:cnt]
+
+        # one last shuffle to mix all the classes together
+        rng.shuffle(Lin)
+        return self._batches(Lin, batchSize, skip)
+
+
+    def _batches(self, Lin, batchSize, skip):
+        # return in subsets of size batchSize
+        b = self.borderSize
+        for ii in range(skip*batchSize, Lin.size, batchSize):
+            Idx = np.column_stack(np.unravel_index(Lin[ii:(ii+batchSize)], self.shape)) + [0, b, b]
+            yield Idx, (1.0*ii)/Lin.size
+
+
+    def replay(self, seeds):
+        """Puts the pools in the state they would be in after epochs with
+        the given seeds (without generating those epochs).
+        """
+        for seed in seeds:
+            rng = np.random.RandomState(seed)
+            for pool in self.pools:
+                rng.shuffle(pool)
+
+
+
+def _rebatch(chunks, batchSize, total):
+    """Regroups an iterator over (# pixels x 3) index arrays into 
+    (Idx, epochPct) tuples where Idx has (at most) batchSize rows.
+    """
+    buf, nBuf, nDone = [], 0, 0
+    for C in chunks:
+        buf.append(C);  nBuf += C.shape[0]
+        if nBuf < batchSize: continue
+
+        B = np.concatenate(buf)
+        nFull = nBuf - nBuf % batchSize
+        for ii in range(0, nFull, batchSize):
+            yield B[ii:(ii+batchSize)], (1.0*nDone)/total
+            nDone += batchSize
+        buf, nBuf = [B[nFull:]], nBuf - nFull
 
-        # left border
-        Xm[ii, nPixels:m+nPixels,0:nPixels] = np.fliplr(X[ii, :,0:nPixels])
+    if nBuf > 0:
+        yield np.concatenate(buf), (1.0*nDone)/total
 
-        # right border
-        Xm[ii, nPixels:m+nPixels,n+nPixels:] = np.fliplr(X[ii, :,n-nPixels:])
 
-    return Xm
+
+def split_draw(counts, n, rng=np.random):
+    """Splits a draw (without replacement) of n items from a population 
+    made up of groups with the given counts, i.e. a multivariate 
+    hypergeometric sample.  Returns the number drawn from each group.
+    """
+    take = np.zeros((len(counts),), dtype=np.int64)
+    left = np.sum(counts)
+    for jj in range(len(counts)):
+        if n == 0: break
+        left -= counts[jj]
+        take[jj] = n if left == 0 else rng.hypergeometric(counts[jj], left, n) if counts[jj] > 0 else 0
+        n -= take[jj]
+    return take
+
+
+
+def _slice_indices(ii, bits, borderSize):
+    """The (int32) indices of the nonzero entries of bits, the interior
+    of slice ii.
+    """
+    rows, cols = np.nonzero(bits)
+    Idx = np.empty((rows.size, 3), dtype=np.int32)
+    Idx[:,0] = ii
+    Idx[:,1] = rows + borderSize
+    Idx[:,2] = cols + borderSize
+    return Idx
 
 
 
@@ -228,8 +1055,11 @@ def stratified_interior_pixel_generator(Y, borderSize, batchSize,
     """An iterator over pixel indices with the property that pixels of different
     class labels are represented in equal proportions.
 
-    Warning: this is fairly memory intensive (pre-computes the entire list of indices).
-    An alternative (an approxmation) might have been random sampling...
+    Pixels are generated lazily, one slice at a time, so memory is proportional
+    to the size of a slice (vs the volume).  The number of pixels drawn from each 
+    class is balanced over the whole volume, but pixels are only shuffled within
+    a slice (slices are visited in random order).  For a shuffle over the entire
+    volume (e.g. for training) use a StratifiedSampler.
 
     Parameters:
       Y          := a (# slices x width x height) class label tensor
@@ -243,44 +1073,35 @@ def stratified_interior_pixel_generator(Y, borderSize, batchSize,
                     the corresponding pixel
     """
     [s,m,n] = Y.shape
-    yAll = np.unique(Y)
-    yAll = [y for y in yAll if y not in omitLabels]
-    assert(len(yAll) > 0)
-
-    # Used to restrict the set of pixels under consideration.
-    bitMask = np.ones(Y.shape, dtype=bool)
-    bitMask[omitSlices,:,:] = 0
+    interior = (slice(borderSize, m-borderSize), slice(borderSize, n-borderSize))
+    slices = [ii for ii in range(s) if ii not in omitSlices]
 
-    bitMask[:, 0:borderSize, :] = 0
-    bitMask[:, (m-borderSize):m, :] = 0
-    bitMask[:, :, 0:borderSize] = 0
-    bitMask[:, :, (n-borderSize):n] = 0
+    def bits(ii, y):
+        Yi = Y[(ii,) + interior]
+        return (Yi == y) if mask is None else ((Yi == y) & mask[(ii,) + interior])
 
-    if mask is not None:
-        bitMask = bitMask & mask
+    yAll = np.unique(np.concatenate([np.unique(Y[(ii,) + interior]) for ii in slices]))
+    yAll = [y for y in yAll if y not in omitLabels]
+    assert(len(yAll) > 0)
 
     # Determine how many instances of each class to report
     # (the minimum over the total number)
-    cnt = [np.sum( (Y==y) & bitMask ) for y in yAll]
-    print('[emlib]: num. pixels per class label is: %s' % str(cnt))
-    cnt = min(cnt)
+    Cnt = np.array([[np.sum(bits(ii, y)) for y in yAll] for ii in slices], dtype=np.int64)
+    print('[emlib]: num. pixels per class label is: %s' % str(list(np.sum(Cnt, axis=0))))
+    cnt = np.min(np.sum(Cnt, axis=0))
     print('[emlib]: will draw %d samples from each class' % cnt)
 
-    # Stratified sampling
-    Idx = np.zeros((0,3), dtype=np.int32)  # three columns because there are 3 dimensions in the tensor
-    for y in yAll:
-        tup = np.nonzero( (Y==y) & bitMask )
-        Yi = np.column_stack(tup)
-        np.random.shuffle(Yi)
-        Idx = np.vstack((Idx, Yi[:cnt,:]))
+    # Split the samples of each class among the slices
+    Take = np.column_stack([split_draw(Cnt[:,k], cnt) for k in range(len(yAll))])
 
-    # one last shuffle to mix all the classes together
-    np.random.shuffle(Idx)   # note: modifies array in-place
+    def chunks():
+        for jj in np.random.permutation(len(slices)):
+            Idx = [_slice_indices(slices[jj], bits(slices[jj], y), borderSize) for y in yAll]
+            Idx = np.concatenate([I[np.random.permutation(I.shape[0])[:Take[jj,k]]] for k, I in enumerate(Idx)])
+            np.random.shuffle(Idx)
+            yield Idx
 
-    # return in subsets of size batchSize
-    for ii in range(0, Idx.shape[0], batchSize):
-        nRet = min(batchSize, Idx.shape[0] - ii)
-        yield Idx[ii:(ii+nRet)], (1.0*ii)/Idx.shape[0]
+    return _rebatch(chunks(), batchSize, cnt*len(yAll))
 
 
  
@@ -289,12 +1110,10 @@ def interior_pixel_generator(X, borderSize, batchSize,
                              omitSlices=[]):
     """An iterator over pixel indices in the interior of an image.
 
-    Warning: this is fairly memory intensive (pre-computes the entire list of indices).
+    Pixels are generated (in C order) lazily, one slice at a time, so memory
+    is proportional to the size of a slice (vs the volume).
 
-    Note: we could potentially speed up the process of extracting subtiles by
-    creating a more efficient implementation; however, some simple timing tests
-    indicate we are spending orders of magnitude more time in CNN operations so
-    there is no pressing need to optimize tile extraction at the moment.
+    See extract_tiles() for mapping the returned indices to tiles.
 
     Parameters:
       X          := a (# slices x width x height) image tensor
@@ -308,25 +1127,339 @@ def interior_pixel_generator(X, borderSize, batchSize,
                     the corresponding pixel
     """
     [s,m,n] = X.shape
-        
-    # Used to restrict the set of pixels under consideration.
-    bitMask = np.ones(X.shape, dtype=bool)
-    bitMask[omitSlices,:,:] = 0
-
-    bitMask[:, 0:borderSize, :] = 0
-    bitMask[:, (m-borderSize):m, :] = 0
-    bitMask[:, :, 0:borderSize] = 0
-    bitMask[:, :, (n-borderSize):n] = 0
-    
-    if mask is not None:
-        bitMask = bitMask & mask
+    interior = (slice(borderSize, m-borderSize), slice(borderSize, n-borderSize))
+    slices = [ii for ii in range(s) if ii not in omitSlices]
+
+    if mask is None:
+        bits = lambda ii: np.ones((m-2*borderSize, n-2*borderSize), dtype=bool)
+        total = len(slices) * (m-2*borderSize) * (n-2*borderSize)
+    else:
+        bits = lambda ii: mask[(ii,) + interior]
+        total = sum([np.count_nonzero(bits(ii)) for ii in slices])
+
+    chunks = (_slice_indices(ii, bits(ii), borderSize) for ii in slices)
+    return _rebatch(chunks, batchSize, total)
+
+
+
+def _assemble_minibatch(X, Y, Idx, Xi, yi, data_augment, rng=None):
+    """Fills the minibatch buffers (Xi, yi) with the tiles and labels
+    associated with the pixel indices Idx.  
+
+    data_augment (if any) is called as data_augment(Xi, rng), where rng 
+    is the np.random.RandomState for this minibatch.
+    """
+    tileRadius = int(Xi.shape[2]/2)
+    extract_tiles(X, Idx, tileRadius, out=Xi)
+    if Y is not None:
+        yi[:Idx.shape[0]] = Y[ Idx[:,0], Idx[:,1], Idx[:,2] ]
+
+    # label-preserving data transformation (synthetic data generation)
+    if data_augment is not None:
+        Xi[...] = data_augment(Xi, rng)
+
+    if np.any(np.isnan(Xi)) or np.any(np.isnan(yi)):
+        raise RuntimeError('NaN detected in minibatch')
+
+
+
+def _batch_rng(seed, b):
+    """The random number generator for minibatch b; it depends only
+    on (seed, b), not on which process assembles the minibatch.
+    """
+    return np.random.RandomState([seed, b])
+
+
+
+def _prefetch_worker(X, Y, buffers, data_augment, taskQ, fullQ, seed):
+    """Producer half of MinibatchPrefetcher (runs in a child process;
+    there may be several of these).
+    """
+    # The child starts with a copy of the parent's RNG state; reseed so
+    # that successive epochs (and sibling workers) do not replay the same 
+    # random draws.  Augmentation itself uses the per-minibatch RNG.
+    np.random.seed(seed)
+    random.seed(seed)
+
+    while True:
+        task = taskQ.get()
+        if task is None:
+            break
+        b, k, Idx, batchSeed = task
+        try:
+            _assemble_minibatch(X, Y, Idx, buffers[k][0], buffers[k][1], 
+                                data_augment, _batch_rng(batchSeed, b))
+            fullQ.put(('batch', b))
+        except Exception:
+            fullQ.put(('error', traceback.format_exc()))
+
+
+
+class MinibatchPrefetcher(object):
+    """Assembles minibatches in background processes so that the data-side
+    work (tile extraction, augmentation, NaN checks) for upcoming batches
+    overlaps with the CNN's processing of the current one.
+
+    The producers write into a ring of pre-allocated float32 buffers that 
+    live in shared memory: minibatch b goes into slot (b % nBuffers), and 
+    the consumer hands a slot back once it asks for the next minibatch.  
+    Hence, a buffer yielded by this object is only valid until the next 
+    iteration.  With nWorkers > 1, several minibatches are assembled 
+    concurrently; they are still yielded in order.  The pixel indices 
+    themselves are drawn (from it) in the consumer's process.
+
+    Each minibatch is augmented with its own RNG, seeded by (seed, b), so
+    the results are reproducible (for a given seed) regardless of the 
+    number of workers, or whether prefetching is used at all.
+
+    Note: if Idx.shape[0] < batchDim[0] (last iteration of an epoch) the
+    trailing entries of Xi/yi contain examples from whichever minibatch last
+    used the buffer.  This is intentional (to keep batch sizes consistent
+    even if data set size is not a multiple of the minibatch size).
+
+    Example:
+
+       prefetcher = MinibatchPrefetcher(it, X, Y, batchDim)
+       for Xi, yi, Idx, epochPct in prefetcher:
+           ...
+       print(prefetcher.waitTime)
+
+    Parameters:
+      it           := an iterator over (Idx, epochPct) tuples, e.g. from
+                      interior_pixel_generator()
+      X            := a (# slices x width x height) data tensor
+      Y            := a labels tensor with the same size as X (or None, in
+                      which case the labels are all 0)
+      batchDim     := the tuple (minibatchSize, #channels, height, width)
+      data_augment := (optional) synthetic data augmentation function 
+                      f(Xi, rng) -> Xi'
+      nBuffers     := size of the buffer ring; 0 disables the background
+                      processes (minibatches are assembled inline).  At 
+                      least nWorkers+1 buffers are used.
+      nWorkers     := number of background processes
+      seed         := (optional) seed for the per-minibatch RNGs 
+                      (default: drawn from np.random)
+      firstBatch   := index of the first minibatch (e.g. when resuming 
+                      part way through an epoch); used for the RNG seeds
+    """
+
+    def __init__(self, it, X, Y, batchDim, data_augment=None, nBuffers=3, 
+                 nWorkers=1, seed=None, firstBatch=0):
+        self._it = it
+        self._X = X
+        self._Y = Y
+        self._batchDim = tuple([int(x) for x in batchDim])
+        self._augment = data_augment
+        self._nWorkers = max(int(nWorkers), 1)
+        self._nBuffers = max(nBuffers, self._nWorkers+1) if nBuffers > 0 else 0
+        self._seed = np.random.randint(0, 2**31-1) if seed is None else int(seed)
+        self._firstBatch = firstBatch
+
+        self.waitTime = 0.0   # := time consumer spent blocked on the producers
+        self.nBatches = 0     # := number of minibatches consumed
+
+
+    def _alloc(self):
+        """Allocates a (C-contiguous, float32) minibatch in shared memory.
+        """
+        n = int(np.prod(self._batchDim))
+        Xi = np.frombuffer(mp.RawArray(ctypes.c_float, n), dtype=np.float32)
+        yi = np.frombuffer(mp.RawArray(ctypes.c_float, self._batchDim[0]), dtype=np.float32)
+        return Xi.reshape(self._batchDim), yi
+
+
+    def __iter__(self):
+        if self._nBuffers <= 0:
+            return self._iter_inline()
+        return self._iter_prefetch()
+
+
+    def _iter_inline(self):
+        Xi, yi = self._alloc()
+        it = iter(self._it)
+        b = self._firstBatch
+        while True:
+            tic = time.time()
+            try:
+                Idx, epochPct = next(it)
+            except StopIteration:
+                break
+            _assemble_minibatch(self._X, self._Y, Idx, Xi, yi, self._augment, _batch_rng(self._seed, b))
+            self.waitTime += time.time() - tic
+            yield Xi, yi, Idx, epochPct
+            self.nBatches += 1
+            b += 1
+
+
+    def _iter_prefetch(self):
+        buffers = [self._alloc() for ii in range(self._nBuffers)]
+        taskQ = mp.Queue()
+        fullQ = mp.Queue()
+
+        # The workers' seeds derive from self._seed (rather than the global 
+        # RNG, whose state is part of a training checkpoint).
+        seeds = np.random.RandomState(self._seed).randint(0, 2**31-1, size=self._nWorkers)
+        procs = []
+        for seed in seeds:
+            p = mp.Process(target=_prefetch_worker,
+                           args=(self._X, self._Y, buffers, self._augment, taskQ, fullQ, seed))
+            p.daemon = True
+            p.start()
+            procs.append(p)
+
+        it = iter(self._it)
+        pending = {}    # := minibatch index -> (Idx, epochPct), for dispatched minibatches
+        ready = set()   # := minibatches that have been assembled
+        nextBatch = [self._firstBatch]
+
+        def dispatch():
+            """Hands the next minibatch (if any) to the workers."""
+            try:
+                Idx, epochPct = next(it)
+            except StopIteration:
+                return
+            b = nextBatch[0]
+            nextBatch[0] += 1
+            pending[b] = (Idx, epochPct)
+            taskQ.put((b, b % self._nBuffers, Idx, self._seed))
+
+        try:
+            for ii in range(self._nBuffers):
+                dispatch()
+
+            b = self._firstBatch
+            while b in pending:
+                tic = time.time()
+                while b not in ready:
+                    try:
+                        msg = fullQ.get(timeout=1)
+                    except Queue.Empty:
+                        # a producer that dies (e.g. is killed) posts no message
+                        if not all([p.is_alive() for p in procs]):
+                            raise RuntimeError('minibatch producer exited unexpectedly')
+                        continue
+                    if msg[0] == 'error':
+                        raise RuntimeError('minibatch producer failed:\n%s' % msg[1])
+                    ready.add(msg[1])
+                self.waitTime += time.time() - tic
+
+                Idx, epochPct = pending.pop(b)
+                ready.remove(b)
+                k = b % self._nBuffers
+                yield buffers[k][0], buffers[k][1], Idx, epochPct
+                self.nBatches += 1
+                dispatch()   # reuses slot k
+                b += 1
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+
+
+
+class MetricsAccumulator(object):
+    """Streaming classification metrics.
+
+    Predictions are added one batch (or slice) at a time via update(); 
+    each update is a single bincount into a confusion matrix (and, 
+    optionally, into histograms of the class 1 probability estimates 
+    for binary problems, from which ROC and precision-recall curves 
+    are computed; see Matlab's perfcurve() and tests/test_perfcurve2.m).
+    Hence the full volume of estimates never needs to be in memory.
+
+    o Assumes any class label <0 should be ignored in the analysis.
+    o Assumes all non-negative class labels are contiguous and start at 0.
+      (so for binary classification, the class labels are {0,1})
+    """
+
+    def __init__(self, nBins=1000):
+        self.C = np.zeros((0,0), dtype=np.int64)    # confusion matrix
+        self.support = np.zeros((0,), dtype=np.int64) # num. pixels per true class
+        self.nBins = nBins
+        self.H = np.zeros((2, nBins), dtype=np.int64)  # histograms of P for y=0, y=1
+
+
+    def update(self, Y, Yhat, P=None):
+        """Y    := true class labels
+           Yhat := estimated class labels (same size as Y)
+           P    := (optional) estimated probability of class 1 (same size as Y)
+        """
+        Y = np.asarray(Y).ravel()
+        valid = (Y >= 0)
+        y = Y[valid].astype(np.int64)
+        yhat = np.asarray(Yhat).ravel()[valid].astype(np.int64)
+        ok = (yhat >= 0)
+
+        k = max(len(self.support), 
+                int(np.max(y))+1 if y.size else 0, 
+                int(np.max(yhat[ok]))+1 if np.any(ok) else 0)
+        if k > len(self.support):
+            C = np.zeros((k,k), dtype=np.int64)
+            C[:self.C.shape[0], :self.C.shape[1]] = self.C
+            self.C = C
+            self.support = np.concatenate((self.support, np.zeros((k-len(self.support),), dtype=np.int64)))
+
+        self.support += np.bincount(y, minlength=k)
+        self.C += np.bincount(y[ok]*k + yhat[ok], minlength=k*k).reshape((k,k))
 
-    Idx = np.column_stack(np.nonzero(bitMask))
+        if P is not None:
+            p = np.asarray(P).ravel()[valid]
+            binary = (y <= 1)
+            bins = np.clip((p[binary] * self.nBins).astype(np.int64), 0, self.nBins-1)
+            self.H += np.bincount(y[binary]*self.nBins + bins, minlength=2*self.nBins).reshape((2, self.nBins))
 
-    # return in subsets of size batchSize
-    for ii in range(0, Idx.shape[0], batchSize):
-        nRet = min(batchSize, Idx.shape[0] - ii)
-        yield Idx[ii:(ii+nRet)], (1.0*ii)/Idx.shape[0]
+
+    def report(self, display=False):
+        """Returns (C, acc, precision, recall, f1); see metrics()."""
+        C = self.C.astype(np.float64)
+
+        # works for arbitrary # of classes
+        acc = np.trace(C) / np.sum(self.support)
+
+        # binary classification metrics (only for classes {0,1})
+        nTruePos = C[1,1] if C.shape[0] > 1 else np.float64(0)
+        precision = nTruePos / (np.sum(C[:,1]) if C.shape[0] > 1 else 0)
+        recall = nTruePos / (self.support[1] if C.shape[0] > 1 else 0)
+        f1 = 2.0*(precision*recall) / (precision+recall)
+
+        if display: 
+            for ii in range(C.shape[0]): 
+                print('  class=%d    %s' % (ii, C[ii,:]))
+            print('  accuracy:  %0.3f' % (acc))
+            print('  precision: %0.3f' % (precision))
+            print('  recall:    %0.3f' % (recall))
+            print('  f1:        %0.3f' % (f1))
+
+        return C, acc, precision, recall, f1
+
+
+    def _rates(self):
+        # number of y=0, y=1 pixels with P >= each threshold
+        fp = np.concatenate((np.cumsum(self.H[0,::-1])[::-1], [0]))
+        tp = np.concatenate((np.cumsum(self.H[1,::-1])[::-1], [0]))
+        thresholds = np.linspace(0, 1, self.nBins+1)
+        return 1.0*fp, 1.0*tp, thresholds
+
+
+    def roc(self):
+        """Returns (pfa, pd, thresholds), the ROC curve."""
+        fp, tp, thresholds = self._rates()
+        return fp / np.sum(self.H[0,:]), tp / np.sum(self.H[1,:]), thresholds
+
+
+    def pr(self):
+        """Returns (precision, recall, thresholds), the precision-recall curve."""
+        fp, tp, thresholds = self._rates()
+        with np.errstate(invalid='ignore'):
+            precision = tp / (tp + fp)
+        return precision, tp / np.sum(self.H[1,:]), thresholds
+
+
+    def auc(self):
+        """Area under the ROC curve."""
+        pfa, pd, thresholds = self.roc()
+        return np.trapz(pd[::-1], pfa[::-1])
 
 
 
@@ -339,37 +1472,15 @@ def metrics(Y, Yhat, display=False):
     o Assumes any class label <0 should be ignored in the analysis.
     o Assumes all non-negative class labels are contiguous and start at 0.
       (so for binary classification, the class labels are {0,1})
+
+    See MetricsAccumulator for computing these incrementally.
     """
     assert(len(Y.shape) == 3)
     assert(len(Yhat.shape) == 3)
 
-    # create a confusion matrix
-    # yAll is all *non-negative* class labels in Y
-    yAll = np.unique(Y);  yAll = yAll[yAll >= 0] 
-    C = np.zeros((yAll.size, yAll.size))
-    for yi in yAll:
-        est = Yhat[Y==yi]
-        for jj in yAll:
-            C[yi,jj] = np.sum(est==jj)
-
-    # works for arbitrary # of classes
-    acc = 1.0*np.sum(Yhat[Y>=0] == Y[Y>=0]) / np.sum(Y>=0)
-
-    # binary classification metrics (only for classes {0,1})
-    nTruePos = 1.0*np.sum((Y==1) & (Yhat==1))
-    precision = nTruePos / np.sum(Yhat==1)
-    recall = nTruePos / np.sum(Y==1)
-    f1 = 2.0*(precision*recall) / (precision+recall)
-
-    if display: 
-        for ii in range(C.shape[0]): 
-            print('  class=%d    %s' % (ii, C[ii,:]))
-        print('  accuracy:  %0.3f' % (acc))
-        print('  precision: %0.3f' % (precision))
-        print('  recall:    %0.3f' % (recall))
-        print('  f1:        %0.3f' % (f1))
-
-    return C, acc, precision, recall, f1
+    acc = MetricsAccumulator()
+    acc.update(Y, Yhat)
+    return acc.report(display)
 
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
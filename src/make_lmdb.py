@@ -101,7 +101,7 @@ def get_args():
 
 
 def main(args):
-    tileRadius = np.floor(args.tileSize/2)
+    tileRadius = int(args.tileSize/2)
     nMiniBatch = 1000 # here, a "mini-batch" specifies LMDB transaction size
 
     # make sure we don't clobber an existing output
@@ -111,7 +111,7 @@ def main(args):
 
     # load the data volumes (EM image and labels, if any)
     print('[make_lmdb]: loading EM data file: %s' % args.emFileName)
-    X = emlib.load_cube(args.emFileName, np.float32)
+    X = emlib.load_cube(args.emFileName, np.uint8)  # critical!! otherwise, Caffe just flails...
 
     if args.labelsFileName: 
         print('[make_lmdb]: loading labels file: %s' % args.labelsFileName) 
@@ -134,7 +134,6 @@ def main(args):
         sliceIdx = eval(args.slicesExpr) 
         X = X[sliceIdx, :, :]  # python puts the z dimension first... 
         Y = Y[sliceIdx, :, :]
-    X = X.astype(np.uint8)  # critical!! otherwise, Caffe just flails...
 
     print('[make_lmdb]: EM volume shape: %s' % str(X.shape))
     print('[make_lmdb]: yAll is %s' % np.unique(Y))
@@ -157,7 +156,7 @@ def main(args):
 
     if np.any(Y > 0): 
         # generates a balanced training data set (subsamples and shuffles)
-        it = emlib.stratified_interior_pixel_generator(Y, tileRadius, nMiniBatch, omitLabels=[-1])
+        it = emlib.StratifiedSampler(Y, tileRadius, omitLabels=[-1]).epoch(nMiniBatch)
     else:
         # enumerates all possible tiles in order (no shuffling)
         it = emlib.interior_pixel_generator(X, tileRadius, nMiniBatch)
@@ -169,17 +168,15 @@ def main(args):
             print('[make_lmdb]: stopping at %d (max number of examples reached\n)' % (tileId-1))
             break
 
+        # Translate indices Idx -> tiles Xb and labels yb.
+        Xb = emlib.extract_tiles(X, Idx, tileRadius)
+        yb = Y[ Idx[:,0], Idx[:,1], Idx[:,2] ].astype(np.int32)
+
         # Each mini-batch will be added to the database as a single transaction.
         with env.begin(write=True) as txn:
-            # Translate indices Idx -> tiles Xi and labels yi.
             for jj in range(Idx.shape[0]):
-                yi = Y[ Idx[jj,0], Idx[jj,1], Idx[jj,2] ]
-                yi = int(yi)
-                a = Idx[jj,1] - tileRadius
-                b = Idx[jj,1] + tileRadius + 1
-                c = Idx[jj,2] - tileRadius
-                d = Idx[jj,2] + tileRadius + 1
-                Xi = X[ Idx[jj,0], a:b, c:d ]
+                yi = int(yb[jj])
+                Xi = Xb[jj, 0, :, :]
                 assert(Xi.shape == (args.tileSize, args.tileSize))
 
                 datum = caffe.proto.caffe_pb2.Datum()
@@ -0,0 +1,264 @@
+""" Postprocessing of CNN probability estimates.
+
+This is a numpy/scipy port of the matlab code in ./Postproc
+(postproc_volume.m, inpaint_prob_map.m and inpaint/inpaintn.m); it fills
+in any pixels that were not evaluated (e.g. when deploying with
+--eval-pct < 1), smooths the result with an order statistic filter
+and (optionally) inverts it to follow the ISBI 2012 convention.
+
+Example:
+   python postproc.py YhatDeploy.npy --out-file YhatPost.npy
+"""
+
+__author__ = "Mike Pekala"
+__copyright__ = "Copyright 2015, JHU/APL"
+__license__ = "Apache 2.0"
+
+
+import argparse, os, time
+import multiprocessing as mp
+
+import numpy as np
+from scipy.fftpack import dctn, idctn
+from scipy.ndimage import distance_transform_edt, rank_filter
+
+import emlib
+
+
+
+def disk(radius):
+    """A disk-shaped (boolean) neighborhood with the given radius."""
+    r = np.arange(-radius, radius+1)
+    return (r[:,np.newaxis]**2 + r[np.newaxis,:]**2) <= radius**2
+
+
+
+def inpaintn(x, n=100, y0=None, m=2):
+    """Inpaints (replaces) the NaN values in an N-D array using a
+    DCT-based penalized least squares method.  This is a port of
+    inpaintn.m (see Postproc/inpaint for the original and its license).
+
+    Ref: Garcia D, "Robust smoothing of gridded data in one and higher
+         dimensions with missing values," Comput Stat Data Anal, 2010.
+         Wang G et al, "Three-dimensional reconstruction of...,"
+         Ultrasound Med Biol, 2012.
+
+      x  := the array to inpaint
+      n  := the number of iterations
+      y0 := (optional) an initial guess
+      m  := the order of the smoothing penalty
+    """
+    x = np.array(x, dtype=np.float64)
+    W = np.isfinite(x)
+    if np.all(W):
+        return x
+    if not np.any(W):
+        raise ValueError('cannot inpaint an array with no finite values')
+
+    # eigenvalues of the (discrete) Laplacian
+    d = x.ndim
+    Lambda = np.zeros(x.shape)
+    for ii, sz in enumerate(x.shape):
+        shape = [1]*d
+        shape[ii] = sz
+        Lambda = Lambda + np.reshape(np.cos(np.pi*np.arange(sz)/sz), shape)
+    Lambda = (2*(d - Lambda))**m
+
+    if y0 is not None:
+        y = np.array(y0, dtype=np.float64)
+    else:
+        # nearest neighbor interpolation
+        idx = distance_transform_edt(~W, return_distances=False, return_indices=True)
+        y = x[tuple(idx)]
+    s0 = 3
+
+    x[~W] = 0
+    RF = 2   # relaxation factor
+    for s in np.logspace(s0, -6, n):
+        Gamma = 1. / (1 + s*Lambda)
+        y = RF * idctn(Gamma * dctn(W*(x-y) + y, norm='ortho'), norm='ortho') + (1-RF)*y
+
+    y[W] = x[W]
+    return y
+
+
+
+def inpaint_prob_map(Yi, useSmoothed=True):
+    """Inpaints the missing (negative or NaN) estimates in one slice;
+    see inpaint_prob_map.m.  The result is rescaled to [0,1].
+
+      useSmoothed := if False, the original (evaluated) values replace
+                     the rescaled ones.
+    """
+    Yi = np.array(Yi, dtype=np.float64)
+    Yi[Yi < 0] = np.nan
+    Missing = np.isnan(Yi)
+    if not np.any(Missing):
+        return Yi
+
+    Yr = inpaintn(Yi)
+    Yr = Yr - np.min(Yr)
+    Yr = Yr / np.max(Yr)
+    if not useSmoothed:
+        Yr[~Missing] = Yi[~Missing]
+    return Yr
+
+
+
+def ordfilt(X, order, footprint):
+    """2D order statistic filter (like matlab's ordfilt2, including the
+    zero padding at the boundaries).  order is 1-based.
+    """
+    return rank_filter(X, order-1, footprint=footprint, mode='constant', cval=0)
+
+
+
+def postproc_slice(Yi, footprint=disk(2), order=None, invert=True, useSmoothed=True):
+    """Postprocesses the estimates for a single slice:
+      1.  Inpainting any "missing" (non-evaluated) pixels
+      2.  Smoothing the results via an order statistic filter
+      3.  Inverting, so that low values correspond to high
+          probability of membrane (ISBI2012 convention).
+    """
+    Yi = inpaint_prob_map(Yi, useSmoothed)
+    if footprint is not None and np.sum(footprint) > 0:
+        if order is None:
+            order = int(round(np.sum(footprint) / 2.))
+        Yi = ordfilt(Yi, order, footprint)
+    if invert:
+        Yi = 1 - Yi
+    return Yi.astype(np.float32)
+
+
+
+def _postproc_slice_star(args):
+    return postproc_slice(*args)
+
+
+
+def _open_estimates(Yhat):
+    """Returns (nSlices, get_slice) for estimates that are a file name,
+    a SparseProbVolume or a dense (#classes, #slices, height, width) tensor;
+    get_slice(ii, k) returns the estimates for class k in slice ii.
+    """
+    if isinstance(Yhat, str):
+        if Yhat.endswith('.npy'):
+            Yhat = np.load(Yhat, mmap_mode='r')
+        else:
+            Yhat = emlib.load_sparse_prob(Yhat)
+
+    if isinstance(Yhat, emlib.SparseProbVolume):
+        return Yhat.shape[1], lambda ii, k: Yhat.get_slice(ii)[k,...]
+    else:
+        return Yhat.shape[1], lambda ii, k: np.array(Yhat[k, ii, ...])
+
+
+
+def postproc_volume(Yhat, classIdx=1, footprint=disk(2), order=None, invert=True,
+                    useSmoothed=True, nWorkers=None, outFile=None, tiffFile=None, verbose=True):
+    """Postprocesses a volume of CNN estimates (see postproc_slice()),
+    a slice at a time.  This is the python equivalent of postproc_volume.m.
+
+    Parameters:
+      Yhat      := the estimates; either a tensor with dimensions
+                   (#classes, #slices, height, width) where non-evaluated
+                   pixels are negative (see emcnn.predict()), a
+                   SparseProbVolume, or the name of a file containing
+                   either (.npy, or .npz/.mat as per emlib.save_sparse_prob())
+      classIdx  := which class to postprocess (1 := membrane)
+      footprint := neighborhood for the order statistic filter
+                   (None := no filtering)
+      order     := the order statistic to use (default is the median)
+      nWorkers  := number of processes to use (default is one per cpu;
+                   <= 1 processes slices in this process)
+      outFile   := (optional) a .npy file name; if provided, results are
+                   streamed to this (memory mapped) file.
+      tiffFile  := (optional) a .tif file name; if provided, results are
+                   also streamed to this (multi-page) file.
+
+    Returns a float32 tensor with dimensions (#slices, height, width).
+    """
+    nSlices, get_slice = _open_estimates(Yhat)
+    if nWorkers is None:
+        nWorkers = mp.cpu_count()
+
+    Y0 = get_slice(0, classIdx)
+    shape = (nSlices,) + Y0.shape
+    if outFile:
+        Yout = np.lib.format.open_memmap(outFile, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        Yout = np.empty(shape, dtype=np.float32)
+
+    tw = emlib.TiffWriter(tiffFile, shape, np.float32) if tiffFile else None
+    pool = mp.Pool(nWorkers) if nWorkers > 1 else None
+    chunkSize = max(nWorkers, 1) * 2   # limits the number of slices in memory
+
+    tic = time.time()
+    try:
+        for a in range(0, nSlices, chunkSize):
+            b = min(a + chunkSize, nSlices)
+            work = [(get_slice(ii, classIdx), footprint, order, invert, useSmoothed) for ii in range(a, b)]
+            if pool is None:
+                results = map(_postproc_slice_star, work)
+            else:
+                results = pool.map(_postproc_slice_star, work)
+            for ii, Yi in zip(range(a, b), results):
+                Yout[ii,...] = Yi
+                if tw is not None: tw.write(Yi)
+            if verbose:
+                print('[postproc]: finished slice %d (of %d); total time: %0.2f sec' % (b, nSlices, time.time() - tic))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if tw is not None:
+            tw.close()
+
+    if outFile:
+        Yout.flush()
+    return Yout
+
+
+
+def _get_args():
+    """Command line parameters."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(dest='inFile', type=str,
+		    help='CNN estimates (.npy, or sparse .npz/.mat)')
+
+    parser.add_argument('--out-file', dest='outFile',
+		    type=str, default='',
+		    help='output file (.npy); default is <inFile>.post.npy')
+
+    parser.add_argument('--tiff-out', dest='tiffFile',
+		    type=str, default='',
+		    help='(optional) also save the result as a multi-page .tif file')
+
+    parser.add_argument('--invert', dest='invert',
+		    type=int, default=1,
+		    help='1 := invert the estimates (ISBI 2012 convention)')
+
+    parser.add_argument('--radius', dest='radius',
+		    type=int, default=2,
+		    help='radius of the (disk) smoothing filter; 0 := no smoothing')
+
+    parser.add_argument('--workers', dest='nWorkers',
+		    type=int, default=mp.cpu_count(),
+		    help='number of processes to use')
+
+    return parser.parse_args()
+
+
+
+if __name__ == "__main__":
+    args = _get_args()
+    outFile = args.outFile if args.outFile else os.path.splitext(args.inFile)[0] + '.post.npy'
+
+    footprint = disk(args.radius) if args.radius > 0 else None
+    Y = postproc_volume(args.inFile, footprint=footprint, invert=args.invert,
+                        nWorkers=args.nWorkers, outFile=outFile, 
+                        tiffFile=args.tiffFile if args.tiffFile else None)
+    print('[postproc]: results written to "%s"' % outFile)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -8,8 +8,53 @@ __copyright__ = "Copyright 2015, JHU/APL"
 __license__ = "Apache 2.0"
 
 
-import copy, time, sys
+import copy, time, sys, traceback, Queue
+import ctypes
+import multiprocessing as mp
 import numpy as np
+from scipy.linalg import blas
+
+
+
+def _axpy(a, x, y):
+    """y += a*x, in place (and without temporaries, via BLAS, when possible)."""
+    if x.dtype == y.dtype == np.float32 and x.flags.c_contiguous and y.flags.c_contiguous:
+        blas.saxpy(x.reshape(-1), y.reshape(-1), a=a)
+    else:
+        y += a*x
+
+
+
+def _scal(a, x):
+    """x *= a, in place."""
+    if x.dtype == np.float32 and x.flags.c_contiguous:
+        blas.sscal(a, x.reshape(-1))
+    else:
+        x *= a
+
+
+
+def _forward_backward(net, X, y):
+    """Runs one forward/backward pass of net on the minibatch (X,y);
+    afterwards the gradients live in the blob diffs.  Returns the
+    output of the forward pass.
+    """
+    # convert vector of labels into an appropriately-sized tensor.
+    if y.ndim == 1: 
+        yTensor = y[:, np.newaxis, np.newaxis, np.newaxis]
+    else:
+        yTensor = y
+    assert(yTensor.ndim) == 4
+
+    # caffe wants (C-contiguous) data to be float32; 
+    # these are no-ops if this is already the case.
+    yTensor = np.ascontiguousarray(yTensor, dtype=np.float32)
+    X = np.ascontiguousarray(X, dtype=np.float32)
+
+    net.set_input_arrays(X, yTensor) 
+    out = net.forward() 
+    net.backward() 
+    return out
 
 
 
@@ -35,7 +80,7 @@ class SGDSolverMemoryData:
     this code can be retired.
     """
 
-    def __init__(self, solver, param, verbose=True):
+    def __init__(self, solver, param, verbose=True, nanCheckInterval=100):
         if param.lr_policy not in [u'step', u'inv']:
             raise ValueError('sorry - I only support "step" or "inv" policies at this time')
 
@@ -49,7 +94,8 @@ class SGDSolverMemoryData:
         self._cnnTime = 0.0   # := track time spent doing CNN ops
 	self._bornTime = time.time()
         self._iter = 0        # := current training iteration
-        self._V = {}          # := previous SGD updates (for momentum)
+        self._V = {}          # := previous SGD updates (for momentum); preallocated
+        self._nanCheckInterval = nanCheckInterval   # := how often to scan gradients for NaNs
 
         self._lastLoss = np.NaN
         self._lastAcc = np.NaN
@@ -68,6 +114,13 @@ class SGDSolverMemoryData:
         return out
 
 
+    def close(self):
+        """Releases any resources held by the solver (see
+        SGDSolverDataParallel); a no-op here.
+        """
+        pass
+
+
     def is_training_complete(self):
         return (self._iter >= self._param.max_iter)
 
@@ -76,6 +129,39 @@ class SGDSolverMemoryData:
         return ((self._iter % self._param.snapshot) == 0)
 
 
+    def get_state(self):
+        """Returns the solver state (weights, momentum, iteration and
+        recent loss values) as a dictionary of (copies of) numpy arrays;
+        see set_state().
+        """
+        state = {'iter' : np.array(self._iter), 
+                 'lossHistory' : np.array(self._lastLossN, dtype=np.float64)}
+        for lIdx, layer in enumerate(self._solver.net.layers): 
+            for bIdx, blob in enumerate(layer.blobs): 
+                state['W_%d_%d' % (lIdx, bIdx)] = blob.data.copy()
+                if (lIdx, bIdx) in self._V:
+                    state['V_%d_%d' % (lIdx, bIdx)] = self._V[(lIdx, bIdx)].copy()
+        return state
+
+
+    def set_state(self, state):
+        """Restores a state created by get_state() (e.g. the 
+        contents of a .npz file).
+        """
+        self._iter = int(state['iter'])
+        self._lastLossN = list(state['lossHistory'])
+        self._V = {}
+        for lIdx, layer in enumerate(self._solver.net.layers): 
+            for bIdx, blob in enumerate(layer.blobs): 
+                W = state['W_%d_%d' % (lIdx, bIdx)]
+                if W.shape != blob.data.shape:
+                    raise ValueError('layer %d blob %d: state has shape %s (vs %s)' % (lIdx, bIdx, W.shape, blob.data.shape))
+                blob.data[...] = W
+                key = 'V_%d_%d' % (lIdx, bIdx)
+                if key in state:
+                    self._V[(lIdx, bIdx)] = np.array(state[key], dtype=blob.data.dtype)
+
+
     def print_state(self):
         """Displays info. about learning progress to stdout.
         """
@@ -158,28 +244,32 @@ class SGDSolverMemoryData:
         See SGDSolver::ComputeUpdateValue() in caffe.cpp
         """
 
-        # convert vector of labels into an appropriately-sized tensor.
-        if y.ndim == 1: 
-            yTensor = np.ascontiguousarray(y[:, np.newaxis, np.newaxis, np.newaxis]) 
-        else:
-            yTensor = y
-        assert(yTensor.ndim) == 4
+        tic = time.time() 
+        out = _forward_backward(self._solver.net, X, y)
+        return self._update(out, currIter, tic)
 
-        # caffe wants data to be float32
-        yTensor = yTensor.astype(np.float32)
-        X = X.astype(np.float32)
 
+    def _update(self, out, currIter, tic):
+        """Applies the SGD update (momentum and weight decay) using the
+        gradients currently stored in the net's blob diffs.
+
+          out : The output of the forward pass for this minibatch
+          currIter : The current training iteration (scalar integer)
+          tic : When work on this iteration began (for timing)
+        """
         # the learning rate for this iteration
         alpha = self._get_learning_rate(currIter)
 
-        tic = time.time() 
-        self._solver.net.set_input_arrays(X, yTensor) 
-        out = self._solver.net.forward() 
-        self._solver.net.backward() 
+        # A NaN in the gradients will (quickly) show up in the loss;
+        # the gradients themselves are only scanned periodically.
+        loss = out.get('loss', None)
+        if loss is not None and np.any(np.isnan(loss)):
+            raise RuntimeError("NaN detected in loss (iteration %d)" % currIter)
+        checkNaN = self._nanCheckInterval > 0 and (currIter % self._nanCheckInterval) == 0
 
         for lIdx, layer in enumerate(self._solver.net.layers): 
             for bIdx, blob in enumerate(layer.blobs): 
-                if np.any(np.isnan(blob.diff)): 
+                if checkNaN and np.isnan(np.sum(blob.diff)): 
                     raise RuntimeError("NaN detected in gradient of layer %d" % lIdx) 
                 # Some networks scale the learning rate for weights 
                 # and biases differently; handle that here:
@@ -191,12 +281,15 @@ class SGDSolverMemoryData:
                 alphaLocal = alpha * 1.0 
                 decayLocal = self._param.weight_decay * 1.0
 
-                # SGD with momentum
+                # SGD with momentum; V is updated in place:
+                #    V <- momentum * V - alpha * grad
                 key = (lIdx, bIdx) 
-                V = self._V.get(key, 0.0) 
-                Vnext = self._param.momentum * V - alphaLocal * blob.diff
-                blob.data[...] += Vnext
-                self._V[key] = Vnext 
+                V = self._V.get(key, None)
+                if V is None:
+                    V = self._V[key] = np.zeros(blob.diff.shape, dtype=blob.diff.dtype)
+                _scal(self._param.momentum, V)
+                _axpy(-alphaLocal, blob.diff, V)
+                _axpy(1.0, V, blob.data)
                        
                 # Also implement weight decay (optional).
                 # The weight decay formula (without momentum) looks like:
@@ -213,7 +306,7 @@ class SGDSolverMemoryData:
                 # XXX: make sure it is correct to apply in this
                 #      manner (i.e. apart from momentum)
                 if decayLocal > 0:
-                    blob.data[...] *= (1.0 - alphaLocal * decayLocal)
+                    _scal(1.0 - alphaLocal * decayLocal, blob.data)
 
         self._cnnTime += time.time() - tic
 
@@ -237,4 +330,463 @@ class SGDSolverMemoryData:
         return out
 
 
+
+def _shared_like(A):
+    """A float32 array with the shape of A, backed by shared memory
+    (so that it is visible to processes forked after its creation).
+    """
+    n = int(np.prod(A.shape))
+    return np.frombuffer(mp.RawArray(ctypes.c_float, max(n,1)), dtype=np.float32)[:n].reshape(A.shape)
+
+
+
+def _sgd_worker(make_net, W, G, X, y, taskQ, doneQ):
+    """Computes gradients on a replica of the network.
+
+    Each task is a minibatch that has been copied into (X,y); the
+    worker loads the current weights W, runs forward/backward and
+    writes the gradients to G.  All of these are shared memory.
+    Every task is answered on doneQ (with a traceback on failure).
+    """
+    try:
+        net = make_net()
+        blobs = [blob for layer in net.layers for blob in layer.blobs]
+        failure = None
+    except:
+        failure = traceback.format_exc()
+
+    while True:
+        task = taskQ.get()
+        if task is None:
+            break
+        if failure is not None:
+            doneQ.put((task, failure))
+            continue
+        try:
+            for blob, Wk in zip(blobs, W):
+                blob.data[...] = Wk
+            out = _forward_backward(net, X, y)
+            for blob, Gk in zip(blobs, G):
+                Gk[...] = blob.diff
+            loss = out.get('loss', None)
+            doneQ.put((task, None if loss is None else float(np.squeeze(loss))))
+        except:
+            doneQ.put((task, traceback.format_exc()))
+
+
+
+class SGDSolverDataParallel(SGDSolverMemoryData):
+    """
+    Data-parallel SGD (for CPU training).  There are nWorkers replicas
+    of the network: the solver's own net plus (nWorkers-1) copies that
+    live in worker processes.  Each training iteration consumes
+    nWorkers minibatches (one per replica); the gradients are averaged
+    and then applied by the usual momentum/weight decay logic in
+    SGDSolverMemoryData.  The effective batch size is therefore
+    nWorkers times that of the network.
+
+    Weights, gradients and the worker inputs live in shared memory;
+    the only inter-process messages are small task/completion tokens.
+
+    step() dispatches each minibatch to a worker as soon as it arrives
+    and returns None until every replica has a minibatch; the call that
+    completes the set performs the update and returns the network output.
+    """
+
+    def __init__(self, solver, param, make_net, nWorkers, verbose=True, nanCheckInterval=100):
+        """
+          make_net := a function (called in each worker process) that 
+                      creates a replica of solver.net (i.e. the same 
+                      architecture, in training mode); its weights
+                      are overwritten before each use.
+          nWorkers := the total number of network replicas (>= 1)
+        """
+        SGDSolverMemoryData.__init__(self, solver, param, verbose, nanCheckInterval)
+        if nWorkers < 1:
+            raise ValueError('nWorkers must be positive (got %d)' % nWorkers)
+
+        self._make_net = make_net
+        self._nWorkers = nWorkers
+        self._blobs = [blob for layer in solver.net.layers for blob in layer.blobs]
+        self._W = [_shared_like(blob.data) for blob in self._blobs]
+        self._G = [[_shared_like(blob.data) for blob in self._blobs] for ii in range(nWorkers-1)]
+        self._X = [None] * (nWorkers-1)   # := worker inputs; allocated on first use
+        self._y = [None] * (nWorkers-1)
+        self._nPending = 0                # := #minibatches dispatched this iteration
+        self._workers = []
+        self._taskQ = []
+        self._doneQ = mp.Queue()
+        self._publish()
+
+
+    def _start(self, X, y):
+        """Allocates the (shared) input buffers and starts the workers;
+        deferred until the minibatch dimensions are known.
+        """
+        for ii in range(self._nWorkers-1):
+            self._X[ii] = _shared_like(X)
+            self._y[ii] = _shared_like(np.empty((X.shape[0],1,1,1)))
+            taskQ = mp.Queue()
+            p = mp.Process(target=_sgd_worker, 
+                           args=(self._make_net, self._W, self._G[ii], self._X[ii], self._y[ii], taskQ, self._doneQ))
+            p.daemon = True
+            p.start()
+            self._taskQ.append(taskQ)
+            self._workers.append(p)
+
+
+    def _publish(self):
+        """Copies the current weights to shared memory."""
+        for blob, Wk in zip(self._blobs, self._W):
+            Wk[...] = blob.data
+
+
+    def step(self, X, y):
+        if self._nPending < self._nWorkers-1:
+            if not self._workers:
+                self._start(X, y)
+            ii = self._nPending
+            self._X[ii][...] = X
+            self._y[ii][...] = np.reshape(y, self._y[ii].shape)
+            self._taskQ[ii].put(ii)
+            self._nPending += 1
+            return None
+
+        # this process handles the last minibatch itself
+        tic = time.time()
+        out = _forward_backward(self._solver.net, X, y)
+        losses = [out.get('loss', None)]
+
+        for jj in range(self._nPending):
+            ii, result = self._wait()
+            if isinstance(result, str):
+                raise RuntimeError('worker %d failed:\n%s' % (ii, result))
+            losses.append(result)
+        self._nPending = 0
+
+        # average the gradients (in the solver's net)
+        for k, blob in enumerate(self._blobs):
+            for G in self._G:
+                _axpy(1.0, G[k], blob.diff)
+            _scal(1.0 / self._nWorkers, blob.diff)
+        if losses[0] is not None:
+            out = dict(out)
+            out['loss'] = np.array(np.mean([np.squeeze(l) for l in losses]), dtype=np.float32)
+
+        out = self._update(out, self._iter, tic)
+        self._publish()
+        self._iter += 1
+
+	if self._verbose and (self._iter % self._param.display) == 1:
+		self.print_state()
+
+        return out
+
+
+    def _wait(self, timeout=10):
+        """Waits for the next completed task; raises if a worker died."""
+        while True:
+            try:
+                return self._doneQ.get(timeout=timeout)
+            except Queue.Empty:
+                if not all([p.is_alive() for p in self._workers]):
+                    raise RuntimeError('an SGD worker process exited unexpectedly')
+
+
+    def set_state(self, state):
+        SGDSolverMemoryData.set_state(self, state)
+        self._publish()
+
+
+    def close(self):
+        """Stops the worker processes."""
+        for taskQ in self._taskQ:
+            taskQ.put(None)
+        for p in self._workers:
+            p.join()
+        self._workers, self._taskQ = [], []
+
+
+
+#-------------------------------------------------------------------------------
+# Dense (whole-slice) inference via shift-and-stitch.
+#
+# The networks we train classify one tile at a time (via a MemoryData
+# layer).  Evaluating one tile per pixel recomputes nearly identical
+# convolutions for neighboring pixels.  Instead, we can turn the network
+# into a fully convolutional one (InnerProduct -> Convolution) and run it
+# on an entire slice.  Because of pooling, such a network only produces
+# estimates on a grid with spacing equal to the network's total stride f;
+# running it on the f*f shifted copies of the input and interleaving the
+# results ("shift-and-stitch") recovers an estimate for every pixel.
+#
+# Ref: Long, Shelhamer, Darrell "Fully Convolutional Networks for
+#      Semantic Segmentation," CVPR 2015 (section 3.2)
+#-------------------------------------------------------------------------------
+
+_INPUT_LAYERS = ['MemoryData', 'Data', 'ImageData', 'HDF5Data', 'DummyData', 'Input']
+_TRAIN_ONLY_LAYERS = ['SoftmaxWithLoss', 'Accuracy']
+
+
+def _first(v, default):
+    """Returns a (scalar) protobuf field value.  Depending upon the
+    version of Caffe, some fields (e.g. kernel_size) are repeated.
+    """
+    try:
+        return int(v[0]) if len(v) else default
+    except TypeError:
+        return int(v) if v else default
+
+
+
+def layer_specs(netParam):
+    """Extracts the information needed by dense_geometry() from a
+    caffe_pb2.NetParameter object.
+
+    Returns a list of dictionaries (one per layer).
+    """
+    specs = []
+    for layer in netParam.layer:
+        spec = {'name' : str(layer.name),
+                'type' : str(layer.type),
+                'bottom' : [str(x) for x in layer.bottom],
+                'top' : [str(x) for x in layer.top]}
+
+        if layer.type == 'Convolution':
+            cp = layer.convolution_param
+            spec['kernel'] = _first(cp.kernel_size, _first(cp.kernel_h, 0))
+            spec['stride'] = _first(cp.stride, 1)
+            spec['pad'] = _first(cp.pad, 0)
+        elif layer.type == 'Pooling':
+            pp = layer.pooling_param
+            if pp.global_pooling:
+                raise ValueError('layer "%s": global pooling is not supported' % layer.name)
+            spec['kernel'] = _first(pp.kernel_size, _first(pp.kernel_h, 0))
+            spec['stride'] = _first(pp.stride, 1)
+            spec['pad'] = _first(pp.pad, 0)
+        elif layer.type == 'LRN':
+            lp = layer.lrn_param
+            spec['withinChannel'] = (lp.norm_region == lp.WITHIN_CHANNEL)
+
+        specs.append(spec)
+    return specs
+
+
+
+def dense_geometry(specs, tileSize):
+    """Determines how a tile-based network maps onto a fully convolutional one.
+
+    Parameters:
+      specs    := the output of layer_specs()
+      tileSize := the height/width of the network's input tiles
+
+    Returns a dictionary with keys:
+      stride   := the total stride of the network (the spacing of the
+                  estimates produced by the fully convolutional network)
+      ipKernel := a dictionary mapping each InnerProduct layer name to the
+                  kernel size of its Convolution equivalent
+      warnings := a list of reasons why the dense estimates may not be
+                  identical to the tile-based ones (empty if they should be)
+    """
+    size = {}     # blob name -> spatial size (height == width)
+    stride = {}   # blob name -> cumulative stride
+    ipKernel = {}
+    warnings = []
+
+    for spec in specs:
+        name, ltype = spec['name'], spec['type']
+
+        if ltype in _INPUT_LAYERS:
+            for top in spec['top']:
+                size[top], stride[top] = tileSize, 1
+            continue
+        if ltype in _TRAIN_ONLY_LAYERS:
+            continue
+
+        sIn = size[spec['bottom'][0]]
+        fIn = stride[spec['bottom'][0]]
+
+        if ltype == 'Convolution':
+            k, st, pad = spec['kernel'], spec['stride'], spec['pad']
+            sOut = (sIn + 2*pad - k) // st + 1
+            fOut = fIn * st
+            if pad > 0:
+                warnings.append('layer "%s": zero padding is applied at the tile boundary' % name)
+
+        elif ltype == 'Pooling':
+            k, st, pad = spec['kernel'], spec['stride'], spec['pad']
+            # Caffe rounds up when computing the size of pooling outputs.
+            sOut = int(np.ceil(float(sIn + 2*pad - k) / st)) + 1
+            if pad and (sOut-1)*st >= sIn + pad:
+                sOut -= 1
+            fOut = fIn * st
+            if pad > 0:
+                warnings.append('layer "%s": padding is applied at the tile boundary' % name)
+            if (sIn + 2*pad - k) % st:
+                warnings.append('layer "%s": the last pooling window is clipped at the tile boundary' % name)
+
+        elif ltype == 'InnerProduct':
+            ipKernel[name] = sIn
+            sOut, fOut = 1, fIn
+
+        else:
+            # element-wise layers (ReLU, Dropout, Softmax, ...)
+            sOut, fOut = sIn, fIn
+            if spec.get('withinChannel', False):
+                warnings.append('layer "%s": within-channel LRN is zero padded at the tile boundary' % name)
+
+        if sOut < 1:
+            raise ValueError('layer "%s": tile size %d is too small for this network' % (name, tileSize))
+
+        for top in spec['top']:
+            size[top], stride[top] = sOut, fOut
+
+    if 'prob' not in size:
+        raise ValueError("Can't find a layer called 'prob'")
+    if size['prob'] != 1:
+        raise ValueError('network produces a %dx%d output per tile (expected 1x1)' % (size['prob'], size['prob']))
+
+    return {'stride' : stride['prob'], 'ipKernel' : ipKernel, 'warnings' : warnings}
+
+
+
+def make_dense_net_param(netParam, geometry, inputShape):
+    """Rewrites a tile-based network as a fully convolutional one.
+
+    The input layer is replaced by a plain "data" input of shape
+    inputShape, loss/accuracy layers are dropped and InnerProduct layers
+    become Convolution layers (with the same names).
+
+    Parameters:
+      netParam   := a caffe_pb2.NetParameter object (not modified)
+      geometry   := the output of dense_geometry()
+      inputShape := the 4d shape of the dense network's input
+    """
+    dense = type(netParam)()
+    dense.name = netParam.name + '_dense'
+    dense.input.append('data')
+    dense.input_dim.extend([int(x) for x in inputShape])
+
+    for layer in netParam.layer:
+        if layer.type in _INPUT_LAYERS or layer.type in _TRAIN_ONLY_LAYERS:
+            continue
+
+        newLayer = dense.layer.add()
+        newLayer.CopyFrom(layer)
+
+        if layer.type == 'InnerProduct':
+            ip = layer.inner_product_param
+            newLayer.type = 'Convolution'
+            newLayer.ClearField('inner_product_param')
+
+            cp = newLayer.convolution_param
+            cp.num_output = ip.num_output
+            cp.bias_term = ip.bias_term
+            k = geometry['ipKernel'][layer.name]
+            if cp.DESCRIPTOR.fields_by_name['kernel_size'].label == \
+                    cp.DESCRIPTOR.fields_by_name['kernel_size'].LABEL_REPEATED:
+                cp.kernel_size.append(k)
+            else:
+                cp.kernel_size = k
+
+    return dense
+
+
+
+def shift_and_stitch(forward, Xpad, tileRadius, stride):
+    """Produces a dense map of estimates for one (mirrored) slice.
+
+    Parameters:
+      forward    := a function mapping an input with the same shape as Xpad
+                    to an (nClasses, Ho, Wo) tensor whose entry (:, i, j) is
+                    the estimate for the tile with upper left corner
+                    (stride*i, stride*j)
+      Xpad       := a (height+2*tileRadius, width+2*tileRadius) slice
+                    (i.e. with mirrored edges)
+      tileRadius := tiles have dimensions (2*tileRadius+1, 2*tileRadius+1)
+      stride     := the total stride of the fully convolutional network
+
+    Returns an (nClasses, height, width) float32 tensor.
+    """
+    Hp, Wp = Xpad.shape
+    H, W = Hp - 2*tileRadius, Wp - 2*tileRadius
+
+    Xin = np.zeros(Xpad.shape, dtype=np.float32)
+    P = None
+
+    for dy in range(min(stride, H)):
+        for dx in range(min(stride, W)):
+            # The tail of Xin only affects estimates that are discarded.
+            Xin[...] = 0
+            Xin[:Hp-dy, :Wp-dx] = Xpad[dy:, dx:]
+            out = forward(Xin)
+
+            if P is None:
+                P = np.zeros((out.shape[0], H, W), dtype=np.float32)
+
+            ny = len(range(dy, H, stride))
+            nx = len(range(dx, W, stride))
+            if out.shape[1] < ny or out.shape[2] < nx:
+                raise RuntimeError('dense network output is too small (%s)' % str(out.shape))
+            P[:, dy::stride, dx::stride] = out[:, :ny, :nx]
+
+    return P
+
+
+
+class ShiftAndStitchNet:
+    """Dense (whole-slice) inference using a tile-based network.
+
+    Builds a fully convolutional version of the tile-based network
+    (see make_dense_net_param()), copies the weights over and then
+    uses shift_and_stitch() to produce estimates for every pixel
+    in a slice.
+    """
+
+    def __init__(self, net, netParam, tileSize, sliceShape, denseNetFn, verbose=True):
+        """
+          net        : a caffe.Net (tile-based) with trained weights
+          netParam   : the caffe_pb2.NetParameter for net
+          tileSize   : the height/width of the network's input tiles
+          sliceShape : the (height, width) of the mirrored slices to process
+          denseNetFn : where to write the fully convolutional prototxt
+        """
+        import caffe  # imported here so this module can be used without caffe
+
+        self._tileRadius = int(tileSize/2)
+        self._geometry = dense_geometry(layer_specs(netParam), tileSize)
+        self.stride = self._geometry['stride']
+
+        if verbose:
+            print "[dense]: network has stride %d (%d forward passes per slice)" % (self.stride, self.stride**2)
+            for w in self._geometry['warnings']:
+                print "[dense]: WARNING: estimates may differ from tile-based estimates; %s" % w
+
+        denseParam = make_dense_net_param(netParam, self._geometry, (1, 1) + tuple(sliceShape))
+        with open(denseNetFn, 'w') as f:
+            f.write(str(denseParam))
+
+        phaseTest = 1  # 1 := test mode
+        self.net = caffe.Net(str(denseNetFn), phaseTest)
+
+        # InnerProduct weights (nOut, C*k*k) -> Convolution weights (nOut, C, k, k)
+        for name, blobs in net.params.iteritems():
+            for bIdx, b in enumerate(blobs):
+                dst = self.net.params[name][bIdx].data
+                dst[...] = np.reshape(b.data, dst.shape)
+
+
+    def _forward(self, Xin):
+        self.net.blobs['data'].data[0, 0, ...] = Xin
+        out = self.net.forward()
+        return out['prob'][0]
+
+
+    def predict_slice(self, Xpad):
+        """Returns an (nClasses, height, width) tensor of estimates for
+        a (mirrored) slice.
+        """
+        return shift_and_stitch(self._forward, Xpad, self._tileRadius, self.stride)
+
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,138 @@
+"""Simple throughput benchmarks for the data-side code paths.
+
+These are not unit tests (they make no assertions); they exist so we
+can quantify the impact of changes to performance-critical code.
+
+To run (from pwd):
+    PYTHONPATH=../src python benchmark.py
+"""
+
+__author__ = "Mike Pekala"
+__copyright__ = "Copyright 2015, JHU/APL"
+__license__ = "Apache 2.0"
+
+
+import sys, os, time
+import numpy as np
+
+import emlib
+import emcnn
+
+
+
+def _extract_tiles_loop(X, Idx, tileRadius, out):
+    """The original (one tile at a time) tile extraction code;
+    retained here as a baseline for comparison.
+    """
+    for jj in range(Idx.shape[0]):
+        a = Idx[jj,1] - tileRadius
+        b = Idx[jj,1] + tileRadius + 1
+        c = Idx[jj,2] - tileRadius
+        d = Idx[jj,2] + tileRadius + 1
+        out[jj, 0, :, :] = X[ Idx[jj,0], a:b, c:d ]
+    return out
+
+
+
+def bench_tile_extraction(volumeShape=(10,512,512), tileSize=65, batchSize=100, nBatches=200):
+    """Reports tiles/sec for the per-tile loop vs the batched gather.
+    """
+    tileRadius = int(tileSize/2)
+    X = np.random.rand(*volumeShape).astype(np.float32)
+    Xi = np.zeros((batchSize, 1, tileSize, tileSize), dtype=np.float32)
+
+    it = emlib.interior_pixel_generator(X, tileRadius, batchSize)
+    batches = [Idx for Idx, pct in it][:nBatches]
+    nTiles = sum([Idx.shape[0] for Idx in batches])
+
+    for name, f in [('loop', _extract_tiles_loop), ('batched', emlib.extract_tiles)]:
+        tic = time.time()
+        for Idx in batches:
+            f(X, Idx, tileRadius, out=Xi)
+        elapsed = time.time() - tic
+        print('[benchmark]: tile extraction (%s): %0.0f tiles/sec' % (name, nTiles / elapsed))
+        sys.stdout.flush()
+
+
+
+def bench_prefetch(volumeShape=(10,512,512), tileSize=65, batchSize=100, nBatches=200, cnnSec=0.005):
+    """Reports throughput with/without background minibatch assembly.
+
+    The CNN is simulated by a fixed amount of (GIL-holding) work per minibatch.
+    """
+    tileRadius = int(tileSize/2)
+    batchDim = (batchSize, 1, tileSize, tileSize)
+    X = np.random.rand(*volumeShape).astype(np.float32)
+    Y = (np.random.rand(*volumeShape) > 0.5).astype(np.int32)
+
+    def fake_cnn():
+        tic = time.time()
+        while (time.time() - tic) < cnnSec:
+            pass
+
+    it = emlib.stratified_interior_pixel_generator(Y, tileRadius, batchSize)
+    batches = [next(it) for ii in range(nBatches)]
+
+    for nBuffers, nWorkers in [(0, 1), (3, 1), (4, 3)]:
+        prefetcher = emlib.MinibatchPrefetcher(iter(batches), X, Y, batchDim, nBuffers=nBuffers, nWorkers=nWorkers)
+        tic = time.time()
+        for Xi, yi, Idx, epochPct in prefetcher:
+            fake_cnn()
+        elapsed = time.time() - tic
+        print('[benchmark]: prefetch (nBuffers=%d, nWorkers=%d): %0.1f batches/sec; waited on data %0.2f of %0.2f sec' % (nBuffers, nWorkers, nBatches/elapsed, prefetcher.waitTime, elapsed))
+        sys.stdout.flush()
+
+
+
+class _DotNet(object):
+    """A stand-in for a caffe.Net whose forward pass is (CPU bound) 
+    matrix arithmetic of roughly the size of a small CNN."""
+    def __init__(self, batchDim, nHidden=1024):
+        d = batchDim[2] * batchDim[3]
+        self.W1 = np.random.randn(d, nHidden).astype(np.float32) / d
+        self.W2 = np.random.randn(nHidden, 2).astype(np.float32)
+        self.blobs = {'prob' : type('Blob', (object,), {'data' : np.zeros((batchDim[0], 2))})()}
+
+    def set_input_arrays(self, X, y):
+        self._X = np.reshape(X, (X.shape[0], -1))
+
+    def forward(self):
+        H = np.maximum(np.dot(self._X, self.W1), 0)
+        Z = np.exp(np.dot(H, self.W2))
+        return {'prob' : (Z / np.sum(Z, axis=1)[:,np.newaxis])[:,:,np.newaxis,np.newaxis]}
+
+
+
+def bench_deploy_scaling(volumeShape=(16,200,200), tileSize=65, batchSize=100, workers=[1,2,4,8]):
+    """Reports deploy throughput (pixels/sec) vs number of worker processes.
+
+    Set OMP_NUM_THREADS=1 so that each worker uses a single core.
+    """
+    batchDim = (batchSize, 1, tileSize, tileSize)
+    tileRadius = int(tileSize/2)
+    X = emlib.mirror_edges(np.random.rand(*volumeShape).astype(np.float32), tileRadius)
+    Mask = np.ones(X.shape, dtype=bool)
+    nPixels = np.prod(volumeShape)
+    make_net = lambda: _DotNet(batchDim)
+
+    stdout = sys.stdout
+    for nWorkers in workers:
+        sys.stdout = open(os.devnull, 'w')   # suppress per-slice progress
+        tic = time.time()
+        try:
+            emcnn.predict_parallel(make_net, X, Mask, batchDim, nWorkers, nPrefetch=0)
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - tic
+        print('[benchmark]: deploy (workers=%d): %0.0f pixels/sec' % (nWorkers, nPixels / elapsed))
+        sys.stdout.flush()
+
+
+
+if __name__ == "__main__":
+    bench_tile_extraction()
+    bench_prefetch()
+    bench_deploy_scaling()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -10,11 +10,33 @@ __license__ = "Apache 2.0"
 
 
 import unittest
-import os
+import os, tempfile, shutil
 import numpy as np
 from sklearn.metrics import precision_recall_fscore_support as smetrics
 
 import emcnn
+import emlib
+
+
+
+class _Blob(object):
+    def __init__(self, shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+
+class _MeanNet(object):
+    """Stands in for a caffe.Net (in MemoryData mode); the "probability"
+    of class 1 is the mean of the tile.
+    """
+    def __init__(self, batchSize):
+        self.blobs = {'prob' : _Blob((batchSize, 2))}
+
+    def set_input_arrays(self, X, y):
+        self._X = X.copy()
+
+    def forward(self):
+        m = np.mean(np.reshape(self._X, (self._X.shape[0], -1)), axis=1)
+        return {'prob' : np.column_stack([1-m, m])[:,:,np.newaxis,np.newaxis]}
 
 
 
@@ -34,6 +56,20 @@ class TestEmcnn(unittest.TestCase):
         self.assertTrue(len(toOmit) == 2)
 
         
+    def test_data_scale(self):
+        # only data with values > 1 is assumed to be in [0 255], whatever
+        # its type, and whether it is in memory or read slice by slice
+        tmpDir = tempfile.mkdtemp()
+        for ii, (X, scale) in enumerate([(np.random.randint(0, 2, size=(3,10,12)).astype(np.uint8), 1.),
+                         (np.random.randint(0, 256, size=(3,10,12)).astype(np.uint8), 1/255.),
+                         (np.random.rand(3,10,12).astype(np.float32), 1.)]):
+            fn = os.path.join(tmpDir, 'X%d.npy' % ii)
+            np.save(fn, X)
+            self.assertTrue(emcnn._data_scale(X) == scale)
+            self.assertTrue(emcnn._data_scale(emlib.open_cube(fn), [2,0]) == scale)
+        shutil.rmtree(tmpDir)
+
+        
     def test_xform_minibatch(self):
         X = np.random.randint(0,10, size=(2,100,3,3))
 
@@ -47,6 +83,12 @@ class TestEmcnn(unittest.TestCase):
             self.assertTrue(not np.any(np.isnan(Xprime)))
         self.assertTrue(numDiff>0)
 
+        # the transformation is determined by the rng
+        for rotate in [False, True]:
+            Xa = emcnn._xform_minibatch(X, rotate, rng=np.random.RandomState(3))
+            Xb = emcnn._xform_minibatch(X, rotate, rng=np.random.RandomState(3))
+            self.assertTrue(np.all(Xa == Xb))
+
         
     def test_load_data(self):
         # TODO: make this search the PYTHONPATH for files...
@@ -67,6 +109,148 @@ class TestEmcnn(unittest.TestCase):
         self.assertTrue(np.max(X) <= 1.0)
         self.assertTrue(np.min(X) >= 0.0)
 
+
+    def test_validate(self):
+        batchDim = (10, 1, 7, 7)
+        X = np.random.rand(3, 26, 27).astype(np.float32)
+        Y = np.random.randint(-1, 2, size=X.shape)
+        Y[1,...] = -1     # a slice with no labels
+
+        tmpDir = tempfile.mkdtemp()
+        outFile = os.path.join(tmpDir, 'Yhat.npy')
+        perf = emcnn.validate(_MeanNet(batchDim[0]), X, Y, batchDim, nPrefetch=0, outFile=outFile)
+
+        # compare with predicting the whole volume at once
+        Mask = np.ones(X.shape, dtype=bool)
+        emcnn.prune_border_3d(Mask, 3)[emcnn.prune_border_3d(Y, 3) < 0] = False
+        Prob = emcnn.predict(_MeanNet(batchDim[0]), X, Mask, batchDim, nPrefetch=0)
+        self.assertTrue(np.allclose(np.load(outFile), Prob))
+
+        Yhat = np.argmax(Prob, 0)
+        Yhat[emcnn.prune_border_3d(Mask, 3) == False] = -1
+        C, acc, precision, recall, f1 = emlib.metrics(emcnn.prune_border_3d(Y, 3), Yhat)
+        self.assertTrue(np.all(perf.report()[0] == C))
+        self.assertAlmostEqual(perf.report()[1], acc)
+        shutil.rmtree(tmpDir)
+
+
+    def test_validate_pixels(self):
+        batchDim = (10, 1, 7, 7)
+        X = np.random.rand(3, 26, 27).astype(np.float32)
+        Y = np.random.randint(-1, 2, size=X.shape)
+
+        # the subset is reproducible and only contains labeled interior pixels
+        Idx = emcnn.validation_pixels(Y, 3, 100)
+        self.assertTrue(Idx.shape == (100, 3))
+        self.assertTrue(np.all(Idx == emcnn.validation_pixels(Y, 3, 100)))
+        self.assertTrue(np.all(Y[Idx[:,0], Idx[:,1], Idx[:,2]] >= 0))
+        self.assertTrue(np.all(Idx[:,1:] >= 3) and np.all(Idx[:,1] < 23) and np.all(Idx[:,2] < 24))
+
+        # all labeled pixels is the same as validate()
+        Idx = emcnn.validation_pixels(Y, 3)
+        self.assertTrue(Idx.shape[0] == np.sum(emcnn.prune_border_3d(Y, 3) >= 0))
+        perf = emcnn.validate_pixels(_MeanNet(batchDim[0]), X, Y, Idx, batchDim, nPrefetch=0)
+        perf2 = emcnn.validate(_MeanNet(batchDim[0]), X, Y, batchDim, nPrefetch=0)
+        self.assertTrue(np.all(perf.report()[0] == perf2.report()[0]))
+
+
+    def test_async_validator(self):
+        batchDim = (10, 1, 7, 7)
+        X = np.random.rand(3, 26, 27).astype(np.float32)
+        Y = np.random.randint(-1, 2, size=X.shape)
+        Idx = emcnn.validation_pixels(Y, 3, 200)
+
+        tmpDir = tempfile.mkdtemp()
+        logFile = os.path.join(tmpDir, 'validation.log')
+        validator = emcnn.AsyncValidator(lambda fn: _MeanNet(batchDim[0]), X, Y, batchDim, logFile, validIdx=Idx)
+        validator.submit(100, 'iter_000100.caffemodel')
+        validator.submit(200, 'iter_000200.caffemodel')
+        validator.close()
+
+        # one line per snapshot (plus a header)
+        lines = open(logFile).read().splitlines()
+        self.assertTrue(len(lines) == 3)
+        self.assertTrue([int(l.split()[0]) for l in lines[1:]] == [100, 200])
+        perf = emcnn.validate_pixels(_MeanNet(batchDim[0]), X, Y, Idx, batchDim, nPrefetch=0)
+        self.assertAlmostEqual(float(lines[1].split()[1]), perf.report()[1], places=4)
+
+        # failures are reported to the parent
+        def make_net(fn):
+            raise IOError('cannot load %s' % fn)
+        validator = emcnn.AsyncValidator(make_net, X, Y, batchDim, logFile, validIdx=Idx)
+        validator.submit(300, 'iter_000300.caffemodel')
+        self.assertRaises(RuntimeError, validator.close)
+        shutil.rmtree(tmpDir)
+
+
+    def test_resume_rng(self):
+        r = 3
+        batchDim = (10, 1, 2*r+1, 2*r+1)
+        X = np.random.rand(2, 30, 30).astype(np.float32)
+        Y = np.random.randint(0, 2, size=X.shape)
+        sampler = emlib.StratifiedSampler(Y, r)
+
+        def run_epoch(seed, skip, checkpointAt=None):
+            it = sampler.epoch(batchDim[0], seed=seed, skip=skip)
+            prefetcher = emlib.MinibatchPrefetcher(it, X, Y, batchDim, nBuffers=3, seed=seed, firstBatch=skip)
+            for nBatches, batch in enumerate(prefetcher, skip+1):
+                if nBatches == checkpointAt:
+                    state = emcnn.get_rng_state()
+            return state if checkpointAt else None
+
+        # a (simulated) checkpoint part way through an epoch...
+        np.random.seed(0)
+        seed = np.random.randint(0, 2**31-1)
+        state = run_epoch(seed, 0, checkpointAt=2)
+        nextSeed = np.random.randint(0, 2**31-1)
+
+        # ...from which resuming draws the same seed for the next epoch
+        emcnn.set_rng_state(state)
+        run_epoch(seed, 2)
+        self.assertTrue(np.random.randint(0, 2**31-1) == nextSeed)
+
+
+    def test_checkpointer(self):
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir, 'iter_000010.solverstate.npz')
+        state = {'W_0_0' : np.random.rand(3,4).astype(np.float32), 'iter' : np.array(10)}
+        state.update(emcnn.get_rng_state())
+
+        checkpointer = emcnn.Checkpointer()
+        checkpointer.save(fn, state)
+        x = np.random.rand(5)
+        checkpointer.wait()
+        self.assertTrue(os.listdir(tmpDir) == ['iter_000010.solverstate.npz'])
+
+        state2 = np.load(fn)
+        self.assertTrue(np.all(state2['W_0_0'] == state['W_0_0']))
+        self.assertTrue(int(state2['iter']) == 10)
+
+        # the random number generator picks up where it left off
+        emcnn.set_rng_state(state2)
+        self.assertTrue(np.all(np.random.rand(5) == x))
+        shutil.rmtree(tmpDir)
+
+
+    def test_predict_parallel(self):
+        batchDim = (10, 1, 7, 7)
+        X = np.random.rand(5, 26, 27).astype(np.float32)
+        Mask = np.random.rand(*X.shape) < 0.3
+        make_net = lambda: _MeanNet(batchDim[0])
+
+        P1 = emcnn.predict(make_net(), X, Mask, batchDim, nPrefetch=0)
+        self.assertTrue(P1.shape == (2, 5, 20, 21))
+
+        P2 = emcnn.predict_parallel(make_net, X, Mask, batchDim, 2)
+        self.assertTrue(np.allclose(P1, P2))
+
+        P3 = emcnn.predict_parallel(make_net, X, Mask, batchDim, 2, sparse=np.float32)
+        self.assertTrue(np.allclose(P1, P3.todense()))
+
+        # workers may prefetch minibatches in processes of their own
+        P4 = emcnn.predict_parallel(make_net, X, Mask, batchDim, 2, nPrefetch=3)
+        self.assertTrue(np.allclose(P1, P4))
+
         
 
         
@@ -10,8 +10,12 @@ __license__ = "Apache 2.0"
 
 
 import unittest
+import os, tempfile, shutil
 import numpy as np
+import h5py
+from PIL import Image
 from sklearn.metrics import precision_recall_fscore_support as smetrics
+from sklearn.metrics import confusion_matrix, roc_auc_score
 
 import emlib
 
@@ -29,8 +33,54 @@ class TestEmlib(unittest.TestCase):
         self.assertAlmostEqual(prec, prec2[1])
         self.assertAlmostEqual(recall, recall2[1])
         self.assertAlmostEqual(f1, f12[1])
+
+
+    def test_metrics_accumulator(self):
+        Y = np.random.randint(-1,2,size=(4,20,20))
+        P = np.clip(0.3*Y + 0.7*np.random.rand(*Y.shape), 0, 1)
+        Yhat = (P > 0.5).astype(np.int32)
+        Yhat[0,0,0:5] = -1      # not evaluated
+
+        # streaming a slice at a time is the same as all at once
+        acc = emlib.MetricsAccumulator()
+        for ii in range(Y.shape[0]):
+            acc.update(Y[ii,...], Yhat[ii,...], P[ii,...])
+        C, a, prec, recall, f1 = acc.report()
+
+        v = Y >= 0
+        self.assertTrue(np.all(C == confusion_matrix(Y[v & (Yhat >= 0)], Yhat[v & (Yhat >= 0)])))
+        self.assertAlmostEqual(a, 1.0*np.sum(Y[v] == Yhat[v]) / np.sum(v))
+        self.assertAlmostEqual(recall, 1.0*np.sum((Y == 1) & (Yhat == 1)) / np.sum(Y == 1))
+
+        # ROC curve (from the histograms) vs. sklearn
+        self.assertTrue(abs(acc.auc() - roc_auc_score(Y[v], P[v])) < 1e-2)
+        precision, recall, thresholds = acc.pr()
+        self.assertAlmostEqual(recall[0], 1.0)
+        self.assertAlmostEqual(precision[0], 1.0*np.sum(Y == 1) / np.sum(v))
         
     
+    def test_remap_class_labels(self):
+        for dtype in [np.uint8, np.float32, np.int32]:
+            Y = np.random.choice([0, 3, 7, 9], size=(2,10,10)).astype(dtype)
+            Y[0,0,0:3] = [0, 3, 7]   # make sure all labels are present
+            Y[1,0,0] = 9
+
+            Yout, yAll, counts, nOmitted = emlib.remap_class_labels(Y, [7])
+            self.assertTrue(Yout.dtype == np.int8)
+            self.assertTrue(list(yAll) == [0, 3, 9])
+            for k, y in enumerate(yAll):
+                self.assertTrue(np.all((Yout == k) == (Y == y)))
+                self.assertTrue(counts[k] == np.sum(Y == y))
+            self.assertTrue(np.all((Yout == -1) == (Y == 7)))
+            self.assertTrue(nOmitted == np.sum(Y == 7))
+            self.assertTrue(np.all(emlib.fix_class_labels(Y, [7]) == Yout))
+
+            # a specific label order
+            Yout, yAll, counts, nOmitted = emlib.remap_class_labels(Y, [], labelOrder=[9, 7, 3, 0])
+            self.assertTrue(list(yAll) == [9, 7, 3, 0])
+            self.assertTrue(np.all(Yout == 3 - np.searchsorted([0, 3, 7, 9], Y)))
+
+
     def test_mirror_edges(self):
         X = np.random.rand(10,3,3);
         b = 2  # b := border size
@@ -45,6 +95,274 @@ class TestEmlib(unittest.TestCase):
         self.assertTrue(np.all(Xm[:,:,b-1] == Xm[:,:,b]))
         self.assertTrue(np.all(Xm[:, b:-b, b:-b] == X))
 
+
+    def test_mirrored_volume(self):
+        X = np.random.rand(3,12,15).astype(np.float32)
+        r = 4
+        Xm = emlib.mirror_edges(X, r)
+        V = emlib.MirroredVolume(X, r)
+        self.assertTrue(V.shape == Xm.shape)
+        self.assertTrue(np.all(np.asarray(V) == Xm))
+
+        # slicing and integer array indexing
+        self.assertTrue(np.all(V[1] == Xm[1]))
+        self.assertTrue(np.all(V[0:2, 1:9, 3:20] == Xm[0:2, 1:9, 3:20]))
+        self.assertTrue(np.all(V[:, r:-r, r:-r] == X))
+        self.assertTrue(np.may_share_memory(V[:, r:-r, r:-r], X))   # a view
+        s, a, b = np.random.randint(0, 3, 50), np.random.randint(0, 20, 50), np.random.randint(0, 23, 50)
+        self.assertTrue(np.all(V[s, a, b] == Xm[s, a, b]))
+
+        # tiles in the interior and in the mirrored border
+        Idx = np.array([[0,4,4], [1,10,12], [2,8,11], [2,15,18], [0,9,4]])
+        self.assertTrue(np.all(emlib.extract_tiles(V, Idx, r) == emlib.extract_tiles(Xm, Idx, r)))
+        self.assertTrue(np.all(emlib.extract_tiles(V, Idx[2:3], r) == emlib.extract_tiles(Xm, Idx[2:3], r)))
+        self.assertRaises(RuntimeError, emlib.extract_tiles, V, np.array([[0,3,10]]), r)
+
+        # raw uint8 data is scaled as it is accessed
+        X8 = np.random.randint(0, 256, size=X.shape).astype(np.uint8)
+        V = emlib.MirroredVolume(X8, r, scale=1/255.)
+        Xm = emlib.mirror_edges(X8, r) / np.float32(255.)
+        self.assertTrue(V.dtype == np.float32)
+        self.assertTrue(np.allclose(np.asarray(V), Xm))
+        self.assertTrue(np.allclose(V[1], Xm[1]))
+        self.assertTrue(np.allclose(V[s, a, b], Xm[s, a, b]))
+        for Ii in [Idx, Idx[2:3]]:
+            Xi = emlib.extract_tiles(V, Ii, r)
+            self.assertTrue(Xi.dtype == np.float32)
+            self.assertTrue(np.allclose(Xi, emlib.extract_tiles(Xm, Ii, r)))
+
+        # border tiles in volumes with more than 2^31 voxels (a sparse file)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            Xbig = np.memmap(os.path.join(tmpDir, 'X.raw'), dtype=np.uint8, mode='w+', shape=(700,2000,2000))
+            Xbig[699, :20, :20] = np.random.randint(0, 256, size=(20,20))
+            V = emlib.MirroredVolume(Xbig, r)
+            Idx = np.array([[699, r+1, r+2], [699, r+10, r]], dtype=np.int32)
+            Xm = emlib.mirror_edges(np.array(Xbig[699:700, :30, :30]), r)
+            self.assertTrue(np.all(emlib.extract_tiles(V, Idx, r) == emlib.extract_tiles(Xm, Idx - [699,0,0], r)))
+            del V, Xbig
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+    def test_load_cube(self):
+        X = np.random.randint(0, 255, size=(6,20,30)).astype(np.uint8)
+        tmpDir = tempfile.mkdtemp()
+        np.save(os.path.join(tmpDir, 'X.npy'), X)
+        with h5py.File(os.path.join(tmpDir, 'X.mat'), 'w') as f:
+            f.create_dataset('X', data=np.transpose(X, (0,2,1)))   # matlab ordering
+
+        for fn in ['X.npy', 'X.mat']:
+            Xl = emlib.load_cube(os.path.join(tmpDir, fn), np.float32)
+            self.assertTrue(Xl.dtype == np.float32 and np.all(Xl == X))
+
+            # only a subset of slices (in any order)
+            for slices in [[1,3], [4,0,4]]:
+                Xl = emlib.load_cube(os.path.join(tmpDir, fn), np.float32, slices)
+                self.assertTrue(Xl.flags['C_CONTIGUOUS'] and Xl.flags['WRITEABLE'])
+                self.assertTrue(np.all(Xl == X[slices,...]))
+
+
+    def test_load_tiff_data(self):
+        X = np.random.randint(0, 255, size=(6,20,30)).astype(np.uint8)
+        fn = os.path.join(tempfile.mkdtemp(), 'X.tif')
+        pages = [Image.fromarray(X[ii,...]) for ii in range(X.shape[0])]
+        pages[0].save(fn, save_all=True, append_images=pages[1:])
+
+        Xl = emlib.load_tiff_data(fn, cache=False, nThreads=4)
+        self.assertTrue(Xl.dtype == np.float32 and np.all(Xl == X))
+        Xl = emlib.load_tiff_data(fn, None, [4,1], cache=False, nThreads=2)
+        self.assertTrue(Xl.dtype == np.uint8 and np.all(Xl == X[[4,1],...]))
+
+        # the first (cached) load creates a decoded copy; the second uses it
+        Xl = emlib.load_tiff_data(fn, np.float32, [2,3])
+        self.assertTrue(np.all(Xl == X[[2,3],...]))
+        sidecars = [f for f in os.listdir(os.path.dirname(fn)) if f.endswith('.npy')]
+        self.assertTrue(len(sidecars) == 1)
+        Xl = emlib.load_tiff_data(fn)
+        self.assertTrue(np.all(Xl == X))
+
+
+    def test_tiff_writer(self):
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir, 'X.tif')
+        for dtype in [np.uint8, np.float32]:
+            X = (255*np.random.rand(5,17,23)).astype(dtype)
+            for compression in [None, 'deflate']:
+                emlib.save_multipage_tiff(X, fn, compression=compression)
+                Xl = emlib.load_tiff_data(fn, None, cache=False)
+                self.assertTrue(Xl.dtype == dtype and np.all(Xl == X))
+
+        # BigTIFF (which PIL cannot read, so just check the header)
+        with emlib.TiffWriter(fn, bigtiff=True) as tw:
+            tw.write(X[0,...])
+        with open(fn, 'rb') as f:
+            self.assertTrue(f.read(8) == b'II\x2b\x00\x08\x00\x00\x00')
+
+
+    def test_read_block(self):
+        X = np.random.rand(4,20,30).astype(np.float32)
+        r = 5
+        Xm = emlib.mirror_edges(X, r)
+
+        # .npy (memory mapped) and .mat (hdf5) volumes
+        tmpDir = tempfile.mkdtemp()
+        np.save(os.path.join(tmpDir, 'X.npy'), X)
+        with h5py.File(os.path.join(tmpDir, 'X.mat'), 'w') as f:
+            f.create_dataset('X', data=np.transpose(X, (0,2,1)))
+
+        for fn in ['X.npy', 'X.mat']:
+            V = emlib.open_cube(os.path.join(tmpDir, fn))
+            self.assertTrue(V.shape == X.shape)
+            for rows, cols in [((0,7), (0,30)), ((7,14), (12,24)), ((14,20), (24,30))]:
+                for slices in [[1,3], [3,0,3]]:   # (in any order)
+                    Xb = emlib.read_block(V, slices, rows, cols, r)
+                    self.assertTrue(np.all(Xb == Xm[slices, rows[0]:rows[1]+2*r, cols[0]:cols[1]+2*r]))
+
+
+    def test_create_prob_volume(self):
+        P = emlib.create_prob_volume((2,3,4,5))
+        self.assertTrue(P.dtype == np.float32)
+        self.assertTrue(np.all(P == -1))
+
+        # memory mapped version
+        fn = os.path.join(tempfile.mkdtemp(), 'P.npy')
+        P = emlib.create_prob_volume((2,3,4,5), fn)
+        P[1,2,...] = 0.5
+        P.flush()
+        del P
+        P = np.load(fn)
+        self.assertTrue(P.shape == (2,3,4,5))
+        self.assertTrue(np.all(P[1,2,...] == 0.5))
+        self.assertTrue(np.sum(P == -1) == P.size - 20)
+
+
+    def test_sparse_prob_volume(self):
+        Mask = np.random.rand(3,10,12) < 0.2
+        Mask[1,2,3] = False
+        P = emlib.SparseProbVolume.from_mask(2, Mask, dtype=np.float32)
+        self.assertTrue(P.values.shape == (2, np.sum(Mask)))
+
+        # assign estimates the same way as for a dense tensor
+        Pd = emlib.create_prob_volume((2,) + Mask.shape)
+        s, r, c = np.nonzero(Mask)
+        V = np.random.rand(2, s.size).astype(np.float32)
+        P[:, s, r, c] = V
+        Pd[:, s, r, c] = V
+        self.assertTrue(np.all(P.todense() == Pd))
+
+        # pixels outside the mask cannot be assigned
+        self.assertRaises(IndexError, P.__setitem__, (0, [1], [2], [3]), 0.5)
+
+        # round trip (numpy and matlab formats)
+        tmpDir = tempfile.mkdtemp()
+        for fn in ['P.npz', 'P.mat']:
+            emlib.save_sparse_prob(os.path.join(tmpDir, fn), P)
+            P2 = emlib.load_sparse_prob(os.path.join(tmpDir, fn))
+            self.assertTrue(P2.shape == P.shape)
+            self.assertTrue(np.all(P2.todense() == Pd))
+
+        # merge with a second (overlapping) set of estimates
+        Mask2 = np.random.rand(*Mask.shape) < 0.2
+        Q = emlib.SparseProbVolume.from_mask(2, Mask2, dtype=np.float32)
+        s, r, c = np.nonzero(Mask2)
+        Q[:, s, r, c] = 2
+        Pd[:, s, r, c] = 2
+        PQ = P.merge(Q)
+        self.assertTrue(np.all(PQ.todense() == Pd))
+        self.assertTrue(np.all(PQ.restrict(Mask2).todense() == Q.todense()))
+
+
+    def test_refinement_mask(self):
+        # estimates on a coarse grid for a slice with a vertical boundary
+        P = -1 * np.ones((2,40,40))
+        P[1,::8,::8] = 0.0
+        P[1,::8,24::8] = 1.0
+        P[0,::8,::8] = 1 - P[1,::8,::8]
+
+        New = emlib.refinement_mask(P, 50)
+        self.assertTrue(np.sum(New) == 50)
+        self.assertTrue(np.all(P[0,New] < 0))   # only unevaluated pixels
+        cols = np.nonzero(New)[1]
+        self.assertTrue(np.all((cols > 8) & (cols < 24)))   # near the boundary
+
+        # nothing is uncertain enough
+        self.assertTrue(not np.any(emlib.refinement_mask(P, 50, tol=1.0)))
+
+
+    def test_extract_tiles(self):
+        X = np.random.rand(3,20,30)
+        r = 4  # r := tile radius
+        Idx = np.array([[0,4,4], [1,10,12], [2,15,25], [2,4,25]])
+
+        Xi = emlib.extract_tiles(X, Idx, r)
+        self.assertTrue(Xi.shape == (Idx.shape[0], 1, 2*r+1, 2*r+1))
+        for jj in range(Idx.shape[0]):
+            s, a, b = Idx[jj,:]
+            self.assertTrue(np.all(Xi[jj,0,...] == X[s, a-r:a+r+1, b-r:b+r+1]))
+
+        # writing into a (larger) pre-allocated buffer
+        out = -1*np.ones((10, 1, 2*r+1, 2*r+1), dtype=np.float32)
+        emlib.extract_tiles(X, Idx, r, out=out)
+        self.assertTrue(np.allclose(out[:Idx.shape[0],...], Xi))
+        self.assertTrue(np.all(out[Idx.shape[0]:,...] == -1))
+
+        # tiles that extend beyond the volume are an error
+        self.assertRaises(RuntimeError, emlib.extract_tiles, X, np.array([[0,3,10]]), r)
+
+
+
+    def test_minibatch_prefetcher(self):
+        r = 3
+        batchDim = (7, 1, 2*r+1, 2*r+1)
+        X = np.random.rand(2,20,20).astype(np.float32)
+        Y = np.random.randint(0, 2, size=X.shape)
+
+        # the background process should produce the same minibatches
+        # as inline assembly
+        for nBuffers in [0, 2]:
+            it = emlib.interior_pixel_generator(X, r, batchDim[0])
+            nTiles = 0
+            for Xi, yi, Idx, pct in emlib.MinibatchPrefetcher(it, X, Y, batchDim, nBuffers=nBuffers):
+                n = Idx.shape[0]
+                self.assertTrue(Xi.flags['C_CONTIGUOUS'] and Xi.dtype == np.float32)
+                self.assertTrue(np.all(Xi[:n,...] == emlib.extract_tiles(X, Idx, r)))
+                self.assertTrue(np.all(yi[:n] == Y[Idx[:,0], Idx[:,1], Idx[:,2]]))
+                nTiles += n
+            self.assertTrue(nTiles == 2*(20-2*r)**2)
+
+        # augmentation is reproducible under a seed, whether minibatches
+        # are assembled inline or by one or more workers
+        augment = lambda Xi, rng: Xi + rng.rand()
+        results = []
+        for nBuffers, nWorkers in [(0, 1), (2, 1), (3, 3)]:
+            it = emlib.interior_pixel_generator(X, r, batchDim[0])
+            prefetcher = emlib.MinibatchPrefetcher(it, X, Y, batchDim, data_augment=augment,
+                                                   nBuffers=nBuffers, nWorkers=nWorkers, seed=7)
+            results.append([(Xi.copy(), Idx) for Xi, yi, Idx, pct in prefetcher])
+        for other in results[1:]:
+            self.assertTrue(len(other) == len(results[0]))
+            for (Xa, Ia), (Xb, Ib) in zip(results[0], other):
+                self.assertTrue(np.all(Ia == Ib) and np.all(Xa == Xb))
+        self.assertTrue(not np.all(results[0][0][0] == emlib.extract_tiles(X, results[0][0][1], r)))
+
+        # stopping early should not hang
+        it = emlib.interior_pixel_generator(X, r, batchDim[0])
+        prefetcher = emlib.MinibatchPrefetcher(it, X, Y, batchDim, nBuffers=2)
+        for Xi, yi, Idx, pct in prefetcher:
+            break
+        self.assertTrue(prefetcher.nBatches == 0)
+
+        # errors in the producer are reported to the consumer
+        it = iter([(np.array([[0,0,0]]), 0.0)])  # tile is out of bounds
+        f = lambda: list(emlib.MinibatchPrefetcher(it, X, Y, batchDim, nBuffers=2))
+        self.assertRaises(RuntimeError, f)
+
+        # as is a producer that dies without reporting anything
+        it = emlib.interior_pixel_generator(X, r, batchDim[0])
+        f = lambda: list(emlib.MinibatchPrefetcher(it, X, Y, batchDim, data_augment=lambda Xi, rng: os._exit(1), nBuffers=2))
+        self.assertRaises(RuntimeError, f)
+
         
     def test_interior_pixel_generator(self):
         b = 10  # b := border size
@@ -109,6 +427,41 @@ class TestEmlib(unittest.TestCase):
         self.assertTrue(np.all(Y == Z))
 
 
+    def test_stratified_sampler(self):
+        b = 5
+        Y = (np.random.rand(3,40,50) > 0.7).astype(np.int8)
+        Y[1,10:20,10:20] = -1
+        mask = np.random.rand(*Y.shape) > 0.2
+        sampler = emlib.StratifiedSampler(Y, b, mask=mask, omitSlices=[2], omitLabels=[-1])
+        self.assertTrue(all([p.dtype == np.int32 for p in sampler.pools]))
+
+        nValid = [np.sum((Y[0:2,b:-b,b:-b] == y) & mask[0:2,b:-b,b:-b]) for y in [0,1]]
+        self.assertTrue(len(sampler) == 2*min(nValid))
+
+        # each epoch is a fresh, balanced draw
+        epochs = []
+        for ii in range(2):
+            Idx = np.vstack([idx for idx, pct in sampler.epoch(30)])
+            self.assertTrue(Idx.shape[0] == len(sampler))
+            self.assertTrue(np.all(Idx[:,0] < 2))
+            self.assertTrue(np.all(Idx[:,1:] >= b))
+            self.assertTrue(np.all(Idx[:,1] < 40-b) and np.all(Idx[:,2] < 50-b))
+            self.assertTrue(np.all(mask[Idx[:,0], Idx[:,1], Idx[:,2]]))
+            y = Y[Idx[:,0], Idx[:,1], Idx[:,2]]
+            self.assertTrue(np.sum(y == 0) == np.sum(y == 1))
+            epochs.append(Idx)
+        self.assertFalse(np.all(epochs[0] == epochs[1]))
+
+        # an epoch can be reproduced (e.g. when resuming training)
+        sampler = emlib.StratifiedSampler(Y, b, omitLabels=[-1])
+        sampler.epoch(30, seed=1)
+        Idx = np.vstack([idx for idx, pct in sampler.epoch(30, seed=2)])
+        sampler = emlib.StratifiedSampler(Y, b, omitLabels=[-1])
+        sampler.replay([1])
+        Idx2 = np.vstack([idx for idx, pct in sampler.epoch(30, seed=2, skip=3)])
+        self.assertTrue(np.all(Idx[90:] == Idx2))
+
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+"""Unit test for postproc.py
+
+To run (from pwd):
+    PYTHONPATH=../src python test_postproc.py
+"""
+
+__author__ = "Mike Pekala"
+__copyright__ = "Copyright 2015, JHU/APL"
+__license__ = "Apache 2.0"
+
+
+import os, tempfile
+import unittest
+import numpy as np
+
+import emlib
+import postproc
+
+
+
+class TestPostproc(unittest.TestCase):
+    def test_inpaintn(self):
+        # a smooth surface with 80% of the values missing
+        r, c = np.meshgrid(np.linspace(0, 1, 40), np.linspace(0, 1, 50), indexing='ij')
+        X = np.sin(3*r) * np.cos(2*c)
+        Xn = X.copy()
+        Xn[np.random.rand(*X.shape) < 0.8] = np.nan
+
+        Y = postproc.inpaintn(Xn)
+        self.assertTrue(np.all(np.isfinite(Y)))
+        self.assertTrue(np.all(Y[np.isfinite(Xn)] == Xn[np.isfinite(Xn)]))
+        self.assertTrue(np.mean(np.abs(Y - X)) < 0.01)
+
+
+    def test_ordfilt(self):
+        X = np.random.rand(10,12)
+        F = postproc.disk(2)
+        self.assertTrue(np.sum(F) == 13)
+
+        Y = postproc.ordfilt(X, 7, F)
+        Xp = np.zeros((14,16))
+        Xp[2:-2,2:-2] = X    # ordfilt2 uses zero padding
+        for ii in range(X.shape[0]):
+            for jj in range(X.shape[1]):
+                v = np.sort(Xp[ii:ii+5, jj:jj+5][F])
+                self.assertTrue(Y[ii,jj] == v[6])
+
+
+    def test_postproc_volume(self):
+        P = np.random.rand(2,3,20,25).astype(np.float32)
+        Mask = np.random.rand(3,20,25) < 0.3
+        Ps = emlib.SparseProbVolume.from_mask(2, Mask, dtype=np.float32)
+        s, r, c = np.nonzero(Mask)
+        Ps[:, s, r, c] = P[:, s, r, c]
+
+        # dense, sparse and parallel versions should agree
+        Y1 = postproc.postproc_volume(Ps.todense(), nWorkers=1, verbose=False)
+        Y2 = postproc.postproc_volume(Ps, nWorkers=1, verbose=False)
+        fn = os.path.join(tempfile.mkdtemp(), 'Y.npy')
+        Y3 = postproc.postproc_volume(Ps, nWorkers=2, outFile=fn, tiffFile=fn[:-4] + '.tif', verbose=False)
+        self.assertTrue(Y1.shape == (3,20,25))
+        self.assertTrue(np.all(Y1 == Y2))
+        self.assertTrue(np.all(Y1 == np.load(fn)))
+        self.assertTrue(np.all(Y1 == emlib.load_tiff_data(fn[:-4] + '.tif', cache=False)))
+        self.assertTrue(np.all((Y1 >= 0) & (Y1 <= 1)))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,222 @@
+"""Unit test for pycaffe2.py
+
+To run (from pwd):
+    PYTHONPATH=../src python test_pycaffe2.py
+"""
+
+__author__ = "Mike Pekala"
+__copyright__ = "Copyright 2015, JHU/APL"
+__license__ = "Apache 2.0"
+
+
+import unittest
+import numpy as np
+from scipy.signal import correlate2d
+
+import pycaffe2
+
+
+
+def _conv_spec(name, bottom, k, stride=1, pad=0):
+    return {'name' : name, 'type' : 'Convolution', 'bottom' : [bottom], 'top' : [name],
+            'kernel' : k, 'stride' : stride, 'pad' : pad}
+
+def _pool_spec(name, bottom, k, stride):
+    return {'name' : name, 'type' : 'Pooling', 'bottom' : [bottom], 'top' : [name],
+            'kernel' : k, 'stride' : stride, 'pad' : 0}
+
+def _spec(name, ltype, bottom, top=None):
+    return {'name' : name, 'type' : ltype, 'bottom' : [bottom], 'top' : [top or name]}
+
+_data_spec = {'name' : 'data', 'type' : 'MemoryData', 'bottom' : [], 'top' : ['data', 'label']}
+
+
+
+def _max_pool(X):
+    """2x2 max pooling with stride 2 (rounding up, as Caffe does)."""
+    m, n = X.shape
+    Xp = -np.inf * np.ones((m + m%2, n + n%2))
+    Xp[:m,:n] = X
+    return np.max(np.max(np.reshape(Xp, (Xp.shape[0]/2, 2, Xp.shape[1]/2, 2)), axis=3), axis=1)
+
+
+
+class _Blob(object):
+    def __init__(self, shape):
+        self.data = np.random.rand(*shape).astype(np.float32)
+        self.diff = np.zeros(shape, dtype=np.float32)
+
+class _Layer(object):
+    def __init__(self, *shapes):
+        self.blobs = [_Blob(shape) for shape in shapes]
+
+class _Net(object):
+    """A stand-in for a caffe.Net; the "gradient" is a function of the input."""
+    def __init__(self):
+        self.layers = [_Layer((4,3,2,2), (4,)), _Layer(), _Layer((5,4))]
+    def set_input_arrays(self, X, y):
+        assert(X.dtype == np.float32 and y.dtype == np.float32 and y.ndim == 4)
+        self._g = np.mean(X)
+    def forward(self):
+        return {'loss' : np.array(self._g)}
+    def backward(self):
+        for layer in self.layers:
+            for b in layer.blobs:
+                b.diff[...] = self._g * b.data
+
+class _Solver(object):
+    def __init__(self):
+        self.net = _Net()
+
+class _SolverParam(object):
+    class SolverType(object):
+        Value = staticmethod(lambda name: 0)
+    lr_policy = u'step';  solver_type = 0
+    base_lr = 0.01;  gamma = 0.1;  stepsize = 2;  momentum = 0.9;  weight_decay = 0.005
+    display = 100;  max_iter = 10;  snapshot = 5
+
+
+
+class TestPycaffe2(unittest.TestCase):
+    def test_sgd_step(self):
+        param = _SolverParam()
+        solverMD = pycaffe2.SGDSolverMemoryData(_Solver(), param, verbose=False, nanCheckInterval=2)
+        blobs = [b for layer in solverMD._solver.net.layers for b in layer.blobs]
+        W = [b.data.copy() for b in blobs]
+        V = [0 for b in blobs]
+
+        for ii in range(4):
+            X = np.random.rand(10, 1, 5, 5)
+            solverMD.step(X, np.random.randint(0, 2, size=10))
+
+            # the (reference) update
+            alpha = param.base_lr * param.gamma ** np.floor(ii / param.stepsize)
+            for k in range(len(W)):
+                V[k] = param.momentum * V[k] - alpha * np.mean(X.astype(np.float32)) * W[k]
+                W[k] = (W[k] + V[k]) * (1 - alpha * param.weight_decay)
+                self.assertTrue(np.allclose(blobs[k].data, W[k], rtol=1e-5))
+
+        # resuming from a saved state gives the same updates
+        solverMD2 = pycaffe2.SGDSolverMemoryData(_Solver(), param, verbose=False)
+        solverMD2.set_state(solverMD.get_state())
+        self.assertTrue(solverMD2._iter == solverMD._iter)
+        for s in [solverMD, solverMD2]:
+            s.step(X, np.zeros(10))
+        blobs2 = [b for layer in solverMD2._solver.net.layers for b in layer.blobs]
+        self.assertTrue(all([np.allclose(b.data, b2.data) for b, b2 in zip(blobs, blobs2)]))
+
+        # NaNs are an error
+        X[0,0,0,0] = np.nan
+        self.assertRaises(RuntimeError, solverMD.step, X, np.zeros(10))
+
+
+    def test_sgd_data_parallel(self):
+        param = _SolverParam()
+        nWorkers = 3
+        solverMD = pycaffe2.SGDSolverDataParallel(_Solver(), param, _Net, nWorkers, verbose=False)
+        blobs = [b for layer in solverMD._solver.net.layers for b in layer.blobs]
+        W = [b.data.copy() for b in blobs]
+        V = [0 for b in blobs]
+
+        try:
+            for ii in range(3):
+                Xs = [np.random.rand(10, 1, 5, 5).astype(np.float32) for jj in range(nWorkers)]
+                for jj, X in enumerate(Xs):
+                    out = solverMD.step(X, np.random.randint(0, 2, size=10))
+                    # only the last minibatch of the set triggers an update
+                    self.assertTrue((out is None) == (jj < nWorkers-1))
+                self.assertTrue(solverMD._iter == ii+1)
+
+                # the (reference) update uses the averaged gradient
+                g = np.mean([np.mean(X) for X in Xs])
+                self.assertAlmostEqual(float(out['loss']), g, places=5)
+                alpha = param.base_lr * param.gamma ** np.floor(ii / param.stepsize)
+                for k in range(len(W)):
+                    V[k] = param.momentum * V[k] - alpha * g * W[k]
+                    W[k] = (W[k] + V[k]) * (1 - alpha * param.weight_decay)
+                    self.assertTrue(np.allclose(blobs[k].data, W[k], rtol=1e-5))
+        finally:
+            solverMD.close()
+
+        # a replica that cannot be created is an error (not a hang)...
+        def make_net():
+            raise MemoryError()
+        solverMD = pycaffe2.SGDSolverDataParallel(_Solver(), param, make_net, 2, verbose=False)
+        X = np.random.rand(10, 1, 5, 5).astype(np.float32)
+        try:
+            solverMD.step(X, np.zeros(10))
+            self.assertRaises(RuntimeError, solverMD.step, X, np.zeros(10))
+        finally:
+            solverMD.close()
+
+        # ...as is a worker that dies
+        solverMD = pycaffe2.SGDSolverDataParallel(_Solver(), param, _Net, 2, verbose=False)
+        solverMD.step(X, np.zeros(10))
+        solverMD.step(X, np.zeros(10))
+        solverMD._workers[0].terminate()
+        solverMD._workers[0].join()
+        solverMD.step(X, np.zeros(10))
+        self.assertRaises(RuntimeError, solverMD._wait, 0.1)
+        solverMD.close()
+
+
+
+    def test_dense_geometry(self):
+        # The N3 network (65x65 tiles)
+        specs = [_data_spec,
+                 _conv_spec('conv1', 'data', 5),
+                 _pool_spec('pool1', 'conv1', 2, 2),
+                 dict(_spec('norm1', 'LRN', 'pool1'), withinChannel=True),
+                 _conv_spec('conv2', 'norm1', 5),
+                 _pool_spec('pool2', 'conv2', 2, 2),
+                 _conv_spec('conv3', 'pool2', 5),
+                 _pool_spec('pool3', 'conv3', 2, 2),
+                 _spec('ip1', 'InnerProduct', 'pool3'),
+                 _spec('relu4', 'ReLU', 'ip1', 'ip1'),
+                 _spec('ip2', 'InnerProduct', 'ip1'),
+                 {'name' : 'loss', 'type' : 'SoftmaxWithLoss', 'bottom' : ['ip2', 'label'], 'top' : ['loss']},
+                 _spec('prob', 'Softmax', 'ip2')]
+
+        geom = pycaffe2.dense_geometry(specs, 65)
+        self.assertTrue(geom['stride'] == 8)
+        self.assertTrue(geom['ipKernel'] == {'ip1' : 5, 'ip2' : 1})
+        # pool1 and pool2 clip at the tile boundary, as does the LRN
+        self.assertTrue(len(geom['warnings']) == 3)
+
+        # a tile that is too small is an error
+        self.assertRaises(ValueError, pycaffe2.dense_geometry, specs, 21)
+
+
+    def test_shift_and_stitch(self):
+        # A toy "network": conv(2x2) -> pool(2,2) -> conv(2x2) -> pool(2,2)
+        # For 7x7 tiles this has no clipped pooling windows, so the dense
+        # estimates should be identical to the tile-based ones.
+        r = 3
+        K1 = np.random.rand(2,2)
+        K2 = np.random.rand(2,2)
+        forward = lambda X: _max_pool(correlate2d(_max_pool(correlate2d(X, K1, 'valid')), K2, 'valid'))[np.newaxis,...]
+
+        specs = [_data_spec,
+                 _conv_spec('conv1', 'data', 2), _pool_spec('pool1', 'conv1', 2, 2),
+                 _conv_spec('conv2', 'pool1', 2), _pool_spec('prob', 'conv2', 2, 2)]
+        geom = pycaffe2.dense_geometry(specs, 2*r+1)
+        self.assertTrue(geom['stride'] == 4)
+        self.assertTrue(len(geom['warnings']) == 0)
+
+        Xpad = np.random.rand(19+2*r, 22+2*r).astype(np.float32)
+        P = pycaffe2.shift_and_stitch(forward, Xpad, r, geom['stride'])
+        self.assertTrue(P.shape == (1, 19, 22))
+
+        for ii in range(P.shape[1]):
+            for jj in range(P.shape[2]):
+                Pij = forward(Xpad[ii:ii+2*r+1, jj:jj+2*r+1])
+                self.assertTrue(Pij.shape == (1,1,1))
+                self.assertAlmostEqual(Pij[0,0,0], P[0,ii,jj], places=4)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4